@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020  Tobias Isenberg
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import numpy as np
+import sys
+import os
+try:
+    import zstandard # optional, only needed for zstd-compressed segments
+except ImportError:
+    zstandard = None
+
+# the file formats, these have to match the ones written by oximeter-data-recording.py
+csvHeader = "PPG,BPM,SPO2,MS-timestamp,buffer-end-marker\n"
+indexHeader = "MS-timestamp,byte-offset\n"
+samplesPerRecord = 4
+noReadingValue = 127
+binaryFileExtension = ".oxb"
+binaryMagic = b"OXIVIS01"
+binaryHeaderSize = 64
+binaryRecordDtype = np.dtype([('ms', '>u4'), ('values', 'u1', (samplesPerRecord, 3)), ('marker', 'u1')])
+byteStrings = np.array([str(value) for value in range(256)])
+compressedFileExtensions = [".gz", ".bz2", ".xz", ".zst"]
+
+def isCompressedFile(fileName):
+    return os.path.splitext(fileName)[1] in compressedFileExtensions
+
+# open a data file for reading; compressed segments are decompressed as a stream while reading
+def openDataFile(fileName):
+    extension = os.path.splitext(fileName)[1]
+    if (extension == ".gz"): return gzip.open(fileName, 'rb')
+    if (extension == ".bz2"): return bz2.open(fileName, 'rb')
+    if (extension == ".xz"): return lzma.open(fileName, 'rb')
+    if (extension == ".zst"):
+        if (zstandard == None):
+            print("Reading " + fileName + " requires the zstandard module (pip3 install zstandard)")
+            sys.exit()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fileName, 'rb')))
+    return open(fileName, 'rb')
+
+# the records of a binary recording, through a memory map or, for compressed segments, decompressed into memory;
+# a recording without any samples yet consists of the header only
+def readBinaryRecords(fileName):
+    if (isCompressedFile(fileName)):
+        with openDataFile(fileName) as f:
+            f.read(binaryHeaderSize)
+            data = f.read()
+            f.close()
+        return np.frombuffer(data, dtype=binaryRecordDtype, count=len(data) // binaryRecordDtype.itemsize)
+    if (os.path.getsize(fileName) <= binaryHeaderSize): return np.zeros(0, dtype=binaryRecordDtype)
+    return np.memmap(fileName, dtype=binaryRecordDtype, mode='r', offset=binaryHeaderSize)
+
+# reconstruct the start time string posted by the ESP32 from a recording's filename
+# (oximeter-YYYYMMDD-HHMMSS-ms.csv becomes "ms = DD.MM.YYYY, HH:MM:SS")
+def startTimeFromFileName(fileName):
+    nameParts = os.path.basename(fileName).split(".")[0].split("-")
+    startDate = nameParts[-3]
+    startTime = nameParts[-2]
+    return nameParts[-1] + " = " + startDate[6:8] + "." + startDate[4:6] + "." + startDate[:4] + ", " + startTime[:2] + ":" + startTime[2:4] + ":" + startTime[4:6]
+
+def csvToBinary(csvFileName, binaryFileName):
+    with io.TextIOWrapper(openDataFile(csvFileName), encoding='utf-8') as csvfile:
+        dataReader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        headers = next(dataReader)
+        rows = np.array([row for row in dataReader], dtype=str).reshape(-1, len(headers))
+        csvfile.close()
+    columns = {key: rows[:, index] for index, key in enumerate(headers)}
+
+    numberOfSamples = len(rows)
+    if (numberOfSamples % samplesPerRecord != 0):
+        print("Cannot convert " + csvFileName + ": " + str(numberOfSamples) + " samples are not a multiple of " + str(samplesPerRecord))
+        return False
+    ms = columns["MS-timestamp"].astype(np.uint32).reshape(-1, samplesPerRecord)
+    if (np.any(ms != ms[:, :1])):
+        print("Cannot convert " + csvFileName + ": samples of one record do not share a timestamp")
+        return False
+
+    # samples without a reading have empty BPM and SpO2 fields, these were 127 in the original data buffer
+    noReading = columns["SPO2"] == ""
+    records = np.zeros(numberOfSamples // samplesPerRecord, dtype=binaryRecordDtype)
+    records['ms'] = ms[:, 0]
+    records['values'][:, :, 0] = columns["PPG"].astype(np.uint8).reshape(-1, samplesPerRecord)
+    records['values'][:, :, 1] = np.where(noReading, str(noReadingValue), columns["BPM"]).astype(np.uint8).reshape(-1, samplesPerRecord)
+    records['values'][:, :, 2] = np.where(noReading, str(noReadingValue), columns["SPO2"]).astype(np.uint8).reshape(-1, samplesPerRecord)
+    records['marker'] = columns["buffer-end-marker"].astype(np.uint8).reshape(-1, samplesPerRecord)[:, -1]
+
+    # the start time is cut to the size of the header, as by the recorder
+    startTime = startTimeFromFileName(csvFileName).encode('utf-8')[:binaryHeaderSize - len(binaryMagic)]
+    with open(binaryFileName, 'wb') as f:
+        f.write(binaryMagic + startTime.ljust(binaryHeaderSize - len(binaryMagic), b"\0"))
+        f.write(records.tobytes())
+        f.close()
+    return True
+
+def binaryToCsv(binaryFileName, csvFileName):
+    with openDataFile(binaryFileName) as f:
+        header = f.read(binaryHeaderSize)
+        f.close()
+    if (header[:len(binaryMagic)] != binaryMagic):
+        print("Cannot convert " + binaryFileName + ": not an oximeter binary recording")
+        return False
+    records = readBinaryRecords(binaryFileName)
+
+    values = records['values'].reshape(-1, 3)
+    noReading = values[:, 2] == noReadingValue
+    marker = np.zeros((len(records), samplesPerRecord), dtype=np.uint8)
+    marker[:, -1] = records['marker']
+    fields = [
+        byteStrings[values[:, 0]],
+        np.where(noReading, "", byteStrings[values[:, 1]]),
+        np.where(noReading, "", byteStrings[values[:, 2]]),
+        np.repeat(records['ms'], samplesPerRecord).astype(str),
+        byteStrings[marker.ravel()],
+    ]
+    lines = fields[0]
+    for field in fields[1:]:
+        lines = np.char.add(np.char.add(lines, ","), field)
+
+    with open(csvFileName, 'w', encoding='utf-8') as f:
+        f.write(csvHeader)
+        if (len(lines) > 0): f.write("\n".join(lines.tolist()) + "\n")
+        f.close()
+    return True
+
+# the index of a CSV recording as written by the recorder: the first ms timestamp of each data buffer (a buffer
+# ends with a buffer-end marker of 127) and the byte offset at which the buffer starts in the file
+def indexFileName(fileName):
+    return os.path.splitext(fileName)[0] + ".index.csv"
+
+def rebuildIndex(fileName):
+    if (isCompressedFile(fileName)):
+        print("Compressed segments are read as a stream and need no index: " + fileName)
+        return False
+    indexLines = []
+    with open(fileName, 'rb') as f:
+        if (f.read(len(binaryMagic)) == binaryMagic):
+            print("Binary recordings have fixed-size records and need no index: " + fileName)
+            return False
+        f.seek(0)
+        offset = len(f.readline())
+        bufferStarts = True
+        for line in f:
+            fields = line.split(b",")
+            if (bufferStarts) and (len(fields) == 5): indexLines.append(fields[3].decode('ascii') + "," + str(offset) + "\n")
+            bufferStarts = (len(fields) == 5) and (fields[4].strip() == str(noReadingValue).encode('ascii'))
+            offset += len(line)
+        f.close()
+    with open(indexFileName(fileName), 'w') as f:
+        f.write(indexHeader)
+        f.write("".join(indexLines))
+        f.close()
+    return True
+
+if (len(sys.argv) < 2):
+    print("Too few arguments. Please call script with one or more data files to convert. CSV files are converted to the binary format and vice versa.")
+    print("Compressed segments (e.g., .csv.gz or " + binaryFileExtension + ".gz) are converted into uncompressed files.")
+    print("With --index, the index of the data buffers is (re)built for the given CSV files instead. Examples:")
+    print(os.path.basename(__file__) + " oximeter-20200706-002654-29871.csv")
+    print(os.path.basename(__file__) + " oximeter-20200706-002654-29871" + binaryFileExtension + " oximeter-20200706-003426-481146" + binaryFileExtension)
+    print(os.path.basename(__file__) + " --index oximeter-20200706-002654-29871.csv oximeter-20200706-003426-481146.csv")
+    sys.exit()
+
+if (sys.argv[1] == "--index"):
+    for inputFileName in sys.argv[2:]:
+        if (rebuildIndex(inputFileName)): print("Wrote index " + indexFileName(inputFileName))
+    sys.exit()
+
+for inputFileName in sys.argv[1:]:
+    baseName, extension = os.path.splitext(os.path.splitext(inputFileName)[0] if (isCompressedFile(inputFileName)) else inputFileName)
+    if (extension == binaryFileExtension):
+        outputFileName = baseName + ".csv"
+        converted = binaryToCsv(inputFileName, outputFileName)
+    else:
+        outputFileName = baseName + binaryFileExtension
+        converted = csvToBinary(inputFileName, outputFileName)
+    if (converted): print("Converted " + inputFileName + " to " + outputFileName)
@@ -16,22 +16,287 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import paho.mqtt.client as mqttClient
+import numpy as np
+import bz2
+import gzip
+import http.server
+import lzma
 import os
+import queue
+import shutil
+import threading
+import time
 from datetime import datetime
+try:
+    import zstandard                # optional, only needed for segmentCompression = "zstd"
+except ImportError:
+    zstandard = None
 
 broker_address= "192.168.1.1"       # Broker address
 port = 1883                         # Broker port
-topicData = "sensors/oximeter/data"
-topicStatus = "sensors/oximeter/status"
-topicStarttime = "sensors/oximeter/starttime"
-filenameLocationBasis = "/var/log/openhab2/oximeter-"
+topicData = "sensors/+/data"        # the + stands for the name of the device, e.g., sensors/oximeter/data
+topicStatus = "sensors/+/status"
+topicStarttime = "sensors/+/starttime"
+filenameLocationDirectory = "/var/log/openhab2/" # files are named after the device, e.g., oximeter-20200705-143412-15586.csv
 if (os.name == "nt"): # FIXME: just for tests, sav files locally when running windows
-    filenameLocationBasis = "./oximeter-"
-filenameLocationFull = ""
+    filenameLocationDirectory = "./"
+recordingFormat = "csv"             # "csv" for text files or "binary" for the compact, memory-mappable format
+numberOfWorkers = 4                 # number of threads that decode and write the data, each serving a share of the devices
+writerQueueSize = 1000              # number of received messages that may wait for a worker before new ones are dropped
+flushEveryMessages = 4              # flush the recording file to disk after this many data messages ...
+flushEverySeconds = 60              # ... or after this many seconds, whichever comes first
+fsyncOnFlush = True                 # also force the flushed data onto the storage device (e.g., the SD card)
+logEverySeconds = 60                # interval of the summary log lines about the recorded data
+summaryResolutionsS = [1, 60]       # bucket sizes (in s) of the aggregates in the summary file next to each recording, [] for none
+writeIndexFile = True               # write an index of the data buffers' timestamps and file offsets next to each CSV recording
+segmentEveryMinutes = 60            # start a new segment of the recording after this many minutes of data (0 for no limit) ...
+segmentEveryMB = 0                  # ... or once the segment has reached this size in MB (0 for no limit); with both at 0, one file per recording
+segmentCompression = "gzip"         # compress finished segments in the background: "gzip", "bz2", "xz", "zstd", or "" to keep them uncompressed
+compressBinarySegments = False      # also compress binary segments; saves space, but the visualization then has to decompress them into memory instead of memory-mapping them
+metricsPort = 9105                  # serve the recorder's metrics in Prometheus text format on http://<host>:9105/metrics (0 for no server)
+metricsTopic = ""                   # also publish the metrics to this MQTT topic (e.g., "sensors/recorder/metrics"), "" for none ...
+metricsPublishEverySeconds = 60     # ... every this many seconds
+csvHeader = "PPG,BPM,SPO2,MS-timestamp,buffer-end-marker\n"
+indexHeader = "MS-timestamp,byte-offset\n"
+
+# layout of the data buffers posted by the ESP32: one 16 byte record per BLE notification, consisting of
+# a big-endian 32bit ms timestamp followed by 4 samples of PPG, BPM, and SpO2 (one byte each)
+samplesPerRecord = 4
+recordDtype = np.dtype([('ms', '>u4'), ('values', 'u1', (samplesPerRecord, 3))])
+noReadingValue = 127                # SpO2 value reported when the oximeter has no reading; also the buffer-end marker
+byteStrings = np.array([str(value) for value in range(256)]) # preformatted byte values for the CSV output
+
+# binary recording format: a 64 byte header (8 byte magic and the start time string as posted by the ESP32, padded
+# with zeros) followed by the 16 byte records exactly as received plus one buffer-end marker byte per record
+binaryFileExtension = ".oxb"
+binaryMagic = b"OXIVIS01"
+binaryHeaderSize = 64
+binaryRecordDtype = np.dtype([('ms', '>u4'), ('values', 'u1', (samplesPerRecord, 3)), ('marker', 'u1')])
+
+# finished segments are compressed into a file with the same name plus the extension of the compression method
+compressionExtensions = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz", "zstd": ".zst"}
+
+# view a data buffer as an array of records
+def readRecords(payload):
+    numberOfRecords = len(payload) // recordDtype.itemsize
+    if (len(payload) % recordDtype.itemsize != 0):
+        print(str(datetime.now()) + " Ignoring " + str(len(payload) % recordDtype.itemsize) + " trailing bytes of incomplete record")
+    return np.frombuffer(payload, dtype=recordDtype, count=numberOfRecords)
+
+# decode a complete data buffer into per-sample columns, named like the CSV columns
+def decodeDataPayload(payload):
+    records = readRecords(payload)
+    values = records['values'].reshape(-1, 3)
+    bufferEndMarker = np.zeros(len(values), dtype=np.uint8)
+    if (len(values) > 0): bufferEndMarker[-1] = noReadingValue
+    return {
+        "PPG": values[:, 0],
+        "BPM": values[:, 1],
+        "SPO2": values[:, 2],
+        "MS-timestamp": np.repeat(records['ms'], samplesPerRecord),
+        "buffer-end-marker": bufferEndMarker,
+    }
+
+# format decoded columns as one block of CSV lines; BPM and SpO2 stay empty when there is no reading
+def formatCsvBlock(columns):
+    if (len(columns["PPG"]) == 0): return ""
+    noReading = columns["SPO2"] == noReadingValue
+    fields = [
+        byteStrings[columns["PPG"]],
+        np.where(noReading, "", byteStrings[columns["BPM"]]),
+        np.where(noReading, "", byteStrings[columns["SPO2"]]),
+        columns["MS-timestamp"].astype(str),
+        byteStrings[columns["buffer-end-marker"]],
+    ]
+    lines = fields[0]
+    for field in fields[1:]:
+        lines = np.char.add(np.char.add(lines, ","), field)
+    return "\n".join(lines.tolist()) + "\n"
+
+# the header of a binary recording file
+def formatBinaryHeader(startTime):
+    return binaryMagic + startTime.encode('utf-8')[:binaryHeaderSize - len(binaryMagic)].ljust(binaryHeaderSize - len(binaryMagic), b"\0")
+
+# convert a data buffer into binary file records, marking the last record as the end of the buffer
+def formatBinaryBlock(payload):
+    records = readRecords(payload)
+    block = np.zeros(len(records), dtype=binaryRecordDtype)
+    block['ms'] = records['ms']
+    block['values'] = records['values']
+    if (len(block) > 0): block['marker'][-1] = noReadingValue
+    return block.tobytes()
+
+# the summary file of a recording: per-bucket (e.g., per-second and per-minute) sample and no-reading counts and the
+# min, max, and mean of PPG, BPM, and SpO2, maintained incrementally as the data arrives; buckets are aligned to the
+# ESP32's ms timestamps, and a bucket is written once a later one starts, so the file is complete up to the last minute
+summaryColumns = ["PPG", "BPM", "SPO2"]
+summaryHeader = "resolution-s,MS-start,samples,no-reading," + ",".join(column + "-min," + column + "-max," + column + "-mean" for column in summaryColumns) + "\n"
+
+class SummaryFile:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = open(fileName, 'w')
+        self.file.write(summaryHeader)
+        self.openBuckets = {resolution: None for resolution in summaryResolutionsS} # the latest, possibly incomplete bucket
+
+    # aggregate the samples of one data buffer into the buckets of one resolution
+    def aggregate(self, columns, resolution):
+        bucketStart = columns["MS-timestamp"].astype(np.int64) // (resolution * 1000) * (resolution * 1000)
+        firstIndices = np.flatnonzero(np.concatenate([[True], bucketStart[1:] != bucketStart[:-1]]))
+        noReading = columns["SPO2"] == noReadingValue
+        buckets = {
+            "MS-start": bucketStart[firstIndices],
+            "samples": np.diff(np.append(firstIndices, len(bucketStart))),
+            "no-reading": np.add.reduceat(noReading.astype(np.int64), firstIndices),
+        }
+        for column in summaryColumns:
+            values = columns[column].astype(np.float64)
+            valid = np.ones(len(values), dtype=bool) if (column == "PPG") else ~noReading
+            values[~valid] = np.nan
+            buckets[column + "-min"] = np.fmin.reduceat(values, firstIndices)
+            buckets[column + "-max"] = np.fmax.reduceat(values, firstIndices)
+            buckets[column + "-sum"] = np.add.reduceat(np.where(valid, values, 0), firstIndices)
+            buckets[column + "-count"] = np.add.reduceat(valid.astype(np.int64), firstIndices)
+        return buckets
+
+    def formatBuckets(self, buckets, resolution):
+        lines = []
+        for i in range(len(buckets["MS-start"])):
+            fields = [str(resolution), str(buckets["MS-start"][i]), str(buckets["samples"][i]), str(buckets["no-reading"][i])]
+            for column in summaryColumns:
+                if (buckets[column + "-count"][i] == 0):
+                    fields += ["", "", ""]
+                else:
+                    fields += [str(int(buckets[column + "-min"][i])), str(int(buckets[column + "-max"][i])),
+                        "{:.2f}".format(buckets[column + "-sum"][i] / buckets[column + "-count"][i])]
+            lines.append(",".join(fields) + "\n")
+        return "".join(lines)
+
+    def add(self, columns):
+        if (len(columns["MS-timestamp"]) == 0): return
+        for resolution in summaryResolutionsS:
+            buckets = self.aggregate(columns, resolution)
+            openBucket = self.openBuckets[resolution]
+            if (openBucket != None) and (openBucket["MS-start"][0] == buckets["MS-start"][0]):
+                # the buffer continues the open bucket, so merge it into the first one
+                for key in buckets:
+                    if key.endswith("-min"): buckets[key][0] = np.fmin(buckets[key][0], openBucket[key][0])
+                    elif key.endswith("-max"): buckets[key][0] = np.fmax(buckets[key][0], openBucket[key][0])
+                    elif (key != "MS-start"): buckets[key][0] += openBucket[key][0]
+            elif (openBucket != None):
+                self.file.write(self.formatBuckets(openBucket, resolution))
+            completeBuckets = {key: values[:-1] for key, values in buckets.items()}
+            self.file.write(self.formatBuckets(completeBuckets, resolution))
+            self.openBuckets[resolution] = {key: values[-1:] for key, values in buckets.items()}
+
+    def flush(self):
+        self.file.flush()
+        if (fsyncOnFlush): os.fsync(self.file.fileno())
+
+    def close(self):
+        for resolution, openBucket in self.openBuckets.items():
+            if (openBucket != None): self.file.write(self.formatBuckets(openBucket, resolution))
+        self.file.close()
+
+# counters, gauges, and histograms about the recorder's health and throughput, in the Prometheus text format;
+# updated by the MQTT thread and the workers, so all access goes through one lock
+metricDefinitions = {
+    "oximeter_connects_total": ("counter", "Successful connections to the MQTT broker"),
+    "oximeter_disconnects_total": ("counter", "Unexpected disconnections from the MQTT broker"),
+    "oximeter_messages_received_total": ("counter", "Data messages received from the ESP32"),
+    "oximeter_bytes_received_total": ("counter", "Bytes of data messages received from the ESP32"),
+    "oximeter_messages_dropped_total": ("counter", "Data messages dropped because the writer queue was full"),
+    "oximeter_samples_decoded_total": ("counter", "Samples decoded from the data messages"),
+    "oximeter_no_reading_samples_total": ("counter", "Decoded samples without a reading (SpO2 of 127)"),
+    "oximeter_no_reading_ratio": ("gauge", "Share of samples without a reading in the last data message"),
+    "oximeter_buffer_gap_seconds": ("histogram", "Gap between the last timestamp of a data message and the first of the next one"),
+    "oximeter_decode_seconds": ("histogram", "Time to decode and format one data message"),
+    "oximeter_write_seconds": ("histogram", "Time to write the data messages of one batch to a recording file"),
+    "oximeter_flush_seconds": ("histogram", "Time to flush (and fsync) a recording file"),
+    "oximeter_message_latency_seconds": ("histogram", "Time from receiving a data message to having written it"),
+    "oximeter_queue_depth": ("gauge", "Messages waiting for a worker"),
+    "oximeter_compression_queue_depth": ("gauge", "Finished segments waiting to be compressed"),
+}
+latencyBucketsS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+gapBucketsS = [0.05, 0.1, 0.5, 1, 5, 15, 30, 60, 300, 3600] # a data message holds 15 s of data, so gaps above that are lost messages
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {} # by metric name, then by label string, e.g., 'device="oximeter"'
+
+    @staticmethod
+    def labels(**labelValues):
+        return ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in labelValues.items())
+
+    def inc(self, name, amount = 1, **labelValues):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = self.labels(**labelValues)
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labelValues):
+        with self.lock:
+            self.values.setdefault(name, {})[self.labels(**labelValues)] = value
+
+    # histograms keep one count per bucket (not yet cumulative), followed by the sum and the count of all observations
+    def observe(self, name, value, **labelValues):
+        buckets = gapBucketsS if (name == "oximeter_buffer_gap_seconds") else latencyBucketsS
+        with self.lock:
+            histogram = self.values.setdefault(name, {}).setdefault(self.labels(**labelValues), [0] * (len(buckets) + 3))
+            histogram[np.searchsorted(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def format(self):
+        self.set("oximeter_compression_queue_depth", compressionQueue.qsize())
+        for i, workerQueue in enumerate(workerQueues): self.set("oximeter_queue_depth", workerQueue.qsize(), worker=i)
+        lines = []
+        with self.lock:
+            for name, (metricType, description) in metricDefinitions.items():
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " " + metricType)
+                for key, value in self.values.get(name, {}).items():
+                    if (metricType != "histogram"):
+                        lines.append(name + ("{" + key + "}" if (key != "") else "") + " " + str(value))
+                        continue
+                    buckets = gapBucketsS if (name == "oximeter_buffer_gap_seconds") else latencyBucketsS
+                    prefix = key + "," if (key != "") else ""
+                    for bound, count in zip([str(bound) for bound in buckets] + ["+Inf"], np.cumsum(value[:-2])):
+                        lines.append(name + "_bucket{" + prefix + 'le="' + bound + '"} ' + str(count))
+                    lines.append(name + "_sum" + ("{" + key + "}" if (key != "") else "") + " " + str(value[-2]))
+                    lines.append(name + "_count" + ("{" + key + "}" if (key != "") else "") + " " + str(value[-1]))
+        return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if (self.path not in ["/", "/metrics"]):
+            self.send_error(404)
+            return
+        body = metrics.format().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # keep the scrapes out of the log file
+        pass
+
+def startMetricsServer():
+    server = http.server.ThreadingHTTPServer(("", metricsPort), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="oximeter-metrics", daemon=True).start()
+    print(str(datetime.now()) + " Serving metrics on port " + str(metricsPort))
+
+def publishMetricsLoop(client):
+    while True:
+        time.sleep(metricsPublishEverySeconds)
+        client.publish(metricsTopic, metrics.format())
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print(str(datetime.now()) + " Connected to broker")
+        metrics.inc("oximeter_connects_total")
         global Connected                # Use global variable
         Connected = True                # Signal connection
 
@@ -41,18 +306,61 @@ def on_connect(client, userdata, flags, rc):
 def on_disconnect(client, userdata, rc):
     if rc != 0:
         print(str(datetime.now()) + " Unexpected disconnection.")
+        metrics.inc("oximeter_disconnects_total")
 
-def on_message(client, userdata, message):
-    # print(str(datetime.now()) + " Message received for topic "  + str(message.topic))
-    global topicStarttime
-    global filenameLocationBasis
-    global filenameLocationFull
+def openCompressedFile(fileName, compression):
+    if (compression == "gzip"): return gzip.open(fileName, 'wb', compresslevel=6)
+    if (compression == "bz2"): return bz2.open(fileName, 'wb')
+    if (compression == "xz"): return lzma.open(fileName, 'wb')
+    return zstandard.ZstdCompressor().stream_writer(open(fileName, 'wb'))
 
-    if (message.topic == topicStatus):
-        print(str(datetime.now()) + " Status: " + str(message.payload, 'utf-8', 'ignore'))
+# compress a finished segment next to the original, which is only removed once the compressed file is complete, so
+# that readers always find the full data in one of the two files
+def compressSegment(fileName):
+    compressedFileName = fileName + compressionExtensions[segmentCompression]
+    try:
+        with open(fileName, 'rb') as f, openCompressedFile(compressedFileName + ".tmp", segmentCompression) as compressedFile:
+            shutil.copyfileobj(f, compressedFile, 1024 * 1024)
+        if (fsyncOnFlush):
+            with open(compressedFileName + ".tmp", 'rb') as f: os.fsync(f.fileno())
+        os.replace(compressedFileName + ".tmp", compressedFileName)
+        os.remove(fileName)
+    except OSError as error:
+        print(str(datetime.now()) + " Could not compress " + fileName + ": " + str(error))
+        return
+    print(str(datetime.now()) + " Compressed " + fileName + " to " + compressedFileName + " (" + str(os.path.getsize(compressedFileName)) + " bytes)")
 
-    if (message.topic == topicStarttime):
-        timestamp = str(message.payload, 'utf-8', 'ignore')
+# the compression thread: compresses the segments that the workers have finished, one after the other
+def compressionLoop():
+    while True:
+        fileName = compressionQueue.get()
+        if (fileName == None): break
+        compressSegment(fileName)
+
+# the recording state of one oximeter: its current recording segment and the bookkeeping for flushing and logging;
+# a session is only ever touched by the worker thread that serves its device
+class DeviceSession:
+    def __init__(self, deviceId, workerQueue):
+        self.deviceId = deviceId
+        self.workerQueue = workerQueue
+        self.startTime = ""
+        self.lastTimestamp = None # the last ms timestamp of the previous data message
+        self.baseName = ""
+        self.segmentNumber = 0
+        self.segmentStartMs = None
+        self.fileName = ""
+        self.recordingFile = None
+        self.fileSize = 0
+        self.indexFile = None
+        self.summaryFile = None
+        self.droppedMessages = 0
+        self.messagesSinceFlush = 0
+        self.lastFlushTime = time.monotonic()
+        self.messagesSinceLog = 0
+        self.bytesSinceLog = 0
+
+    # derive the name of a new recording (without extension) from the start time posted by the ESP32 (e.g., "83376 = 05.07.2020, 14:52:39")
+    def recordingBaseName(self, timestamp):
         startTimeMs = timestamp.split(" = ")[0]
         startTimeDateTime = timestamp.split(" = ")[1]
         startTimeDate = startTimeDateTime.split(", ")[0]
@@ -61,60 +369,254 @@ def on_message(client, userdata, message):
         startTimeDay = startTimeDate.split(".")[0]
         startTimeTime = startTimeDateTime.split(", ")[1].replace(":", "")
 
-        filenameLocationFull = filenameLocationBasis + startTimeYear + startTimeMonth + startTimeDay + "-" + startTimeTime + "-" + startTimeMs + ".csv"
-        print(str(datetime.now()) + " Filename: " + filenameLocationFull + "")
-
-        with open(filenameLocationFull,'w') as f:
-            f.write("PPG,BPM,SPO2,MS-timestamp,buffer-end-marker\n")
-            f.close()
-
-    if (message.topic == topicData):
-        print(str(datetime.now()) + " Appending data to file "  + filenameLocationFull)
-        with open(filenameLocationFull,'a') as f:
-            counter = 0
-            counterTotal = 0
-            msTimestamp = 1<<31
-            ppg = 0
-            bpm = 0
-            spo2 = 0
-            bufferIndicator = ""
-            messageSize = len(message.payload)
-            for byte in message.payload:
-                counterTotal += 1
-                if (counterTotal == messageSize): bufferIndicator = "127"
-                else: bufferIndicator = "0"
-                if (counter == 0): msTimestamp = byte<<24
-                if (counter == 1): msTimestamp += byte<<16
-                if (counter == 2): msTimestamp += byte<<8
-                if (counter == 3): msTimestamp += byte
-                if (counter > 3): 
-                    if ((counter - 4) % 3 == 0): ppg = byte
-                    if ((counter - 4) % 3 == 1): bpm = byte
-                    if ((counter - 4) % 3 == 2): 
-                        spo2 = byte
-                        if (spo2 == 127):
-                            f.write(str(ppg) + ",,," + str(msTimestamp) + "," + bufferIndicator + "\n")
-                        else:
-                            f.write(str(ppg) + "," + str(bpm) + "," + str(spo2) + "," + str(msTimestamp) + "," + bufferIndicator + "\n")
-                counter += 1
-                counter = counter % 16
-            f.close()
-        print(str(datetime.now()) + " Appending data completed after " + str(counterTotal) + " bytes")
+        return filenameLocationDirectory + self.deviceId + "-" + startTimeYear + startTimeMonth + startTimeDay + "-" + startTimeTime + "-" + startTimeMs
+
+    # the name of the current segment, e.g., oximeter-20200705-143412-15586.0001.csv, or of the only file of the
+    # recording if it is not split into segments
+    def segmentFileName(self):
+        extension = binaryFileExtension if (recordingFormat == "binary") else ".csv"
+        if (segmentEveryMinutes > 0) or (segmentEveryMB > 0): return self.baseName + ".{:04d}".format(self.segmentNumber) + extension
+        return self.baseName + extension
+
+    # close the current recording (if any) and start a new one; the summary file covers all segments of the recording
+    def start(self, timestamp):
+        self.close()
+        self.startTime = timestamp
+        self.baseName = self.recordingBaseName(timestamp)
+        self.segmentNumber = 1
+        self.openSegment()
+        if (len(summaryResolutionsS) > 0): self.summaryFile = SummaryFile(self.baseName + ".summary.csv")
+
+    # every segment is a complete recording file with its own header and index
+    def openSegment(self):
+        self.fileName = self.segmentFileName()
+        self.segmentStartMs = None
+        print(str(datetime.now()) + " Filename: " + self.fileName + "")
+        self.recordingFile = open(self.fileName, 'wb')
+        if (recordingFormat == "binary"): header = formatBinaryHeader(self.startTime)
+        else: header = csvHeader.encode('ascii')
+        self.recordingFile.write(header)
+        self.fileSize = len(header)
+        if (writeIndexFile) and (recordingFormat == "csv"): # binary files have fixed-size records and need no index
+            self.indexFile = open(os.path.splitext(self.fileName)[0] + ".index.csv", 'w')
+            self.indexFile.write(indexHeader)
+
+    def closeSegment(self):
+        self.flush(force = True)
+        self.log()
+        self.recordingFile.close()
+        self.recordingFile = None
+        if (self.indexFile != None): self.indexFile.close()
+        self.indexFile = None
+        if (segmentCompression != "") and ((recordingFormat != "binary") or (compressBinarySegments)): compressionQueue.put(self.fileName)
+
+    # a segment is full once it spans segmentEveryMinutes of data or has reached segmentEveryMB, checked before each
+    # data buffer so that buffers are never split between segments
+    def segmentIsFull(self, segmentSize, nextTimestamp):
+        if (self.segmentStartMs == None): return False
+        if (segmentEveryMinutes > 0) and (nextTimestamp - self.segmentStartMs >= segmentEveryMinutes * 60 * 1000): return True
+        return (segmentEveryMB > 0) and (segmentSize >= segmentEveryMB * 1000 * 1000)
+
+    # append the blocks of several data buffers, given as (block, first ms timestamp, payload size), with one write
+    # per segment, rolling over to the next segment when the current one is full
+    def write(self, blocks):
+        segmentBlocks = []
+        segmentSize = self.fileSize
+        for block, firstTimestamp, numberOfBytes in blocks:
+            if (self.segmentIsFull(segmentSize, int(firstTimestamp))):
+                self.writeBlocks(segmentBlocks)
+                self.closeSegment()
+                self.segmentNumber += 1
+                self.openSegment()
+                segmentBlocks = []
+                segmentSize = self.fileSize
+            if (self.segmentStartMs == None): self.segmentStartMs = int(firstTimestamp)
+            segmentBlocks.append((block, firstTimestamp, numberOfBytes))
+            segmentSize += len(block)
+        self.writeBlocks(segmentBlocks)
+
+    def writeBlocks(self, blocks):
+        if (len(blocks) == 0): return
+        writeStartTime = time.perf_counter()
+        self.recordingFile.write(b"".join(block for block, firstTimestamp, numberOfBytes in blocks))
+        metrics.observe("oximeter_write_seconds", time.perf_counter() - writeStartTime)
+        indexLines = []
+        for block, firstTimestamp, numberOfBytes in blocks:
+            indexLines.append(str(firstTimestamp) + "," + str(self.fileSize) + "\n")
+            self.fileSize += len(block)
+            self.bytesSinceLog += numberOfBytes
+        if (self.indexFile != None): self.indexFile.write("".join(indexLines))
+        self.messagesSinceFlush += len(blocks)
+        self.messagesSinceLog += len(blocks)
+
+    def flush(self, force = False):
+        if (self.recordingFile == None) or (self.messagesSinceFlush == 0): return
+        now = time.monotonic()
+        if (force) or (self.messagesSinceFlush >= flushEveryMessages) or (now - self.lastFlushTime >= flushEverySeconds):
+            self.recordingFile.flush()
+            if (fsyncOnFlush): os.fsync(self.recordingFile.fileno())
+            if (self.indexFile != None): self.indexFile.flush()
+            if (self.summaryFile != None): self.summaryFile.flush()
+            metrics.observe("oximeter_flush_seconds", time.monotonic() - now)
+            self.messagesSinceFlush = 0
+            self.lastFlushTime = now
+
+    def log(self):
+        if (self.messagesSinceLog == 0): return
+        print(str(datetime.now()) + " Appended " + str(self.messagesSinceLog) + " data messages (" + str(self.bytesSinceLog) + " bytes) to file " + self.fileName +
+            ", " + str(self.workerQueue.qsize()) + " messages waiting")
+        self.messagesSinceLog = 0
+        self.bytesSinceLog = 0
+
+    def close(self):
+        if (self.recordingFile == None): return
+        self.closeSegment()
+        if (self.summaryFile != None): self.summaryFile.close()
+        self.summaryFile = None
+
+# the device name is the middle level of the topic, e.g., "oximeter" for sensors/oximeter/data
+def deviceIdFromTopic(topic):
+    return topic.split("/")[1]
+
+# sessions are assigned to the workers round robin when their device first shows up
+def getSession(deviceId):
+    if (deviceId not in sessions):
+        sessions[deviceId] = DeviceSession(deviceId, workerQueues[len(sessions) % numberOfWorkers])
+    return sessions[deviceId]
+
+def on_message(client, userdata, message):
+    # print(str(datetime.now()) + " Message received for topic "  + str(message.topic))
+    deviceId = deviceIdFromTopic(message.topic)
+
+    if mqttClient.topic_matches_sub(topicStatus, message.topic):
+        print(str(datetime.now()) + " Status " + deviceId + ": " + str(message.payload, 'utf-8', 'ignore'))
+
+    # everything that touches the disk happens in the worker threads, so that this network thread never waits for it
+    isStarttime = mqttClient.topic_matches_sub(topicStarttime, message.topic)
+    if (isStarttime) or mqttClient.topic_matches_sub(topicData, message.topic):
+        session = getSession(deviceId)
+        if (not isStarttime):
+            metrics.inc("oximeter_messages_received_total", device=deviceId)
+            metrics.inc("oximeter_bytes_received_total", len(message.payload), device=deviceId)
+        try:
+            session.workerQueue.put_nowait((session, isStarttime, message.payload, time.monotonic()))
+        except queue.Full:
+            session.droppedMessages += 1
+            metrics.inc("oximeter_messages_dropped_total", device=deviceId)
+            print(str(datetime.now()) + " Writer queue full, dropped message for topic " + str(message.topic) + " (" + str(session.droppedMessages) + " dropped in total)")
 
     # with open('/home/pi/test.txt','a+') as f:
     #      f.write("Message received: "  + message.payload + "\n")
 
+# a worker thread: decodes all messages that are waiting in its queue in one go, appends them to the files of
+# their sessions with one write per session, and flushes and logs according to the policies above
+def workerLoop(workerQueue):
+    workerSessions = []
+    lastLogTime = time.monotonic()
+    stopping = False
+
+    while (not stopping):
+        try:
+            batch = [workerQueue.get(timeout=1)]
+        except queue.Empty:
+            batch = []
+        while (len(batch) < writerQueueSize):
+            try:
+                batch.append(workerQueue.get_nowait())
+            except queue.Empty:
+                break
+
+        pendingBlocks = {}
+        writtenMessages = []
+        for session, isStarttime, payload, receivedTime in batch:
+            if (session == None):
+                stopping = True
+                break
+            if (session not in workerSessions): workerSessions.append(session)
+            if (isStarttime):
+                blocks = pendingBlocks.pop(session, [])
+                if (session.recordingFile != None): session.write(blocks)
+                session.start(str(payload, 'utf-8', 'ignore'))
+                session.lastTimestamp = None
+            elif (session.recordingFile == None):
+                print(str(datetime.now()) + " Received data for " + session.deviceId + " before a start time, ignoring " + str(len(payload)) + " bytes")
+            else:
+                decodeStartTime = time.perf_counter()
+                columns = decodeDataPayload(payload)
+                if (len(columns["MS-timestamp"]) == 0): continue # the blocks of the earlier messages stay pending
+                blocks = pendingBlocks.setdefault(session, [])
+                if (recordingFormat == "binary"): blocks.append((formatBinaryBlock(payload), columns["MS-timestamp"][0], len(payload)))
+                else: blocks.append((formatCsvBlock(columns).encode('ascii'), columns["MS-timestamp"][0], len(payload)))
+                if (session.summaryFile != None): session.summaryFile.add(columns)
+                metrics.observe("oximeter_decode_seconds", time.perf_counter() - decodeStartTime)
+                noReadingSamples = int(np.count_nonzero(columns["SPO2"] == noReadingValue))
+                metrics.inc("oximeter_samples_decoded_total", len(columns["SPO2"]), device=session.deviceId)
+                metrics.inc("oximeter_no_reading_samples_total", noReadingSamples, device=session.deviceId)
+                metrics.set("oximeter_no_reading_ratio", noReadingSamples / len(columns["SPO2"]), device=session.deviceId)
+                if (session.lastTimestamp != None):
+                    metrics.observe("oximeter_buffer_gap_seconds", (int(columns["MS-timestamp"][0]) - session.lastTimestamp) / 1000, device=session.deviceId)
+                session.lastTimestamp = int(columns["MS-timestamp"][-1])
+                writtenMessages.append((session, payload, receivedTime))
+        for session, blocks in pendingBlocks.items():
+            session.write(blocks)
+
+        logNow = time.monotonic() - lastLogTime >= logEverySeconds
+        for session in workerSessions:
+            if (stopping): session.close()
+            else: session.flush()
+            if (logNow): session.log()
+        if (logNow): lastLogTime = time.monotonic()
+        for session, payload, receivedTime in writtenMessages: metrics.observe("oximeter_message_latency_seconds", time.monotonic() - receivedTime)
+        if (onMessageWritten != None):
+            for session, payload, receivedTime in writtenMessages: onMessageWritten(session, payload, receivedTime)
+
+# start the worker threads that decode and write the data, and the thread that compresses finished segments
+def startWorkers():
+    global workerQueues, workerThreads, compressionThread, segmentCompression
+    if (segmentCompression == "zstd") and (zstandard == None):
+        print(str(datetime.now()) + " The zstandard module is not installed, compressing segments with gzip instead")
+        segmentCompression = "gzip"
+    workerQueues = [queue.Queue(maxsize=writerQueueSize) for i in range(numberOfWorkers)]
+    workerThreads = [threading.Thread(target=workerLoop, args=(workerQueue,), name="oximeter-worker-" + str(i), daemon=True) for i, workerQueue in enumerate(workerQueues)]
+    for workerThread in workerThreads: workerThread.start()
+    compressionThread = threading.Thread(target=compressionLoop, name="oximeter-compression", daemon=True)
+    compressionThread.start()
+
+# let the workers write everything that is still queued, then flush and close the recording files, and wait for
+# the compression of the last segments
+def stopWorkers():
+    for workerQueue in workerQueues: workerQueue.put((None, None, None, None))
+    for workerThread in workerThreads: workerThread.join()
+    compressionQueue.put(None)
+    compressionThread.join()
+
 Connected = False   #global variable for the state of the connection
+sessions = {}       # the sessions of all devices seen so far, by device name
+workerQueues = []
+workerThreads = []
+compressionQueue = queue.Queue()    # finished segments waiting to be compressed
+compressionThread = None
+metrics = Metrics()
+onMessageWritten = None # optional callback(session, payload, receivedTime), called after a data message was written
+
+if __name__ == "__main__":
+    startWorkers()
+
+    client = mqttClient.Client("Python-Oximeter-Data-Recorder-" + os.name) # create new instance
+    client.on_connect = on_connect                              # attach function to callback
+    client.on_disconnect = on_disconnect                        # attach function to callback
+    client.on_message = on_message                              # attach function to callback
+
+    if (metricsPort > 0): startMetricsServer()
+    if (metricsTopic != ""): threading.Thread(target=publishMetricsLoop, args=(client,), name="oximeter-metrics-publisher", daemon=True).start()
 
-client = mqttClient.Client("Python-Oximeter-Data-Recorder-" + os.name) # create new instance
-client.on_connect = on_connect                              # attach function to callback
-client.on_disconnect = on_disconnect                        # attach function to callback
-client.on_message = on_message                              # attach function to callback
-
-print(str(datetime.now()) + " Connecting")
-client.connect(broker_address,port,60)                      # connect
-print(str(datetime.now()) + " Subscribing")
-client.subscribe(topicData)                                 # subscribe to data topic
-client.subscribe(topicStarttime)                            # subscribe to starttime topic
-client.subscribe(topicStatus)                               # subscribe to status topic
-client.loop_forever()                                       # then keep listening forever
\ No newline at end of file
+    print(str(datetime.now()) + " Connecting")
+    client.connect(broker_address,port,60)                      # connect
+    print(str(datetime.now()) + " Subscribing")
+    client.subscribe(topicData)                                 # subscribe to data topic
+    client.subscribe(topicStarttime)                            # subscribe to starttime topic
+    client.subscribe(topicStatus)                               # subscribe to status topic
+    try:
+        client.loop_forever()                                   # then keep listening forever
+    finally:
+        stopWorkers()
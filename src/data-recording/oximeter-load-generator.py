@@ -0,0 +1,259 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2020  Tobias Isenberg
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Load generator for oximeter-data-recording.py: simulates one or more ESP32s (or replays a recording) and
+# feeds their messages to the recorder, either by calling its on_message directly or through an MQTT broker,
+# and reports the recorder's throughput and latency.
+
+import argparse
+import bz2
+import csv
+import gzip
+import importlib.util
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime
+import numpy as np
+import paho.mqtt.client as mqttClient
+
+recordsPerSecond = 25               # BLE notifications per second, as sent by the oximeter
+secondsPerMqttMessage = 15          # as configured in ESP32-BLE-Oximeter.ino
+
+# load the recorder script as a module (its MQTT connection is only made when it runs as a script)
+def loadRecorder():
+    recorderFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oximeter-data-recording.py")
+    spec = importlib.util.spec_from_file_location("oximeterDataRecording", recorderFileName)
+    recorder = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(recorder)
+    return recorder
+
+# the start time string as posted by the ESP32, e.g., "83376 = 05.07.2020, 14:52:39"
+def formatStartTime(startTimeMs, startDateTime):
+    return str(startTimeMs) + " = " + startDateTime.strftime("%d.%m.%Y, %H:%M:%S")
+
+# synthetic data of one device: a PPG pulse wave, slowly varying BPM and SpO2 values, no readings (127) for the
+# first seconds while the oximeter settles, and occasional short dropouts; returns the start time (ms and date)
+# and the data messages as payloads
+def syntheticPayloads(recorder, durationS, seed):
+    rng = np.random.default_rng(seed)
+    numberOfRecords = int(durationS * recordsPerSecond)
+    numberOfSamples = numberOfRecords * recorder.samplesPerRecord
+    t = np.arange(numberOfSamples) / (recordsPerSecond * recorder.samplesPerRecord)
+    bpm = 65 + 8 * np.sin(2 * np.pi * t / 600 + rng.uniform(0, 2 * np.pi)) + rng.normal(0, 1, numberOfSamples).cumsum() / np.sqrt(numberOfSamples)
+    phase = 2 * np.pi * np.cumsum(bpm / 60) / (recordsPerSecond * recorder.samplesPerRecord)
+    ppg = 50 + 35 * np.sin(phase) + 10 * np.sin(2 * phase + 1)
+    spo2 = 96 + 1.5 * np.sin(2 * np.pi * t / 900) + rng.normal(0, 0.5, numberOfSamples)
+
+    values = np.stack([np.clip(ppg, 0, 100), np.clip(bpm, 30, 200), np.clip(spo2, 70, 100)], axis=1).round().astype(np.uint8)
+    noReading = t < 8
+    for dropoutStart in rng.uniform(0, durationS, int(durationS / 1800) + 1):
+        noReading |= (t >= dropoutStart) & (t < dropoutStart + rng.uniform(1, 10))
+    values[noReading, 1:] = recorder.noReadingValue
+
+    records = np.zeros(numberOfRecords, dtype=recorder.recordDtype)
+    records['ms'] = rng.integers(10000, 100000) + 40 * np.arange(numberOfRecords) + rng.integers(0, 3, numberOfRecords)
+    records['values'] = values.reshape(numberOfRecords, recorder.samplesPerRecord, 3)
+    recordsPerMessage = recordsPerSecond * secondsPerMqttMessage
+    startTimeMs = int(records['ms'][0]) - rng.integers(500, 2000)
+    return startTimeMs, datetime.now().replace(microsecond=0), [records[i:i + recordsPerMessage].tobytes() for i in range(0, numberOfRecords, recordsPerMessage)]
+
+# the data messages of an existing recording (CSV or binary), split at the buffer-end markers
+def replayPayloads(recorder, fileName):
+    with open(fileName, 'rb') as f:
+        isBinary = f.read(len(recorder.binaryMagic)) == recorder.binaryMagic
+        f.close()
+    if (isBinary):
+        fileRecords = np.fromfile(fileName, dtype=recorder.binaryRecordDtype, offset=recorder.binaryHeaderSize)
+        ms = fileRecords['ms']
+        values = fileRecords['values']
+        bufferEnds = np.flatnonzero(fileRecords['marker'] == recorder.noReadingValue) + 1
+    else:
+        with open(fileName, 'r', encoding='utf-8') as csvfile:
+            dataReader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            next(dataReader)
+            rows = np.array([[str(recorder.noReadingValue) if value == '' else value for value in row] for row in dataReader], dtype=np.int64)
+            csvfile.close()
+        rows = rows[:len(rows) - len(rows) % recorder.samplesPerRecord].reshape(-1, recorder.samplesPerRecord, 5)
+        ms = rows[:, 0, 3]
+        values = rows[:, :, 0:3]
+        bufferEnds = np.flatnonzero(rows[:, -1, 4] == recorder.noReadingValue) + 1
+    records = np.zeros(len(ms), dtype=recorder.recordDtype)
+    records['ms'] = ms
+    records['values'] = values
+    bufferStarts = np.concatenate([[0], bufferEnds])
+    if (bufferStarts[-1] < len(records)): bufferStarts = np.append(bufferStarts, len(records))
+    fileNameParts = os.path.basename(fileName).split(".")[0].split("-")
+    startDateTime = datetime.strptime(fileNameParts[-3] + fileNameParts[-2], "%Y%m%d%H%M%S")
+    return int(fileNameParts[-1]), startDateTime, [records[start:end].tobytes() for start, end in zip(bufferStarts[:-1], bufferStarts[1:])]
+
+# the number of samples in the recorded files (all segments, compressed or not) and in the per-second buckets of the
+# summary files, to check that every sample that was sent has been written exactly once
+def recordedSamples(recorder, directory):
+    openers = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open, "": open}
+    if (recorder.zstandard != None): openers[".zst"] = lambda fileName, mode: recorder.zstandard.ZstdDecompressor().stream_reader(open(fileName, mode))
+    samples = 0
+    summarySamples = 0
+    for fileName in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(fileName)
+        if (extension not in openers): name, extension = fileName, ""
+        if (name.endswith(".summary.csv")):
+            with open(os.path.join(directory, fileName), 'r') as f:
+                summarySamples += sum(int(line.split(",")[2]) for line in f.readlines()[1:] if (line.split(",")[0] == "1"))
+                f.close()
+        elif (name.endswith(recorder.binaryFileExtension)):
+            with openers[extension](os.path.join(directory, fileName), 'rb') as f:
+                samples += (len(f.read()) - recorder.binaryHeaderSize) // recorder.binaryRecordDtype.itemsize * recorder.samplesPerRecord
+                f.close()
+        elif (name.endswith(".csv")) and (not name.endswith(".index.csv")):
+            with openers[extension](os.path.join(directory, fileName), 'rb') as f:
+                samples += f.read().count(b"\n") - 1
+                f.close()
+    return samples, summarySamples
+
+def percentile(values, p):
+    if (len(values) == 0): return float('nan')
+    return float(np.percentile(values, p))
+
+parser = argparse.ArgumentParser(description="Simulate ESP32 oximeters (or replay a recording) to measure the throughput and latency of oximeter-data-recording.py.")
+parser.add_argument("--devices", type=int, default=1, help="number of simulated devices (default: 1)")
+parser.add_argument("--duration", type=float, default=60, help="minutes of synthetic data per device (default: 60)")
+parser.add_argument("--replay", metavar="FILE", help="replay this recording (CSV or binary) on every device instead of synthetic data")
+parser.add_argument("--speed", type=float, default=0, help="playback speed as a multiple of real time, 0 for as fast as possible (default: 0)")
+parser.add_argument("--broker", metavar="HOST[:PORT]", help="publish through this MQTT broker to an in-process recorder instead of calling on_message directly")
+parser.add_argument("--format", choices=["csv", "binary"], default="csv", help="recording format of the recorder (default: csv)")
+parser.add_argument("--workers", type=int, help="number of recorder worker threads (default: the recorder's setting)")
+parser.add_argument("--late", type=float, default=1000, help="count messages as late when they are written more than this many ms after sending (default: 1000)")
+parser.add_argument("--status", action="store_true", help="also send the status messages the ESP32 posts after each buffer")
+parser.add_argument("--runts", type=int, default=0, metavar="N",
+    help="also send a truncated data message (shorter than one record) after every N data messages, which the recorder has to skip without losing the messages around it (default: 0 for none)")
+parser.add_argument("--output", metavar="DIR", help="keep the recorded files in this directory (default: a temporary directory that is removed afterwards)")
+args = parser.parse_args()
+
+recorder = loadRecorder()
+recorder.recordingFormat = args.format
+if (args.workers != None): recorder.numberOfWorkers = args.workers
+outputDirectory = args.output if (args.output != None) else tempfile.mkdtemp(prefix="oximeter-load-")
+os.makedirs(outputDirectory, exist_ok=True)
+recorder.filenameLocationDirectory = os.path.join(outputDirectory, "")
+
+# prepare the messages of all devices, ordered by the time at which the ESP32 would send them
+messages = [] # (due time in s, topic, payload)
+for device in range(args.devices):
+    deviceId = "oximeter" if (args.devices == 1) else "load" + str(device)
+    if (args.replay != None): startTimeMs, startDateTime, payloads = replayPayloads(recorder, args.replay)
+    else: startTimeMs, startDateTime, payloads = syntheticPayloads(recorder, args.duration * 60, device)
+    offset = device * secondsPerMqttMessage / args.devices # spread the devices over the buffer interval
+    messages.append((offset, "sensors/" + deviceId + "/starttime", formatStartTime(startTimeMs, startDateTime).encode('utf-8')))
+    for i, payload in enumerate(payloads):
+        messages.append((offset + (i + 1) * secondsPerMqttMessage, "sensors/" + deviceId + "/data", payload))
+        if (args.runts > 0) and ((i + 1) % args.runts == 0): messages.append((offset + (i + 1) * secondsPerMqttMessage, "sensors/" + deviceId + "/data", payload[:3]))
+        if (args.status): messages.append((offset + (i + 1) * secondsPerMqttMessage, "sensors/" + deviceId + "/status", ("posted to buffer " + str(i % 4)).encode('utf-8')))
+messages.sort(key=lambda message: message[0])
+# truncated messages contain no record, so the recorder writes nothing for them
+numberOfDataMessages = sum(1 for message in messages if (message[1].endswith("/data")) and (len(message[2]) >= recorder.recordDtype.itemsize))
+numberOfSamples = sum(len(message[2]) // recorder.recordDtype.itemsize * recorder.samplesPerRecord for message in messages if message[1].endswith("/data"))
+print("Prepared " + str(numberOfDataMessages) + " data messages (" + "{:,}".format(sum(len(message[2]) for message in messages if message[1].endswith("/data"))) +
+    " bytes) from " + str(args.devices) + " device(s)")
+
+# measure the time from sending a data message until the recorder has written (and possibly flushed) it
+sendTimes = {}
+latencies = []
+writtenBytes = [0]
+latencyLock = threading.Lock()
+def onMessageWritten(session, payload, receivedTime):
+    now = time.monotonic()
+    with latencyLock:
+        sendTime = sendTimes.pop((session.deviceId, bytes(payload[:16])), receivedTime)
+        latencies.append(now - sendTime)
+        writtenBytes[0] += len(payload)
+recorder.onMessageWritten = onMessageWritten
+recorder.startWorkers()
+
+if (args.broker != None):
+    brokerHost = args.broker.split(":")[0]
+    brokerPort = int(args.broker.split(":")[1]) if (":" in args.broker) else 1883
+    recorderClient = mqttClient.Client("Python-Oximeter-Load-Recorder-" + str(os.getpid()))
+    recorderClient.on_message = recorder.on_message
+    recorderClient.connect(brokerHost, brokerPort, 60)
+    for topic in [recorder.topicData, recorder.topicStarttime, recorder.topicStatus]: recorderClient.subscribe(topic, qos=1)
+    recorderClient.loop_start()
+    publisherClient = mqttClient.Client("Python-Oximeter-Load-Generator-" + str(os.getpid()))
+    publisherClient.connect(brokerHost, brokerPort, 60)
+    publisherClient.loop_start()
+    time.sleep(1) # let the subscriptions settle
+    def send(topic, payload):
+        publisherClient.publish(topic, payload, qos=1)
+else:
+    def send(topic, payload):
+        recorder.on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+
+sendBehind = 0
+startTime = time.monotonic()
+for dueTime, topic, payload in messages:
+    if (args.speed > 0):
+        delay = startTime + dueTime / args.speed - time.monotonic()
+        if (delay > 0): time.sleep(delay)
+        elif (delay < -args.late / 1000): sendBehind += 1
+    else:
+        # as fast as possible means as fast as the recorder's workers keep up, not faster than their queues can hold
+        while (max(workerQueue.qsize() for workerQueue in recorder.workerQueues) >= recorder.writerQueueSize - 1): time.sleep(0.001)
+    if (topic.endswith("/data")) and (len(payload) >= recorder.recordDtype.itemsize):
+        with latencyLock:
+            sendTimes[(recorder.deviceIdFromTopic(topic), bytes(payload[:16]))] = time.monotonic()
+    send(topic, payload)
+sendingDoneTime = time.monotonic()
+
+# wait until everything that was sent has been written, or nothing happens for a while
+lastProgress = (time.monotonic(), -1)
+while (len(latencies) + sum(session.droppedMessages for session in recorder.sessions.values()) < numberOfDataMessages):
+    if (len(latencies) != lastProgress[1]): lastProgress = (time.monotonic(), len(latencies))
+    elif (time.monotonic() - lastProgress[0] > 10): break
+    time.sleep(0.01)
+endTime = time.monotonic()
+if (args.broker != None):
+    recorderClient.loop_stop()
+    publisherClient.loop_stop()
+recorder.stopWorkers()
+
+elapsed = endTime - startTime
+droppedMessages = sum(session.droppedMessages for session in recorder.sessions.values())
+latenciesMs = np.array(latencies) * 1000
+print("")
+print("devices:                    " + str(args.devices) + (" (replaying " + args.replay + ")" if (args.replay != None) else " (synthetic, " + str(args.duration) + " min each)"))
+print("mode:                       " + ("MQTT broker " + args.broker if (args.broker != None) else "direct on_message calls") +
+    ", " + (str(args.speed) + "x real time" if (args.speed > 0) else "as fast as possible") + ", " + args.format + ", " + str(recorder.numberOfWorkers) + " worker(s)")
+print("elapsed:                    " + "{:.2f}".format(elapsed) + "s (sending " + "{:.2f}".format(sendingDoneTime - startTime) + "s)")
+print("data messages written:      " + str(len(latencies)) + "/" + str(numberOfDataMessages))
+print("messages per second:        " + "{:,.1f}".format(len(latencies) / elapsed))
+print("bytes per second:           " + "{:,.0f}".format(writtenBytes[0] / elapsed))
+if (args.speed == 0): print("real-time capacity:         " + "{:,.0f}".format(len(latencies) * secondsPerMqttMessage / elapsed) + " devices (at one data message per " + str(secondsPerMqttMessage) + "s each)")
+print("latency (ms) p50/p90/p99/max: " + "/".join("{:.2f}".format(percentile(latenciesMs, p)) for p in [50, 90, 99, 100]))
+print("dropped messages:           " + str(droppedMessages) + " (writer queue full), " + str(numberOfDataMessages - len(latencies) - droppedMessages) + " not written")
+print("late messages (> " + str(args.late) + " ms): " + str(int(np.sum(latenciesMs > args.late))) + " written late, " + str(sendBehind) + " sent behind schedule")
+samples, summarySamples = recordedSamples(recorder, outputDirectory)
+print("samples written:            " + str(samples) + "/" + str(numberOfSamples) + " to the recordings, " + str(summarySamples) + " to the summaries" +
+    ("" if (args.runts == 0) else " (with a truncated message after every " + str(args.runts) + " data messages)"))
+
+if (args.output == None): shutil.rmtree(outputDirectory)
+if (droppedMessages == 0) and ((samples != numberOfSamples) or ((len(recorder.summaryResolutionsS) > 0) and (1 in recorder.summaryResolutionsS) and (summarySamples != numberOfSamples))):
+    sys.exit("The recorded samples do not match the samples that were sent")
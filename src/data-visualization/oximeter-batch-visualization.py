@@ -0,0 +1,199 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2020  Tobias Isenberg
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Batch visualization for oximeter-data-visualization.py: finds all recordings in a directory (tree), groups them into
+# sessions, creates the report of every session that is new or has changed (several at a time), and keeps the numbers
+# of each night in an SQLite index, so that trends over many nights can be looked at without reading the recordings.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+
+visualizerFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oximeter-data-visualization.py")
+
+# the recording files, these have to match the ones written by oximeter-data-recording.py: <device>-YYYYMMDD-HHMMSS-ms
+# followed by an optional segment number, the format, and an optional compression (the index, summary, and pyramid
+# files next to a recording are not data)
+recordingNamePattern = re.compile(r"^(.+)-(\d{8})-(\d{6})-(\d+)$")
+recordingFileExtensions = [".csv", ".oxb"]
+compressedFileExtensions = [".gz", ".bz2", ".xz", ".zst"]
+# the recordings of one session come from one run of the ESP32: the same device and the same ms timestamp basis, i.e.,
+# the wall-clock time in the filename minus the ms timestamp (the boot time of the ESP32) agrees within this tolerance
+sessionToleranceS = 60
+
+# the index: one row per night (session) and report
+indexColumns = ["report", "device", "start", "end", "duration_s", "samples", "samples_per_second", "spo2_min", "spo2_max", "spo2_mean",
+    "bpm_min", "bpm_max", "bpm_mean", "ppg_min", "ppg_max", "gap_s", "interruptions", "files", "source", "updated"]
+indexSchema = """create table if not exists nights (report text primary key, device text, start text, end text, duration_s real, samples integer,
+    samples_per_second real, spo2_min integer, spo2_max integer, spo2_mean real, bpm_min integer, bpm_max integer, bpm_mean real,
+    ppg_min integer, ppg_max integer, gap_s real, interruptions integer, files text, source text, updated text)"""
+# the keys of the visualizer's --summary file for the columns of the index
+summaryKeys = {"start": "start", "end": "end", "duration_s": "durationS", "samples": "samples", "samples_per_second": "samplesPerSecond",
+    "spo2_min": "spo2Min", "spo2_max": "spo2Max", "spo2_mean": "spo2Mean", "bpm_min": "bpmMin", "bpm_max": "bpmMax", "bpm_mean": "bpmMean",
+    "ppg_min": "ppgMin", "ppg_max": "ppgMax", "gap_s": "gapS", "interruptions": "interruptions"}
+
+# whether a file is (a segment of) a recording
+def isRecordingFile(fileName):
+    nameParts = os.path.basename(fileName).split(".")[1:]
+    if (len(nameParts) > 0) and ("." + nameParts[-1] in compressedFileExtensions): nameParts = nameParts[:-1]
+    if (len(nameParts) == 0) or ("." + nameParts[-1] not in recordingFileExtensions): return False
+    return (len(nameParts) == 1) or ((len(nameParts) == 2) and (nameParts[0].isdigit()))
+
+# all recordings in the directory tree, as a dict of the recordings' names (with directory, without extension) and
+# their files
+def findRecordings(directory):
+    recordings = {}
+    for directoryName, directoryNames, fileNames in os.walk(directory):
+        directoryNames.sort()
+        for fileName in sorted(fileNames):
+            if (not isRecordingFile(fileName)) or (recordingNamePattern.match(fileName.split(".")[0]) == None): continue
+            recordings.setdefault(os.path.join(directoryName, fileName.split(".")[0]), []).append(os.path.join(directoryName, fileName))
+    return recordings
+
+# the device, the start time, and the ESP32 ms timestamp of a recording, from its name
+def recordingStart(baseName):
+    match = recordingNamePattern.match(os.path.basename(baseName))
+    return match.group(1), datetime.strptime(match.group(2) + match.group(3), "%Y%m%d%H%M%S"), int(match.group(4))
+
+# group the recordings into sessions: a recording continues the previous session of the same device in the same
+# directory if the ESP32 was not restarted in between (the same boot time and a later ms timestamp)
+def findSessions(recordings):
+    sessions = []
+    latestSessions = {}
+    for baseName in sorted(recordings, key=lambda baseName: recordingStart(baseName)[1]):
+        device, startDateTime, startMs = recordingStart(baseName)
+        bootDateTime = startDateTime - timedelta(milliseconds=startMs)
+        session = latestSessions.get((os.path.dirname(baseName), device))
+        if (session != None) and (abs((bootDateTime - session["boot"]).total_seconds()) <= sessionToleranceS) and (startMs > session["ms"]):
+            session["recordings"].append(baseName)
+            session["ms"] = startMs
+            continue
+        session = dict(device=device, boot=bootDateTime, ms=startMs, recordings=[baseName])
+        latestSessions[(os.path.dirname(baseName), device)] = session
+        sessions.append(session)
+    return sessions
+
+# the file that stands for a recording on the visualizer's command line: a file of a recording that is not split
+# (the binary file if it was also converted), otherwise any of its segments (the visualizer finds the others)
+def recordingArgument(fileNames):
+    return sorted(fileNames, key=lambda fileName: (os.path.basename(fileName).count("."), not fileName.endswith(".oxb")))[0]
+
+# the source key of a session, as for the visualizer's pyramid cache: the names, sizes, and modification times of all
+# files of its recordings
+def sessionSourceKey(fileNames):
+    return "|".join([os.path.basename(fileName) + ":" + str(os.stat(fileName).st_size) + ":" + str(os.stat(fileName).st_mtime_ns) for fileName in fileNames])
+
+# create the report of one session and return the visualizer's output and its summary (None if it failed)
+def visualizeSession(session):
+    summaryFile, summaryFileName = tempfile.mkstemp(suffix=".json")
+    os.close(summaryFile)
+    try:
+        command = [sys.executable, visualizerFileName, args.description, *session["arguments"], "--backend", args.backend, "--summary", summaryFileName]
+        if (args.stream): command.append("--stream")
+        output = subprocess.run(command, capture_output=True, text=True)
+        summary = None
+        if (output.returncode == 0) and (os.path.exists(session["report"])) and (os.path.getsize(summaryFileName) > 0):
+            with open(summaryFileName, 'r', encoding='utf-8') as f:
+                summary = json.load(f)
+                f.close()
+        return output.stdout + output.stderr, summary
+    finally:
+        os.remove(summaryFileName)
+
+# a number of the index in a column of the list, "-" for a night without it (e.g., without any SpO2 or BPM readings)
+def listValue(value, width, valueFormat):
+    return "{:>{}}".format("-" if (value == None) else valueFormat.format(value), width)
+
+def listNights(index):
+    print("report                                            start                  hours  samples/s  SpO2 min  mean  BPM min  mean  max  gaps (min)")
+    for row in index.execute("select report, start, duration_s, samples_per_second, spo2_min, spo2_mean, bpm_min, bpm_mean, bpm_max, gap_s from nights order by start"):
+        report, start, durationS, samplesPerSecond, spo2Min, spo2Mean, bpmMin, bpmMean, bpmMax, gapS = row
+        print("{:<50}{:<21}".format(os.path.relpath(report, args.directory)[-49:], start[:19]) + listValue(None if (durationS == None) else durationS / 3600, 7, "{:.2f}") +
+            listValue(samplesPerSecond, 11, "{:.1f}") + listValue(spo2Min, 10, "{}") + listValue(spo2Mean, 6, "{:.1f}") + listValue(bpmMin, 9, "{}") +
+            listValue(bpmMean, 6, "{:.1f}") + listValue(bpmMax, 5, "{}") + listValue(None if (gapS == None) else gapS / 60, 12, "{:.1f}"))
+
+parser = argparse.ArgumentParser(
+    description="Create the reports of all recording sessions in a directory (tree) with oximeter-data-visualization.py and keep the numbers of each night in an SQLite index.",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog="examples:\n" +
+        "  " + os.path.basename(__file__) + " \"nightly\" recordings\n" +
+        "  " + os.path.basename(__file__) + " --jobs 4 --stream \"nightly\" recordings\n" +
+        "  " + os.path.basename(__file__) + " --list \"nightly\" recordings")
+parser.add_argument("description", help="name extension for the reports, also used in their filenames (as for oximeter-data-visualization.py)")
+parser.add_argument("directory", help="directory with the recordings, including its subdirectories")
+parser.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 1) // 2), metavar="N", help="visualize up to N sessions at the same time (default: %(default)s)")
+parser.add_argument("--index", metavar="FILE", help="the SQLite index of the nights (default: oximeter-index.sqlite in the directory)")
+parser.add_argument("--backend", choices=["plotly", "matplotlib"], default="matplotlib", help="rendering backend of the visualizer (default: %(default)s)")
+parser.add_argument("--stream", action="store_true", help="use the visualizer's constant-memory mode (for multi-day recordings)")
+parser.add_argument("--list", action="store_true", help="only list the nights in the index, without looking for new recordings")
+args = parser.parse_args()
+
+if (not os.path.isdir(args.directory)):
+    sys.exit("Cannot find the directory " + args.directory)
+index = sqlite3.connect(args.index if (args.index != None) else os.path.join(args.directory, "oximeter-index.sqlite"))
+index.execute(indexSchema)
+if (args.list):
+    listNights(index)
+    sys.exit()
+
+recordings = findRecordings(args.directory)
+sessions = findSessions(recordings)
+print("found " + str(len(recordings)) + " recordings in " + str(len(sessions)) + " sessions")
+
+# the sessions whose report is missing or older than their recordings
+sessionsToVisualize = []
+for session in sessions:
+    fileNames = [fileName for baseName in session["recordings"] for fileName in recordings[baseName]]
+    session["arguments"] = [recordingArgument(recordings[baseName]) for baseName in session["recordings"]]
+    session["report"] = session["recordings"][0] + "-" + args.description + ".pdf"
+    session["files"] = " ".join([os.path.basename(fileName) for fileName in session["arguments"]])
+    session["source"] = sessionSourceKey(fileNames)
+    row = index.execute("select source from nights where report = ?", (session["report"],)).fetchone()
+    if (os.path.exists(session["report"])) and (row != None) and (row[0] == session["source"]): continue
+    sessionsToVisualize.append(session)
+print(str(len(sessions) - len(sessionsToVisualize)) + " reports are up to date, creating " + str(len(sessionsToVisualize)) + " with " + str(args.jobs) + " jobs")
+
+# the visualizer runs in its own process per session, the index is only written here
+startTime = time.perf_counter()
+failed = 0
+with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+    futures = {executor.submit(visualizeSession, session): session for session in sessionsToVisualize}
+    for future in concurrent.futures.as_completed(futures):
+        session = futures[future]
+        output, summary = future.result()
+        if (summary == None):
+            print(output)
+            print("visualizing " + session["files"] + " failed")
+            failed += 1
+            continue
+        row = dict(report=session["report"], device=session["device"], files=session["files"], source=session["source"], updated=datetime.now().isoformat(sep=" ", timespec="seconds"))
+        row.update({column: summary[key] for column, key in summaryKeys.items()})
+        index.execute("insert or replace into nights (" + ", ".join(indexColumns) + ") values (" + ", ".join(["?"] * len(indexColumns)) + ")", [row[column] for column in indexColumns])
+        index.commit()
+        print("wrote " + session["report"])
+index.close()
+print("visualized " + str(len(sessionsToVisualize) - failed) + " sessions in " + "{:.1f}".format(time.perf_counter() - startTime) + "s" + ("" if (failed == 0) else ", " + str(failed) + " failed"))
+if (failed > 0): sys.exit(1)
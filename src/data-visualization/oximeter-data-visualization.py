@@ -22,28 +22,1363 @@ from datetime import timedelta
 import io
 from plotly.offline import iplot, init_notebook_mode
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
 import pandas as pd
 import numpy as np
 import plotly.offline as py
 import plotly.graph_objs as go
 import plotly.io as pio
+import plotly
 from PyPDF2 import PdfFileMerger
+import argparse
+import bisect
+import bz2
+import cProfile
+import glob
+import gzip
+import functools
+import hashlib
+import http.server
+import importlib.metadata
+import itertools
+import json
+import lzma
+import multiprocessing
+import pstats
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
 import os
+try:
+    import zstandard # optional, only needed for zstd-compressed segments
+except ImportError:
+    zstandard = None
+try:
+    import scipy.signal # optional, for the band-pass filter and peak detection of the beat analysis (--beats)
+except ImportError:
+    scipy = None
 
-if (len(sys.argv) < 2):
-    print("Too few arguments. Please call script with a name and one or more data files. Examples:")
-    print(os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.csv")
-    print(os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.csv oximeter-20200706-003426-481146.csv")
-    sys.exit()
+parser = argparse.ArgumentParser(
+    description="Visualize one or more oximeter data files from a single recording session as graphs in a PDF.",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog="examples:\n" +
+        "  " + os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.csv oximeter-20200706-003426-481146.csv\n" +
+        "  " + os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.oxb\n" +
+        "  " + os.path.basename(__file__) + " \"Some description\" oximeter-20200706-002654-29871.0001.csv.gz\n" +
+        "  " + os.path.basename(__file__) + " --from 03:10 --to 03:20 \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --jobs 8 \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --sections 60:averaged,5:range,0.5:samples \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --stream \"Some description\" oximeter-20200710-221502-8155.oxb\n" +
+        "  " + os.path.basename(__file__) + " --events events.csv \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --beats beats.csv \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --profile profile.json --profile-format chrome \"Some description\" oximeter-20200706-002654-29871.csv\n" +
+        "  " + os.path.basename(__file__) + " --serve 8050 \"Some description\" oximeter-20200706-002654-29871.csv")
+parser.add_argument("description", help="name extension for the report, also used in its filename")
+parser.add_argument("files", nargs="+", help="data files (CSV or binary, possibly compressed) of the session, in any order; one segment of a recording stands for all of its segments")
+parser.add_argument("--from", dest="fromTime", metavar="TIME", help="only visualize data from this time on: a wall-clock time (\"15:04\", \"15:04:30\", \"2020-07-05 15:04\") or an ESP32 ms timestamp")
+parser.add_argument("--to", dest="toTime", metavar="TIME", help="only visualize data up to this time (same formats as --from)")
+parser.add_argument("--jobs", type=int, default=1, metavar="N", help="render the pages of the report in N worker processes (not on Windows, plotly backend only)")
+parser.add_argument("--backend", choices=["plotly", "matplotlib"], default="plotly", help="render the pages with Plotly's image export (default) or write them directly with matplotlib, which is much faster")
+parser.add_argument("--sections", default="60:averaged,10:range,1:samples", metavar="LIST",
+    help="the sections of graphs in the report, as a comma-separated list of minutes per graph and kind of graph: averaged (moving average of SpO2 and BPM), range (range of the SpO2 and BPM values), or samples (all PPG, SpO2, and BPM samples) (default: %(default)s)")
+parser.add_argument("--cache", metavar="DIR", default=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "oximeter-data-visualization"),
+    help="keep the rendered pages in this directory, so that re-runs only render the pages that changed (plotly backend only; default: %(default)s)")
+parser.add_argument("--cache-size", dest="cacheSizeMB", type=float, default=500, metavar="MB", help="size limit of the page cache, 0 to not use the cache (default: %(default)s)")
+parser.add_argument("--smoothing", default="mean:2", metavar="FILTER:SECONDS",
+    help="the smoothing of the averaged graphs: mean (moving average), median (moving median), or ema (exponential moving average) and its window in seconds (default: %(default)s)")
+parser.add_argument("--stream", action="store_true",
+    help="constant-memory mode for long (multi-day) recordings: the statistics come from the summary pyramids, the samples are read in chunks, and each page is written into the report as soon as it is drawn (with matplotlib)")
+parser.add_argument("--serve", type=int, metavar="PORT",
+    help="instead of writing a PDF, serve an interactive report on http://localhost:PORT/, in which the whole session can be zoomed down to the single samples")
+parser.add_argument("--events", metavar="FILE",
+    help="detect desaturations and episodes of bradycardia and tachycardia, write them to FILE (as CSV, or as JSON if FILE ends in .json), add their numbers to the summary, and only draw the detailed graphs around them")
+parser.add_argument("--beats", metavar="FILE",
+    help="detect the beats in the PPG waveform, write the heart rate, its variability, and the signal quality per 5 minutes to FILE (as CSV, or as JSON if FILE ends in .json), and add them to the summary")
+parser.add_argument("--profile", metavar="FILE",
+    help="measure the time and memory of each stage of the visualization and of each page, show the estimated time left while the pages are created, print a breakdown per stage at the end, and write all measurements to FILE (as JSON)")
+parser.add_argument("--profile-format", dest="profileFormat", choices=["json", "chrome"], default="json",
+    help="write the measurements of --profile as plain JSON or in the trace event format of Chrome's about:tracing and Perfetto (default: %(default)s)")
+parser.add_argument("--profile-page", dest="profilePage", type=int, metavar="N",
+    help="profile the preparation and the rendering of page N of the report with cProfile, print the functions that took the most time, and write the profile next to the report")
+parser.add_argument("--summary", metavar="FILE", help="also write the numbers of the summary page and the total length of the interruptions to FILE (as JSON)")
+args = parser.parse_args()
+
+# binary recording format (see oximeter-data-recording.py): a 64 byte header followed by one record per BLE
+# notification with a big-endian ms timestamp, 4 samples of PPG, BPM, and SpO2, and the buffer-end marker
+binaryFileExtension = ".oxb"
+binaryMagic = b"OXIVIS01"
+binaryHeaderSize = 64
+samplesPerRecord = 4
+binaryRecordDtype = np.dtype([('ms', '>u4'), ('values', 'u1', (samplesPerRecord, 3)), ('marker', 'u1')])
+dataHeaders = ["PPG", "BPM", "SPO2", "MS-timestamp", "buffer-end-marker"]
+interruptionMs = 1000 # timestamps further apart than this mark an interruption of the recording (normally 40 ms)
+# the samples are kept in typed columns: nullable bytes for the values (missing BPM and SpO2 values, and all values
+# in the interruptions between files, are <NA>), and nullable 64 bit ints for the timestamps
+dataTypes = {"PPG": "UInt8", "BPM": "UInt8", "SPO2": "UInt8", "MS-timestamp": "Int64", "buffer-end-marker": "UInt8"}
+recordingFileExtensions = [".csv", binaryFileExtension]
+compressedFileExtensions = [".gz", ".bz2", ".xz", ".zst"]
+
+def isCompressedFile(fileName):
+    return os.path.splitext(fileName)[1] in compressedFileExtensions
+
+# open a data file for reading; compressed segments are decompressed as a stream while reading
+def openDataFile(fileName):
+    extension = os.path.splitext(fileName)[1]
+    if (extension == ".gz"): return gzip.open(fileName, 'rb')
+    if (extension == ".bz2"): return bz2.open(fileName, 'rb')
+    if (extension == ".xz"): return lzma.open(fileName, 'rb')
+    if (extension == ".zst"):
+        if (zstandard == None):
+            print("Reading " + fileName + " requires the zstandard module (pip3 install zstandard)")
+            sys.exit()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fileName, 'rb')))
+    return open(fileName, 'rb')
+
+# the records of a binary recording, through a memory map or, for compressed segments, decompressed into memory
+def readBinaryRecords(fileName):
+    if (isCompressedFile(fileName)):
+        with openDataFile(fileName) as f:
+            f.read(binaryHeaderSize)
+            data = f.read()
+            f.close()
+        return np.frombuffer(data, dtype=binaryRecordDtype, count=len(data) // binaryRecordDtype.itemsize)
+    if (os.path.getsize(fileName) <= binaryHeaderSize): return np.zeros(0, dtype=binaryRecordDtype)
+    return np.memmap(fileName, dtype=binaryRecordDtype, mode='r', offset=binaryHeaderSize)
+
+# the records of a binary recording in chunks of up to chunkRecords records, for the streaming mode; the file is read
+# (and decompressed) as a stream rather than memory-mapped, so that the records of earlier chunks do not stay in memory
+def readBinaryRecordChunks(fileName, chunkRecords):
+    with openDataFile(fileName) as f:
+        f.read(binaryHeaderSize)
+        data = f.read(chunkRecords * binaryRecordDtype.itemsize)
+        while (len(data) >= binaryRecordDtype.itemsize):
+            yield np.frombuffer(data, dtype=binaryRecordDtype, count=len(data) // binaryRecordDtype.itemsize)
+            data = f.read(chunkRecords * binaryRecordDtype.itemsize)
+        f.close()
+
+# the samples of binary records as a data frame, with <NA> for missing BPM and SpO2 values
+def binaryData(records):
+    values = records['values'].reshape(-1, 3)
+    noReading = values[:, 2] == 127
+    marker = np.zeros((len(records), samplesPerRecord), dtype=np.uint8)
+    marker[:, -1] = records['marker']
+    return pd.DataFrame({
+        "PPG": pd.array(values[:, 0], dtype="UInt8"),
+        "BPM": pd.arrays.IntegerArray(values[:, 1].copy(), noReading),
+        "SPO2": pd.arrays.IntegerArray(values[:, 2].copy(), noReading.copy()),
+        "MS-timestamp": pd.array(np.repeat(records['ms'], samplesPerRecord).astype(np.int64), dtype="Int64"),
+        "buffer-end-marker": pd.array(marker.ravel(), dtype="UInt8"),
+    })
+
+# read a binary recording into a data frame; the records are sorted by their timestamps, so time limits are found by
+# bisection
+def readBinaryData(fileName, fromMs = None, toMs = None):
+    records = readBinaryRecords(fileName)
+    if (fromMs != None): records = records[np.searchsorted(records['ms'], fromMs, side='left'):]
+    if (toMs != None): records = records[:np.searchsorted(records['ms'], toMs, side='right')]
+    return binaryData(records)
+
+# the start time of a data file, as the date and time and the ESP32 ms timestamp in its name (the filename starts
+# with the device name, which may itself contain dashes, so count from the end)
+def fileStartTime(fileName):
+    fileNameParts = os.path.basename(fileName).split(".")[0].split("-")
+    return datetime.strptime(fileNameParts[-3] + fileNameParts[-2], "%Y%m%d%H%M%S"), int(fileNameParts[-1])
+
+# convert a --from/--to argument into the ms timestamp basis of a data file; wall-clock times without a date refer
+# to the first such time after the start of the file (for a session, its earliest file, see below)
+def parseTimeLimit(value, fileName):
+    if (value == None): return None
+    if (value.isdigit()): return int(value)
+    fileStartDateTime, fileStartMs = fileStartTime(fileName)
+    limitDateTime = None
+    for timeFormat in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y/%m/%d %H:%M:%S", "%Y/%m/%d %H:%M"]:
+        try:
+            limitDateTime = datetime.strptime(value, timeFormat)
+        except ValueError:
+            pass
+    for timeFormat in ["%H:%M:%S", "%H:%M"]:
+        try:
+            limitDateTime = datetime.combine(fileStartDateTime.date(), datetime.strptime(value, timeFormat).time())
+            if (limitDateTime < fileStartDateTime): limitDateTime += timedelta(days=1)
+        except ValueError:
+            pass
+    if (limitDateTime == None):
+        print("Cannot interpret time " + value)
+        sys.exit()
+    return fileStartMs + round((limitDateTime - fileStartDateTime).total_seconds() * 1000)
+
+# the index written next to a CSV recording: the first ms timestamp of each data buffer and its byte offset in the
+# (uncompressed) file
+def indexFileName(fileName):
+    if (isCompressedFile(fileName)): fileName = os.path.splitext(fileName)[0]
+    return os.path.splitext(fileName)[0] + ".index.csv"
+
+def readIndexFile(fileName):
+    if (not os.path.exists(indexFileName(fileName))): return None
+    timestamps = []
+    offsets = []
+    with open(indexFileName(fileName), 'r', encoding='utf-8') as csvfile:
+        dataReader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        next(dataReader) # skip the headers
+        for row in dataReader:
+            timestamps.append(int(row[0]))
+            offsets.append(int(row[1]))
+        csvfile.close()
+    return timestamps, offsets
+
+# read a CSV recording into a data frame, with <NA> for empty values; with time limits and an index, only the byte
+# range of the data buffers that overlap the limits is read
+def readCsvData(fileName, fromMs = None, toMs = None):
+    index = None
+    if (fromMs != None) or (toMs != None): index = readIndexFile(fileName)
+    with openDataFile(fileName) as csvfile:
+        headerLength = len(csvfile.readline())
+        if (index == None):
+            data = csvfile.read()
+        else:
+            timestamps, offsets = index
+            startOffset = headerLength
+            endOffset = None
+            if (fromMs != None): startOffset = offsets[max(bisect.bisect_right(timestamps, fromMs) - 1, 0)]
+            if (toMs != None) and (bisect.bisect_right(timestamps, toMs) < len(offsets)): endOffset = offsets[bisect.bisect_right(timestamps, toMs)]
+            csvfile.seek(startOffset)
+            data = csvfile.read() if (endOffset == None) else csvfile.read(max(endOffset - startOffset, 0))
+        csvfile.close()
+    if (len(data.strip()) == 0): return emptyData(0)
+    values = pd.read_csv(io.BytesIO(data), header=None, names=dataHeaders, dtype=np.float64).to_numpy()
+    if (fromMs != None): values = values[values[:, 3] >= fromMs]
+    if (toMs != None): values = values[values[:, 3] <= toMs]
+    return csvData(values)
+
+# the samples of CSV rows as a data frame, with <NA> for empty values; parsing into floats (with NaN for empty values)
+# and then masking is much faster than parsing into nullable ints
+def csvData(values):
+    missing = np.isnan(values)
+    return pd.DataFrame({key: pd.arrays.IntegerArray(np.where(missing[:, i], 0, values[:, i]).astype(dataType.lower()), missing[:, i].copy())
+        for i, (key, dataType) in enumerate(dataTypes.items())})
+
+def isBinaryDataFile(fileName):
+    with openDataFile(fileName) as f:
+        magic = f.read(len(binaryMagic))
+        f.close()
+    return magic == binaryMagic
+
+def readData(fileName, fromMs = None, toMs = None):
+    if (isBinaryDataFile(fileName)): return readBinaryData(fileName, fromMs, toMs)
+    return readCsvData(fileName, fromMs, toMs)
+
+# read a data file like readData, but in chunks of at most streamChunkSamples samples, for the streaming mode; a CSV
+# file is parsed as a stream, starting at the data buffer of the --from limit if it has an index
+streamChunkSamples = 1 << 19 # about 90 minutes of data, a multiple of the samples per record
+
+def readDataChunks(fileName, fromMs = None, toMs = None):
+    if (isBinaryDataFile(fileName)):
+        for records in readBinaryRecordChunks(fileName, streamChunkSamples // samplesPerRecord):
+            if (toMs != None) and (records['ms'][0] > toMs): break
+            if (fromMs != None): records = records[np.searchsorted(records['ms'], fromMs, side='left'):]
+            if (toMs != None): records = records[:np.searchsorted(records['ms'], toMs, side='right')]
+            if (len(records) > 0): yield binaryData(records)
+        return
+    index = readIndexFile(fileName) if (fromMs != None) else None
+    with openDataFile(fileName) as csvfile:
+        csvfile.readline() # skip the headers
+        if (index != None): csvfile.seek(index[1][max(bisect.bisect_right(index[0], fromMs) - 1, 0)])
+        for chunk in pd.read_csv(csvfile, header=None, names=dataHeaders, dtype=np.float64, chunksize=streamChunkSamples):
+            values = chunk.to_numpy()
+            if (toMs != None) and (values[0, 3] > toMs): break
+            if (fromMs != None): values = values[values[:, 3] >= fromMs]
+            if (toMs != None): values = values[values[:, 3] <= toMs]
+            if (len(values) > 0): yield csvData(values)
+        csvfile.close()
+
+# the recorder can split a recording into numbered segments (oximeter-20200705-143412-15586.0001.csv, ...), which
+# are compressed once they are finished (oximeter-20200705-143412-15586.0001.csv.gz); returns the segment number
+# (0 for a recording that is not split) or None for files that are not part of a recording (such as the index)
+def segmentNumber(fileName):
+    nameParts = os.path.basename(fileName).split(".")[1:]
+    if (len(nameParts) > 0) and ("." + nameParts[-1] in compressedFileExtensions): nameParts = nameParts[:-1]
+    if (len(nameParts) == 0) or ("." + nameParts[-1] not in recordingFileExtensions): return None
+    if (len(nameParts) == 1): return 0
+    if (len(nameParts) == 2) and (nameParts[0].isdigit()): return int(nameParts[0])
+    return None
+
+# find all segments of the recordings that the given files (or recording names without extension) belong to, as one
+# list of files per recording, ordered by the recordings' start times; while a segment is being compressed, the
+# uncompressed file is used; a name without extension of a recording that is not split stands for its file (the
+# binary one if it was also converted)
+def findRecordings(fileNames):
+    recordings = {}
+    for fileName in fileNames:
+        baseName = os.path.join(os.path.dirname(fileName), os.path.basename(fileName).split(".")[0])
+        if (baseName in recordings): continue
+        if (segmentNumber(fileName) == 0):
+            recordings[baseName] = [fileName]
+            continue
+        segments = {}
+        for segmentFileName in sorted(glob.glob(glob.escape(baseName) + ".*"), key=lambda segmentFileName: (isCompressedFile(segmentFileName), not segmentFileName.endswith(binaryFileExtension))):
+            number = segmentNumber(segmentFileName)
+            if (number != None): segments.setdefault(number, segmentFileName)
+        if (len(segments) > 1): segments.pop(0, None)
+        if (len(segments) == 0):
+            print("No data files found for " + fileName)
+            sys.exit()
+        recordings[baseName] = [segments[number] for number in sorted(segments)]
+    return sorted(recordings.values(), key=lambda segmentFileNames: fileStartTime(segmentFileNames[0]))
+
+# remove the initial 127 values for BPM, i.e., everything before the first valid BPM value; returns whether there is
+# a valid BPM value
+def removeInitialBpm(data):
+    validBpm = (data.BPM.fillna(127) != 127).to_numpy()
+    firstValidBpm = np.argmax(validBpm) if (validBpm.any()) else len(validBpm)
+    data.loc[data.index[:firstValidBpm], "BPM"] = pd.NA
+    return validBpm.any()
+
+# read all segments of a recording in either format into one data frame with a row per sample
+def readRecording(fileNames, fromMs = None, toMs = None):
+    data = pd.concat([readData(fileName, fromMs, toMs) for fileName in fileNames], ignore_index=True)
+    removeInitialBpm(data)
+    return data
+
+# read all segments of a recording like readRecording, but as a sequence of data frames of at most
+# streamChunkSamples samples each
+def readRecordingChunks(fileNames, fromMs = None, toMs = None):
+    validBpmFound = False
+    for fileName in fileNames:
+        for data in readDataChunks(fileName, fromMs, toMs):
+            if (not validBpmFound): validBpmFound = removeInitialBpm(data)
+            yield data
+
+# a data frame of numberOfSamples missing samples
+def emptyData(numberOfSamples):
+    return pd.DataFrame({key: pd.Series(pd.NA, index=range(numberOfSamples), dtype=dataType) for key, dataType in dataTypes.items()})
+
+# the values of a column as floats, with NaN for missing values, for the plots
+def floatValues(column):
+    return column.to_numpy(dtype=np.float64, na_value=np.nan)
+
+# merge the data of all files into one timeline of evenly spaced samples: the samples are sorted by their timestamps,
+# each run of samples without an interruption is placed at the position of its first timestamp (but never before the
+# end of the previous run), and the interruptions in between become runs of missing values; returns the timeline and
+# the time (in ms) of each of its samples, interpolated between the timestamps of the BLE notifications
+def mergeData(dataParts):
+    data = pd.concat(dataParts, ignore_index=True)
+    data = data.iloc[np.argsort(data["MS-timestamp"].to_numpy(dtype=np.int64), kind='stable')].reset_index(drop=True)
+    ms = data["MS-timestamp"].to_numpy(dtype=np.int64)
+    runStarts = np.flatnonzero(np.concatenate([[True], np.diff(ms) > interruptionMs]))
+    runEnds = np.append(runStarts[1:], len(ms))
+    recordedMs = np.sum(ms[runEnds - 1] - ms[runStarts])
+    samplesPerMs = len(ms) / recordedMs if (recordedMs > 0) else 0.1 # the ESP32 reports about 100 samples per second
+    runSlots = runStarts + np.maximum.accumulate(np.round((ms[runStarts] - ms[0]) * samplesPerMs).astype(np.int64) - runStarts)
+    slots = np.repeat(runSlots - runStarts, runEnds - runStarts) + np.arange(len(ms))
+    for run in range(1, len(runStarts)):
+        print("The interruption at " + str(ms[runEnds[run - 1] - 1]) + " ms lasted " + str(ms[runStarts[run]] - ms[runEnds[run - 1] - 1]) + " ms, " +
+            "we thus add " + str(runSlots[run] - runSlots[run - 1] - (runEnds[run - 1] - runStarts[run - 1])) + " empty samples in the break.")
+
+    # the samples of one BLE notification share its timestamp, so the first of them anchor the times, and the end of
+    # each run is extrapolated at the average sample rate
+    anchors = np.flatnonzero(np.concatenate([[True], np.diff(ms) != 0]))
+    lastAnchors = anchors[np.searchsorted(anchors, runEnds) - 1]
+    runEndSlots = slots[runEnds - 1] + 1
+    anchorSlots = np.concatenate([slots[anchors], runEndSlots])
+    anchorMs = np.concatenate([ms[anchors], ms[lastAnchors] + (runEndSlots - slots[lastAnchors]) / samplesPerMs])
+    order = np.argsort(anchorSlots, kind='stable')
+    timeline = data.set_axis(slots).reindex(np.arange(slots[-1] + 1))
+    return timeline, np.interp(np.arange(len(timeline)), anchorSlots[order], anchorMs[order])
+
+# the samples of one chunk in the streaming mode, with their times interpolated like in mergeData: returns the times
+# (in ms) and the PPG, BPM, and SpO2 values as floats, with a missing sample after each run that is followed by an
+# interruption, to interrupt the lines there; the run at the end of the chunk extends to the first timestamp of the
+# next chunk (nextMs) if that continues it
+def chunkSamples(data, nextMs, samplesPerMs):
+    ms = data["MS-timestamp"].to_numpy(dtype=np.int64)
+    runStarts = np.flatnonzero(np.concatenate([[True], np.diff(ms) > interruptionMs]))
+    runEnds = np.append(runStarts[1:], len(ms))
+    anchors = np.flatnonzero(np.concatenate([[True], np.diff(ms) != 0]))
+    lastAnchors = anchors[np.searchsorted(anchors, runEnds) - 1]
+    runEndMs = ms[lastAnchors] + (runEnds - lastAnchors) / samplesPerMs
+    continued = (nextMs != None) and (nextMs - ms[-1] <= interruptionMs)
+    if (continued): runEndMs[-1] = nextMs
+    # one more slot per run for the missing sample at its end
+    runOfSample = np.repeat(np.arange(len(runStarts)), runEnds - runStarts)
+    slots = np.arange(len(ms)) + runOfSample
+    breakSlots = runEnds + np.arange(len(runStarts))
+    anchorSlots = np.concatenate([slots[anchors], breakSlots])
+    anchorMs = np.concatenate([ms[anchors], runEndMs])
+    order = np.argsort(anchorSlots, kind='stable')
+    numberOfSlots = len(ms) + len(runStarts) - (1 if (continued) or (nextMs == None) else 0)
+    columns = [np.interp(np.arange(numberOfSlots), anchorSlots[order], anchorMs[order])]
+    for column in ["PPG", "BPM", "SPO2"]:
+        values = np.full(numberOfSlots, np.nan)
+        values[slots] = floatValues(data[column])
+        columns.append(values)
+    return columns
+
+# the samples of the session for the detailed graphs in the streaming mode, read recording by recording (each given
+# with its time limits) in chunks, as returned by chunkSamples; the recordings have to follow each other in time, as
+# the recorder writes them
+def streamSamples(recordingLimits, samplesPerMs):
+    chunks = itertools.chain.from_iterable(readRecordingChunks(fileNames, fromMs, toMs) for fileNames, fromMs, toMs in recordingLimits)
+    data = next(chunks, None)
+    while (data is not None):
+        nextData = next(chunks, None)
+        yield chunkSamples(data, None if (nextData is None) else int(nextData["MS-timestamp"].iloc[0]), samplesPerMs)
+        data = nextData
+
+# render one page, given as a figure dict, into a PDF; each worker process starts its own image export engine with
+# the first page it renders and keeps it for all further pages
+def renderPage(page):
+    return pio.to_image(page, format='pdf')
+
+# render the pages in their order, in a pool of worker processes if more than one job is requested; the workers are
+# forked so that they do not re-run this script
+def renderPages(pages, jobs):
+    if (jobs > 1) and ("fork" not in multiprocessing.get_all_start_methods()):
+        print("Rendering in several processes is not supported on this platform, rendering the pages one after another")
+        jobs = 1
+    if (jobs <= 1):
+        for page in pages: yield renderPage(page)
+        return
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        for pdf in pool.imap(renderPage, pages): yield pdf
+
+# the page cache: rendered pages stored under a hash of their figure (data and layout) and the version of the renderer,
+# so that a re-run only renders the pages that changed; the least recently used pages are removed once the cache
+# grows beyond its size limit
+def hashPageValue(digest, value):
+    if (isinstance(value, dict)):
+        for key in sorted(value):
+            digest.update(repr(key).encode('utf-8'))
+            hashPageValue(digest, value[key])
+    elif (isinstance(value, (list, tuple))):
+        digest.update(b"[")
+        for item in value: hashPageValue(digest, item)
+        digest.update(b"]")
+    elif (isinstance(value, np.ndarray)):
+        # the graphs' times are arrays of datetime objects, which pandas converts much faster than numpy
+        if (value.dtype == object): value = pd.DatetimeIndex(value).asi8
+        digest.update((str(value.dtype) + str(value.shape)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(repr(value).encode('utf-8'))
+
+try:
+    rendererVersion = "plotly " + plotly.__version__ + ", kaleido " + importlib.metadata.version("kaleido")
+except importlib.metadata.PackageNotFoundError:
+    rendererVersion = "plotly " + plotly.__version__
+
+def pageCacheKey(page):
+    digest = hashlib.sha256(rendererVersion.encode('utf-8'))
+    hashPageValue(digest, page)
+    return digest.hexdigest()
+
+# several runs of the visualization may share the cache, so pages can disappear at any time (removed by another run)
+def trimPageCache(cacheDirectory, cacheSizeBytes):
+    cacheFiles = []
+    for entry in os.scandir(cacheDirectory):
+        if (not entry.name.endswith(".pdf")): continue
+        try:
+            cacheFiles.append((entry.path, entry.stat().st_mtime, entry.stat().st_size))
+        except FileNotFoundError:
+            pass
+    cacheFiles.sort(key=lambda cacheFile: cacheFile[1], reverse=True)
+    totalBytes = 0
+    for path, mtime, size in cacheFiles:
+        totalBytes += size
+        if (totalBytes > cacheSizeBytes):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# a page from the cache, None if it is not there (any more)
+def readCachedPage(cacheFileName):
+    try:
+        with open(cacheFileName, 'rb') as f:
+            pdf = f.read()
+            f.close()
+        os.utime(cacheFileName)
+    except FileNotFoundError:
+        return None
+    return pdf
+
+# render the pages like renderPages, but take the pages that were rendered before from the cache and add the others;
+# a page that another run removes from the cache in the meantime is rendered again, also in a worker process (with
+# several jobs), as the export engine must not be started in this process before the workers are forked from it
+def renderPagesCached(pages, jobs, cacheDirectory, cacheSizeBytes):
+    os.makedirs(cacheDirectory, exist_ok=True)
+    cacheFileNames = [os.path.join(cacheDirectory, pageCacheKey(page) + ".pdf") for page in pages]
+    missing = [i for i, cacheFileName in enumerate(cacheFileNames) if (not os.path.exists(cacheFileName))]
+    print("rendering " + str(len(missing)) + " of " + str(len(pages)) + " pages, " + str(len(pages) - len(missing)) + " are taken from the page cache in " + cacheDirectory)
+    renderedPages = renderPages([pages[i] for i in missing], jobs)
+    missing = set(missing)
+    for i, cacheFileName in enumerate(cacheFileNames):
+        pdf = None if (i in missing) else readCachedPage(cacheFileName)
+        if (pdf == None):
+            pdf = next(renderedPages) if (i in missing) else list(renderPages([pages[i]], jobs))[0]
+            # written under a name of its own and renamed, so that other runs never see a partial page
+            temporaryFileName = cacheFileName + "." + str(os.getpid()) + ".tmp"
+            with open(temporaryFileName, 'wb') as f:
+                f.write(pdf)
+                f.close()
+            os.replace(temporaryFileName, cacheFileName)
+        yield pdf
+    trimPageCache(cacheDirectory, cacheSizeBytes)
+
+# matplotlib versions of the Plotly colors and texts used in the figures; sizes are given in pixels in Plotly and in
+# points in matplotlib, with a figure of 2000x350 pixels being 20x3.5 inches
+def matplotlibColor(color):
+    if (color.startswith("rgb(")): return tuple(int(value) / 255 for value in color[4:-1].split(","))
+    return color
+
+def matplotlibText(text):
+    return text.replace("<br>", "\n").replace("＝", "=")
+
+pointsPerPixel = 0.72
+
+# draw one page, given as a Plotly figure dict, as a matplotlib figure with the same layout: the title at the same
+# position, the traces on the left or right y axis, and the axes' ranges and titles; in Plotly's default look (light
+# blue-gray plot area with white grid lines)
+def matplotlibFigure(page):
+    layout = page['layout']
+    figure = Figure(figsize=(layout['width'] / 100, layout['height'] / 100))
+    margin = layout['margin']
+    figure.subplots_adjust(left=margin['l'] / layout['width'], right=1 - margin['r'] / layout['width'],
+        bottom=margin['b'] / layout['height'], top=1 - margin['t'] / layout['height'])
+    fontSize = layout['font']['size'] * pointsPerPixel
+    if ('title' in layout) and ('text' in layout['title']):
+        figure.text(layout['title']['x'], layout['title']['y'], matplotlibText(layout['title']['text']), ha='center', va='center', fontsize=fontSize, linespacing=1.3)
+    axes = figure.add_subplot()
+    if (len(page['data']) == 0):
+        axes.set_axis_off()
+        return figure
+    axes2 = axes.twinx() if ('yaxis2' in layout) else None
+    for plotAxes, axisLayout in [(axes, layout.get('yaxis', {})), (axes2, layout.get('yaxis2', {}))]:
+        if (plotAxes == None): continue
+        if ('range' in axisLayout): plotAxes.set_ylim(axisLayout['range'])
+        if ('title' in axisLayout): plotAxes.set_ylabel(matplotlibText(axisLayout['title']['text']), fontsize=axisLayout['title'].get('font', {}).get('size', layout['font']['size']) * pointsPerPixel)
+        plotAxes.tick_params(labelsize=fontSize, length=0)
+        for spine in plotAxes.spines.values(): spine.set_visible(False)
+    axes.set_facecolor('#E5ECF6')
+    axes.grid(color='white', linewidth=1)
+    axes.set_axisbelow(True)
+    for trace in page['data']:
+        plotAxes = axes2 if (trace.get('yaxis') == 'y2') else axes
+        plotAxes.plot(trace['x'], trace['y'], color=matplotlibColor(trace['line']['color']), linewidth=trace['line']['width'] * pointsPerPixel)
+    axes.margins(x=0)
+    if ('range' in layout.get('xaxis', {})): axes.set_xlim(layout['xaxis']['range'])
+    timeRange = mdates.num2timedelta(axes.get_xlim()[1] - axes.get_xlim()[0])
+    axes.xaxis.set_major_formatter(mdates.DateFormatter("%H:%M:%S" if (timeRange <= timedelta(minutes=5)) else "%H:%M"))
+    return figure
+
+# write all pages into one PDF document with matplotlib, in this process; yields before each page is drawn
+def writeMatplotlibReport(pages, fileName):
+    with PdfPages(fileName) as pdf:
+        for page in pages:
+            yield
+            pdf.savefig(matplotlibFigure(page))
+
+# the report in the streaming mode: each page is drawn with matplotlib and appended to the PDF file as soon as it is
+# prepared, so that neither the figures nor the rendered pages are kept in memory
+class StreamingReport:
+    def __init__(self, fileName):
+        self.pdf = PdfPages(fileName)
+        self.numberOfPages = 0
+
+    def append(self, page):
+        self.pdf.savefig(matplotlibFigure(page))
+        self.numberOfPages += 1
+
+    def __len__(self):
+        return self.numberOfPages
+
+    def close(self):
+        self.pdf.close()
+
+# the time spent in each stage of the visualization (parsing, building the pyramids, merging, computing the
+# statistics, preparing the pages, building their figures, exporting them, and merging them into the PDF); the
+# stages follow each other and entering one ends the previous one, so that the time of a stage that is entered
+# several times (e.g., for each page) adds up; with --profile, each stage (per page for the pages) is also recorded
+# as an event with the peak of the memory allocated by Python (traced with tracemalloc) and the resident memory at
+# its end, and with --profile-page, the page with that number is profiled with cProfile
+class StageTimer:
+    def __init__(self, profile = False, profilePage = None):
+        self.seconds = {}
+        self.stage = None
+        self.page = None
+        self.firstTime = time.perf_counter()
+        self.startTime = self.firstTime
+        self.profile = profile
+        self.events = []
+        self.phaseStarts = {}
+        self.profilePage = profilePage
+        self.pageProfiler = cProfile.Profile() if (profilePage != None) else None
+        if (profile): tracemalloc.start()
+
+    def enter(self, stage, page = None):
+        now = time.perf_counter()
+        if (self.stage != None): self.seconds[self.stage] = self.seconds.get(self.stage, 0) + now - self.startTime
+        if (self.stage != None) and (self.profile):
+            tracedBytes, peakTracedBytes = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            self.events.append(dict(stage=self.stage, page=self.page, startS=self.startTime - self.firstTime, durationS=now - self.startTime, peakTracedBytes=peakTracedBytes, residentBytes=residentBytes()))
+        if (self.pageProfiler != None) and (page == self.profilePage) and (stage != None): self.pageProfiler.enable()
+        elif (self.pageProfiler != None): self.pageProfiler.disable()
+        self.stage, self.page, self.startTime = stage, page, time.perf_counter()
+
+    # the times of all stages as one line, e.g., "parse 1.234s, merge 0.123s, ...", which ends the current stage
+    def summary(self):
+        self.enter(None)
+        return ", ".join([stage + " " + "{:.3f}".format(seconds) + "s" for stage, seconds in self.seconds.items()])
+
+    # the estimated time left in a phase of several steps (e.g., the pages), from the time of the steps done so far
+    def eta(self, phase, done, total):
+        startTime = self.phaseStarts.setdefault(phase, time.perf_counter())
+        if (done == 0): return ""
+        return ", ETA " + str(timedelta(seconds=round((time.perf_counter() - startTime) / done * (total - done))))
+
+    # the time, number of events, the longest event, and the memory peaks per stage as a table
+    def breakdown(self):
+        totalS = sum(self.seconds.values())
+        lines = ["{:<12}{:>10}{:>8}{:>8}{:>11}{:>14}{:>11}".format("stage", "total", "share", "calls", "longest", "peak traced", "peak RSS")]
+        for stage, seconds in self.seconds.items():
+            stageEvents = [event for event in self.events if (event["stage"] == stage)]
+            peakResident = max([event["residentBytes"] or 0 for event in stageEvents], default=0)
+            lines.append("{:<12}{:>9.3f}s{:>7.1%}{:>8}{:>10.3f}s{:>11.1f} MB{:>8.1f} MB".format(stage, seconds, seconds / totalS if (totalS > 0) else 0, len(stageEvents),
+                max([event["durationS"] for event in stageEvents], default=0), max([event["peakTracedBytes"] for event in stageEvents], default=0) / 1e6, peakResident / 1e6))
+        return "\n".join(lines)
+
+    # write the events as JSON, or in the trace event format of Chrome's about:tracing and Perfetto (with the memory
+    # as counters)
+    def writeTrace(self, fileName, traceFormat):
+        if (traceFormat == "chrome"):
+            traceEvents = []
+            for event in self.events:
+                traceEvents.append(dict(name=event["stage"] + ("" if (event["page"] == None) else " " + str(event["page"])), cat=event["stage"], ph="X", pid=os.getpid(), tid=0,
+                    ts=round(event["startS"] * 1e6), dur=round(event["durationS"] * 1e6), args=dict(page=event["page"], peakTracedMB=event["peakTracedBytes"] / 1e6)))
+                traceEvents.append(dict(name="memory", ph="C", pid=os.getpid(), tid=0, ts=round((event["startS"] + event["durationS"]) * 1e6),
+                    args=dict(tracedMB=event["peakTracedBytes"] / 1e6, residentMB=(event["residentBytes"] or 0) / 1e6)))
+            trace = dict(traceEvents=traceEvents, displayTimeUnit="ms")
+        else:
+            trace = dict(stagesS=self.seconds, events=self.events)
+        with open(fileName, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+            f.close()
+
+    # print the functions that took the most time on the profiled page and write the profile next to fileName
+    def writePageProfile(self, fileName):
+        if (self.pageProfiler == None): return
+        profileFileName = os.path.splitext(fileName)[0] + "-page-" + str(self.profilePage) + ".prof"
+        stats = pstats.Stats(self.pageProfiler)
+        if (stats.total_calls == 0):
+            print("page " + str(self.profilePage) + " was not profiled, the report has fewer pages")
+            return
+        stats.dump_stats(profileFileName)
+        stats.sort_stats("cumulative").print_stats(25)
+        print("wrote the profile of page " + str(self.profilePage) + " to " + profileFileName)
+
+# the resident memory of the process (only on Linux, else None)
+def residentBytes():
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# the times of the samples of a graph, given as ms after startDateTime; as a numpy array of datetime64 values, which
+# Plotly keeps as they are (it turns other date arrays into arrays of datetime objects, which are slow to copy)
+def graphTimes(startDateTime, msOffsets):
+    return (startDateTime + pd.to_timedelta(msOffsets, unit='ms').round('us')).to_numpy()
+
+# the plot area of the 2000 pixel wide pages (without the left and right margins) in pixel columns
+plotColumns = 2000 - 80 - 80
+
+# reduce a trace to the samples that determine how it is drawn at the output resolution: in each pixel column of the
+# time range (given in ms), the first, lowest, highest, and last reading, so that dips and spikes stay visible; the
+# line is interrupted where whole columns have no readings (shorter dropouts are not visible at this resolution
+# anyway); a page thus gets at most about four points per column, however long its time range and however high the
+# sample rate
+def decimateTrace(msValues, values, rangeMs, columns=plotColumns):
+    if (len(values) <= 4 * columns): return msValues, values
+    validIndices = np.flatnonzero(~np.isnan(values))
+    column = ((msValues[validIndices] - rangeMs[0]) * columns // (rangeMs[1] - rangeMs[0])).astype(np.int64)
+    groupStarts = np.flatnonzero(np.diff(column, prepend=-1) != 0)
+    groupLengths = np.diff(groupStarts, append=len(validIndices))
+    groupOfSample = np.repeat(np.arange(len(groupStarts)), groupLengths)
+    validValues = values[validIndices]
+    selected = [groupStarts, groupStarts + groupLengths - 1]
+    if (len(validIndices) > 0):
+        for extremes in [np.minimum.reduceat(validValues, groupStarts), np.maximum.reduceat(validValues, groupStarts)]:
+            positions = np.flatnonzero(validValues == extremes[groupOfSample])
+            selected.append(positions[np.unique(groupOfSample[positions], return_index=True)[1]])
+    selected = np.unique(np.concatenate(selected))
+    breaks = np.flatnonzero(np.diff(column[selected]) > 1) + 1
+    decimatedMs = msValues[validIndices[selected]]
+    return np.insert(decimatedMs, breaks, decimatedMs[breaks]), np.insert(validValues[selected], breaks, np.nan)
+
+# the sections of the report as given with --sections, e.g., "60:averaged,10:range,1:samples", as a list of the
+# minutes per graph and the kind of graph
+graphKinds = ["averaged", "range", "samples"]
+
+def parseSections(value):
+    sections = []
+    for section in value.split(","):
+        minutesPerGraph, separator, kind = section.strip().partition(":")
+        try:
+            minutesPerGraph = float(minutesPerGraph)
+        except ValueError:
+            minutesPerGraph = 0
+        if (minutesPerGraph <= 0) or (kind not in graphKinds): parser.error("invalid section " + section + " (expected minutes per graph and " + ", ".join(graphKinds) + ", e.g., 10:range)")
+        sections.append((minutesPerGraph, kind))
+    return sections
+
+# plan the graphs of all sections: per section, the time range (in ms) of each graph and the range of its samples in
+# the timeline, whose times (timeMs) are searched for the bounds of all graphs at once; in the streaming mode, there
+# is no timeline (timeMs is None) and the samples are found while they are read
+def planGraphs(sections, startTimeMs, durationMs, timeMs = None):
+    plans = []
+    for minutesPerGraph, kind in sections:
+        graphMs = minutesPerGraph * 60 * 1000
+        graphStarts = startTimeMs + graphMs * np.arange(math.ceil(durationMs / graphMs))
+        plans.append(dict(minutesPerGraph=minutesPerGraph, kind=kind, rangesMs=np.stack([graphStarts, graphStarts + graphMs], axis=1)))
+    if (timeMs is None): return plans
+    bounds = np.searchsorted(timeMs, np.concatenate([plan["rangesMs"].ravel() for plan in plans]))
+    for plan, planBounds in zip(plans, np.split(bounds, np.cumsum([plan["rangesMs"].size for plan in plans])[:-1])):
+        plan["samples"] = planBounds.reshape(-1, 2)
+    return plans
+
+# the samples of consecutive graphs (with their time ranges in ms in increasing order) from a stream of chunks as
+# returned by streamSamples: only the chunks that overlap the current graph are kept
+def sampleWindows(chunks, rangesMs):
+    buffered = [np.zeros(0)] * 4
+    chunksLeft = True
+    for rangeMs in rangesMs:
+        while (chunksLeft) and ((len(buffered[0]) == 0) or (buffered[0][-1] < rangeMs[1])):
+            chunk = next(chunks, None)
+            if (chunk is None): chunksLeft = False
+            else: buffered = [np.concatenate([bufferedValues, values]) for bufferedValues, values in zip(buffered, chunk)]
+        start, end = np.searchsorted(buffered[0], rangeMs)
+        yield [values[start:end] for values in buffered]
+        buffered = [values[end:] for values in buffered]
+
+# the summary pyramid of a recording, cached next to it (oximeter-20200705-143412-15586.pyramid): per level, the
+# buckets with the number of samples and the count, min, max, and sum of the PPG, BPM, and SpO2 readings, aligned to
+# the ESP32's ms timestamps like the recorder's summary file (empty buckets have a min of 255 and a max of 0); the
+# cache is keyed by the names, sizes, and modification times of the recording's files and rebuilt when they change
+pyramidVersion = 3
+pyramidLevelsMs = [200, 1000, 10000, 60000, 600000, 3600000]
+pyramidColumns = ["PPG", "BPM", "SPO2"]
+pyramidDtype = np.dtype([('ms', '<i8'), ('samples', '<u4')] +
+    [(column + suffix, dataType) for column in pyramidColumns for suffix, dataType in [('-count', '<u4'), ('-min', 'u1'), ('-max', 'u1'), ('-sum', '<u8')]])
+# the pyramid file: the magic, the length of a JSON header (the source key, the first and last timestamp, the number of
+# samples, the recorded time without the interruptions, the number of interruptions, and the position and number of
+# buckets of each level), the header, and the buckets of each level, which are memory-mapped for each query (see
+# pyramidLevelBuckets)
+pyramidMagic = b"OXIPYRAM"
+
+def pyramidFileName(fileName):
+    return os.path.join(os.path.dirname(fileName), os.path.basename(fileName).split(".")[0]) + ".pyramid"
+
+def pyramidSourceKey(fileNames):
+    return "|".join([str(pyramidVersion)] + [os.path.basename(fileName) + ":" + str(os.stat(fileName).st_size) + ":" + str(os.stat(fileName).st_mtime_ns) for fileName in fileNames])
+
+# the buckets of one level from the samples of a recording (as read by readRecording)
+def summarizeSamples(data, levelMs):
+    bucketStart = data["MS-timestamp"].to_numpy(dtype=np.int64) // levelMs * levelMs
+    firstIndices = np.flatnonzero(np.concatenate([[True], bucketStart[1:] != bucketStart[:-1]])) if (len(bucketStart) > 0) else np.zeros(0, dtype=np.int64)
+    buckets = np.zeros(len(firstIndices), dtype=pyramidDtype)
+    if (len(firstIndices) == 0): return buckets
+    buckets['ms'] = bucketStart[firstIndices]
+    buckets['samples'] = np.diff(np.append(firstIndices, len(bucketStart)))
+    for column in pyramidColumns:
+        values = floatValues(data[column])
+        valid = ~np.isnan(values)
+        buckets[column + '-count'] = np.add.reduceat(valid.astype(np.int64), firstIndices)
+        buckets[column + '-min'] = np.nan_to_num(np.fmin.reduceat(values, firstIndices), nan=255)
+        buckets[column + '-max'] = np.nan_to_num(np.fmax.reduceat(values, firstIndices), nan=0)
+        buckets[column + '-sum'] = np.add.reduceat(np.where(valid, values, 0), firstIndices)
+    return buckets
+
+# combine buckets (of one or more recordings, in any order) into the buckets of the same or a coarser level
+def aggregateBuckets(buckets, levelMs):
+    bucketStart = buckets['ms'] // levelMs * levelMs
+    order = np.argsort(bucketStart, kind='stable')
+    buckets = buckets[order]
+    bucketStart = bucketStart[order]
+    firstIndices = np.flatnonzero(np.concatenate([[True], bucketStart[1:] != bucketStart[:-1]])) if (len(bucketStart) > 0) else np.zeros(0, dtype=np.int64)
+    aggregated = np.zeros(len(firstIndices), dtype=pyramidDtype)
+    if (len(firstIndices) == 0): return aggregated
+    aggregated['ms'] = bucketStart[firstIndices]
+    for field in pyramidDtype.names[1:]:
+        if (field.endswith('-min')): aggregated[field] = np.minimum.reduceat(buckets[field], firstIndices)
+        elif (field.endswith('-max')): aggregated[field] = np.maximum.reduceat(buckets[field], firstIndices)
+        else: aggregated[field] = np.add.reduceat(buckets[field], firstIndices)
+    return aggregated
+
+# write the pyramid of the samples of a recording, given as a sequence of data frames in time order, into the file f;
+# the chunks are summarized one after another and the levels collected in temporary files (each level's last bucket
+# stays open for the next chunk), so that only one chunk is in memory at a time
+def writePyramid(f, sourceKey, chunks):
+    header = dict(source=sourceKey, first=None, last=None, samples=0, recordedMs=0, interruptions=0)
+    levelFiles = {levelMs: tempfile.TemporaryFile() for levelMs in pyramidLevelsMs}
+    openBuckets = {levelMs: np.zeros(0, dtype=pyramidDtype) for levelMs in pyramidLevelsMs}
+    for data in chunks:
+        ms = data["MS-timestamp"].to_numpy(dtype=np.int64)
+        if (len(ms) == 0): continue
+        steps = np.diff(ms, prepend=ms[0] if (header["last"] == None) else header["last"])
+        if (header["first"] == None): header["first"] = int(ms[0])
+        header["last"] = int(ms[-1])
+        header["samples"] += len(ms)
+        header["recordedMs"] += int(np.sum(steps[steps <= interruptionMs]))
+        header["interruptions"] += int(np.sum(steps > interruptionMs))
+        baseBuckets = summarizeSamples(data, pyramidLevelsMs[0])
+        for levelMs in pyramidLevelsMs:
+            buckets = aggregateBuckets(np.concatenate([openBuckets[levelMs], baseBuckets]), levelMs)
+            levelFiles[levelMs].write(buckets[:-1].tobytes())
+            openBuckets[levelMs] = buckets[-1:]
+    levels = []
+    offset = 0
+    for levelMs in pyramidLevelsMs:
+        levelFiles[levelMs].write(openBuckets[levelMs].tobytes())
+        levels.append([levelMs, offset, levelFiles[levelMs].tell() // pyramidDtype.itemsize])
+        offset += levelFiles[levelMs].tell()
+    header["levels"] = levels
+    headerText = json.dumps(header).encode('utf-8')
+    f.write(pyramidMagic + struct.pack("<I", len(headerText)) + headerText)
+    f.write(b"\0" * (-f.tell() % 8)) # the buckets start at a multiple of 8 bytes
+    for levelMs in pyramidLevelsMs:
+        levelFiles[levelMs].seek(0)
+        shutil.copyfileobj(levelFiles[levelMs], f)
+        levelFiles[levelMs].close()
+
+# read the header of a pyramid file (given as an open file, which the pyramid keeps) as a dict, or None if it is not a
+# pyramid file; the levels are kept as the file position and number of their buckets
+def loadPyramid(f):
+    f.seek(0)
+    if (f.read(len(pyramidMagic)) != pyramidMagic): return None
+    headerLength = struct.unpack("<I", f.read(4))[0]
+    pyramid = json.loads(f.read(headerLength).decode('utf-8'))
+    bucketsOffset = f.tell() + (-f.tell() % 8)
+    pyramid["file"] = f
+    pyramid["levels"] = {levelMs: (bucketsOffset + offset, count) for levelMs, offset, count in pyramid["levels"]}
+    return pyramid
+
+# the buckets of one level of a pyramid, memory-mapped; the mapping is released again once the buckets are no longer
+# used, so that a pass over a long recording does not keep the buckets of all of its pages in memory
+def pyramidLevelBuckets(pyramid, levelMs):
+    offset, count = pyramid["levels"][levelMs]
+    if (count == 0): return np.zeros(0, dtype=pyramidDtype)
+    return np.memmap(pyramid["file"], dtype=pyramidDtype, mode='r', offset=offset, shape=(count,))
+
+# the pyramid of a recording, from its cache if that is up to date, otherwise built from the recording's samples
+# (data, if all of them have already been read, else read in chunks) and cached; without write access, the pyramid
+# is built in a temporary file instead
+def readPyramid(fileNames, data = None):
+    cacheFileName = pyramidFileName(fileNames[0])
+    sourceKey = pyramidSourceKey(fileNames)
+    if (os.path.exists(cacheFileName)):
+        f = open(cacheFileName, 'rb')
+        pyramid = loadPyramid(f)
+        if (pyramid != None) and (pyramid["source"] == sourceKey): return pyramid
+        f.close()
+    print("building summary pyramid " + cacheFileName)
+    try:
+        with open(cacheFileName + ".tmp", 'wb') as f:
+            writePyramid(f, sourceKey, readRecordingChunks(fileNames) if (data is None) else [data])
+            f.close()
+        os.replace(cacheFileName + ".tmp", cacheFileName)
+        return loadPyramid(open(cacheFileName, 'rb'))
+    except OSError as e:
+        print("Cannot cache the summary pyramid: " + str(e))
+    f = tempfile.TemporaryFile()
+    writePyramid(f, sourceKey, readRecordingChunks(fileNames) if (data is None) else [data])
+    return loadPyramid(f)
+
+# the coarsest level that still resolves the given time span (in ms)
+def pyramidLevel(resolutionMs):
+    return max([levelMs for levelMs in pyramidLevelsMs if (levelMs <= resolutionMs)], default=pyramidLevelsMs[0])
+
+# the buckets of a level (sorted by their start) from startMs up to endMs (excluded); found by bisection on the
+# memory-mapped buckets, which only reads the few buckets it compares (np.searchsorted would copy all timestamps)
+def bucketsInRange(levelBuckets, startMs, endMs):
+    return levelBuckets[bisect.bisect_left(levelBuckets['ms'], startMs):bisect.bisect_left(levelBuckets['ms'], endMs)]
+
+# the buckets of one level in a time range (in ms) on an even grid, with empty buckets where there is no data; the
+# buckets of the pyramids of all recordings of the session are combined, as they share the ms timestamp basis;
+# returns the buckets' center times and the buckets
+def pyramidBuckets(pyramids, levelMs, rangeMs):
+    grid = np.arange(math.floor(rangeMs[0] / levelMs), math.ceil(rangeMs[1] / levelMs), dtype=np.int64) * levelMs
+    buckets = np.zeros(len(grid), dtype=pyramidDtype)
+    buckets['ms'] = grid
+    for column in pyramidColumns: buckets[column + '-min'] = 255
+    levels = [pyramidLevelBuckets(pyramid, levelMs) for pyramid in pyramids]
+    inRange = aggregateBuckets(np.concatenate([bucketsInRange(levelBuckets, grid[0] if (len(grid) > 0) else rangeMs[0], rangeMs[1]) for levelBuckets in levels]), levelMs)
+    buckets[(inRange['ms'] - grid[0]) // levelMs] = inRange
+    return grid + levelMs / 2, buckets
+
+# the totals of the buckets, as one bucket
+def bucketTotals(buckets):
+    totals = np.zeros(1, dtype=pyramidDtype)
+    for field in pyramidDtype.names[1:]:
+        if (field.endswith('-min')): totals[field] = np.min(buckets[field], initial=255)
+        elif (field.endswith('-max')): totals[field] = np.max(buckets[field], initial=0)
+        else: totals[field] = np.sum(buckets[field])
+    return totals[0]
+
+# the totals of a pyramid in a time range (in ms, the end excluded), from as few buckets as possible: the coarsest
+# buckets that lie within the range, and finer ones towards its ends; the range is rounded to the finest buckets
+def pyramidTotals(pyramid, rangeMs):
+    parts = []
+    remainingRanges = [(rangeMs[0], rangeMs[1])]
+    for levelMs in reversed(pyramidLevelsMs):
+        levelBuckets = pyramidLevelBuckets(pyramid, levelMs)
+        uncovered = []
+        for startMs, endMs in remainingRanges:
+            if (levelMs == pyramidLevelsMs[0]): coveredStartMs, coveredEndMs = startMs // levelMs * levelMs, -(-endMs // levelMs) * levelMs
+            else: coveredStartMs, coveredEndMs = -(-startMs // levelMs) * levelMs, endMs // levelMs * levelMs
+            if (coveredStartMs >= coveredEndMs):
+                uncovered.append((startMs, endMs))
+                continue
+            parts.append(bucketsInRange(levelBuckets, coveredStartMs, coveredEndMs))
+            if (startMs < coveredStartMs): uncovered.append((startMs, coveredStartMs))
+            if (coveredEndMs < endMs): uncovered.append((coveredEndMs, endMs))
+        remainingRanges = uncovered
+    return bucketTotals(np.concatenate(parts + [np.zeros(0, dtype=pyramidDtype)]))
+
+# the range of the readings of a column in each bucket, as a trace that goes to the min and the max of each bucket
+def bucketEnvelope(bucketMs, buckets, column):
+    valid = buckets[column + '-count'] > 0
+    values = np.stack([np.where(valid, buckets[column + '-min'], np.nan), np.where(valid, buckets[column + '-max'], np.nan)], axis=1)
+    return np.repeat(bucketMs, 2), values.ravel()
+
+# the sums and counts of the readings of some columns in the buckets of one level in a time range (in ms) on an even
+# grid, as pyramidBuckets; read from the pyramids 3600 buckets at a time, so that only these columns are kept for
+# the whole session; returns the buckets' center times, the sums, and the counts
+def levelSums(pyramids, levelMs, rangeMs, columns):
+    parts = []
+    for pieceStartMs in range(rangeMs[0] // levelMs * levelMs, rangeMs[1], 3600 * levelMs):
+        bucketMs, buckets = pyramidBuckets(pyramids, levelMs, [pieceStartMs, min(pieceStartMs + 3600 * levelMs, rangeMs[1])])
+        parts.append((bucketMs, {column: buckets[column + '-sum'].astype(np.float64) for column in columns}, {column: buckets[column + '-count'].astype(np.int64) for column in columns}))
+    return (np.concatenate([part[0] for part in parts] + [np.zeros(0)]),
+        {column: np.concatenate([part[1][column] for part in parts] + [np.zeros(0)]) for column in columns},
+        {column: np.concatenate([part[2][column] for part in parts] + [np.zeros(0, dtype=np.int64)]) for column in columns})
+
+# the smoothing of the averaged graphs (--smoothing), done once for the whole session on the buckets of a level: a
+# moving average (of the readings in the window), a moving median, or an exponential moving average (both of the
+# buckets' means, the latter with a span of the window); the windows do not reach across interruptions (runs of
+# buckets without readings of at least interruptionMs), and the exponential moving average starts anew after them;
+# the moving average and median use an odd number of buckets, so that their windows are centered on each bucket
+# (see filterLevel)
+smoothingFilters = ["mean", "median", "ema"]
+smoothingNames = {"mean": "moving average", "median": "moving median", "ema": "exponential moving average"}
+
+def parseSmoothing(value):
+    smoothingFilter, separator, windowS = value.strip().partition(":")
+    try:
+        windowS = float(windowS)
+    except ValueError:
+        windowS = 0
+    if (windowS <= 0) or (smoothingFilter not in smoothingFilters): parser.error("invalid smoothing " + value + " (expected " + ", ".join(smoothingFilters) + " and the window in seconds, e.g., median:5)")
+    return smoothingFilter, windowS
+
+def smoothBuckets(sums, counts, levelMs, windowMs, smoothingFilter):
+    windowLength = 2 * int(windowMs // (2 * levelMs)) + 1
+    valid = counts > 0
+    breakStarts, breakEnds = conditionRuns(~valid, math.ceil(interruptionMs / levelMs))
+    segments = np.cumsum(np.isin(np.arange(len(counts)), breakStarts))
+    if (smoothingFilter == "mean"):
+        segmentStarts, segmentEnds = np.searchsorted(segments, segments, side='left'), np.searchsorted(segments, segments, side='right')
+        windowSums = np.concatenate([[0], np.cumsum(sums)])
+        windowCounts = np.concatenate([[0], np.cumsum(counts)])
+        windowStarts = np.maximum(np.arange(len(counts)) - windowLength // 2, segmentStarts)
+        windowEnds = np.minimum(np.arange(len(counts)) - windowLength // 2 + windowLength, segmentEnds)
+        readings = windowCounts[windowEnds] - windowCounts[windowStarts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(readings > 0, (windowSums[windowEnds] - windowSums[windowStarts]) / readings, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = pd.Series(np.where(valid, sums / counts, np.nan))
+    segmentMeans = means.groupby(segments)
+    if (smoothingFilter == "median"): return segmentMeans.transform(lambda values: values.rolling(windowLength, center=True, min_periods=1).median()).to_numpy()
+    return segmentMeans.transform(lambda values: values.ewm(span=max(round(windowMs / levelMs), 1), ignore_na=True).mean()).where(valid).to_numpy()
+
+# the level of the buckets for the averaged graphs of graphMs, which resolves the smoothing window and the graphs'
+# pixel columns
+def smoothingLevel(graphMs):
+    return pyramidLevel(min(smoothing[1] * 1000, graphMs / plotColumns))
+
+# the level at which the session is smoothed for the graphs' level: the coarsest one (at most the graphs' level) of
+# which the window is an odd number of buckets, otherwise the finest, where the odd number of buckets is closest to
+# the window (e.g., 11 buckets of 0.2s for a window of 2s rather than 3 buckets of 1s)
+def filterLevel(levelMs):
+    windowMs = smoothing[1] * 1000
+    finerLevelsMs = [finerLevelMs for finerLevelMs in pyramidLevelsMs if (finerLevelMs <= levelMs)]
+    for finerLevelMs in reversed(finerLevelsMs):
+        if (windowMs % finerLevelMs == 0) and ((windowMs // finerLevelMs) % 2 == 1): return finerLevelMs
+    return finerLevelsMs[0]
+
+# the smoothed BPM and SpO2 of the whole session (in rangeMs) for the averaged graphs of graphMs; returns the buckets'
+# center times and the smoothed values
+def smoothedSession(graphMs, rangeMs):
+    smoothingFilter, windowS = smoothing
+    levelMs = smoothingLevel(graphMs)
+    filterMs = filterLevel(levelMs)
+    # the range is extended to whole buckets of the graphs' level, so that each of them is filterMs buckets
+    sessionRangeMs = [(rangeMs[0] - math.ceil(windowS * 1000)) // levelMs * levelMs, -(-(rangeMs[1] + math.ceil(windowS * 1000)) // levelMs) * levelMs]
+    bucketMs, sums, counts = levelSums(pyramids, filterMs, sessionRangeMs, ["BPM", "SPO2"])
+    smoothed = [smoothBuckets(sums[column], counts[column], filterMs, windowS * 1000, smoothingFilter) for column in ["BPM", "SPO2"]]
+    if (filterMs == levelMs): return bucketMs, smoothed[0], smoothed[1]
+    # back to the graphs' level: the value at the center of each of their buckets (the mean of the two values at the
+    # center for an even number of finer buckets)
+    finerBuckets = levelMs // filterMs
+    centers = [(finerBuckets - 1) // 2, finerBuckets // 2]
+    bucketMs = bucketMs.reshape(-1, finerBuckets)[:, centers].mean(axis=1)
+    return (bucketMs, *[values.reshape(-1, finerBuckets)[:, centers].mean(axis=1) for values in smoothed])
+
+# event detection (--events): desaturations (the SpO2 at least desaturationDropPercent below its baseline, the mean
+# of the preceding baselineWindowS seconds) and episodes of bradycardia and tachycardia (the BPM below or above a
+# limit), each lasting at least eventMinS; found in the per-second means of the summary pyramids, so that a week
+# of data is only about 600,000 values, and without events across interruptions (seconds without readings)
+desaturationDropPercent = 3
+baselineWindowS = 120
+bradycardiaBpm = 50
+tachycardiaBpm = 100
+eventMinS = 10
+eventMarginMs = 30000 # the detailed graphs around an event also show this much before and after it
+eventColumns = ["event", "start", "end", "duration-s", "MS-start", "MS-end", "baseline", "value"]
+
+# the mean of BPM and SpO2 per second in a time range (in ms), NaN for seconds without readings
+def secondMeans(pyramids, rangeMs):
+    bucketMs, sums, counts = levelSums(pyramids, 1000, rangeMs, ["BPM", "SPO2"])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return rangeMs[0] // 1000 * 1000, {column: np.where(counts[column] > 0, sums[column] / counts[column], np.nan).astype(np.float32) for column in sums}
+
+# the mean of the windowLength values before each value (NaN if fewer than half of them are readings), from
+# cumulative sums
+def trailingMean(values, windowLength):
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0], np.cumsum(np.where(valid, values, 0), dtype=np.float64)])
+    counts = np.concatenate([[0], np.cumsum(valid, dtype=np.int64)])
+    windowEnds = np.arange(len(values))
+    windowStarts = np.maximum(windowEnds - windowLength, 0)
+    windowCounts = counts[windowEnds] - counts[windowStarts]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(windowCounts >= windowLength / 2, (sums[windowEnds] - sums[windowStarts]) / windowCounts, np.nan)
+
+# the runs of at least minLength consecutive true values, as their start and end (excluded) indices
+def conditionRuns(condition, minLength):
+    edges = np.diff(np.concatenate([[0], condition.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    longRuns = ends - starts >= minLength
+    return starts[longRuns], ends[longRuns]
+
+# the lowest or highest value of each run
+def runExtremes(values, starts, ends, reduction):
+    if (len(starts) == 0): return np.zeros(0)
+    bounds = np.stack([starts, ends], axis=1).ravel()
+    return reduction.reduceat(np.append(values, np.nan), bounds)[::2]
 
-filenameExtension = sys.argv[1]
+# all events in a time range (in ms) as a table, ordered by their start
+def detectEvents(pyramids, rangeMs):
+    firstMs, means = secondMeans(pyramids, rangeMs)
+    baseline = trailingMean(means["SPO2"], baselineWindowS)
+    with np.errstate(invalid='ignore'):
+        conditions = [
+            ("desaturation", "SPO2", means["SPO2"] <= baseline - desaturationDropPercent, np.fmin),
+            ("bradycardia", "BPM", means["BPM"] < bradycardiaBpm, np.fmin),
+            ("tachycardia", "BPM", means["BPM"] > tachycardiaBpm, np.fmax),
+        ]
+    eventParts = []
+    for event, column, condition, reduction in conditions:
+        starts, ends = conditionRuns(condition, eventMinS)
+        eventParts.append(pd.DataFrame({"event": event, "MS-start": firstMs + 1000 * starts, "MS-end": firstMs + 1000 * ends,
+            "baseline": baseline[starts] if (column == "SPO2") else np.nan, "value": runExtremes(means[column], starts, ends, reduction)}))
+    events = pd.concat(eventParts, ignore_index=True).sort_values("MS-start", kind="stable", ignore_index=True)
+    events["duration-s"] = (events["MS-end"] - events["MS-start"]) / 1000
+    return events
+
+# which of the graphs (given by their time ranges in ms) show a part of an event (or its margin)
+def graphsWithEvents(rangesMs, events):
+    eventStarts = np.sort(events["MS-start"].to_numpy() - eventMarginMs)
+    eventEnds = np.sort(events["MS-end"].to_numpy() + eventMarginMs)
+    return np.searchsorted(eventStarts, rangesMs[:, 1], side='left') - np.searchsorted(eventEnds, rangesMs[:, 0], side='right') > 0
+
+# beat analysis (--beats): the PPG waveform is band-pass filtered (to beatBandHz, i.e., 30 to 300 BPM), its peaks are
+# the beats, and the intervals between consecutive beats (IBIs) give the heart rate and its variability (SDNN, the
+# standard deviation of the IBIs, RMSSD, the root mean square of the differences of successive IBIs, and pNN50, the
+# share of these differences above 50ms) per window of beatWindowS; an IBI is accepted if it is plausible and within
+# beatIbiTolerance of the median of its neighbors, and the quality of a window is the share of its recorded time
+# that is covered by accepted IBIs, windows below beatMinQuality are flagged as artefacts (e.g., from movement);
+# the samples are processed an hour at a time, with scipy's filters if it is installed and moving averages if not
+beatBandHz = [0.5, 5]
+beatWindowS = 300
+beatIbiMs = [300, 2000]
+beatIbiTolerance = 0.2
+beatMinQuality = 0.6
+beatPieceMs = 3600000
+beatColumns = ["start", "end", "MS-start", "MS-end", "beats", "bpm", "sdnn-ms", "rmssd-ms", "pnn50", "quality", "artefact"]
+
+# the mean of a moving window of windowLength values centered on each value, from cumulative sums
+def movingMean(values, windowLength):
+    sums = np.concatenate([[0], np.cumsum(values, dtype=np.float64)])
+    windowStarts = np.clip(np.arange(len(values)) - windowLength // 2, 0, len(values))
+    windowEnds = np.clip(np.arange(len(values)) - windowLength // 2 + windowLength, 0, len(values))
+    return (sums[windowEnds] - sums[windowStarts]) / np.maximum(windowEnds - windowStarts, 1)
+
+# the beats in the PPG samples of a piece of the session (with their times in ms and NaN where there are no samples),
+# at samplesPerSecond: the times of the beats and the IBI before each beat (NaN for the first beat after a gap)
+def ppgBeats(timeMs, ppg, samplesPerSecond):
+    valid = ~np.isnan(ppg)
+    if (np.sum(valid) < 2 * samplesPerSecond): return np.zeros(0), np.zeros(0)
+    signal = np.where(valid, ppg, np.nanmean(ppg))
+    minDistance = max(int(samplesPerSecond * beatIbiMs[0] / 1000), 1)
+    if (scipy != None):
+        filtered = scipy.signal.sosfiltfilt(scipy.signal.butter(2, beatBandHz, btype='bandpass', fs=samplesPerSecond, output='sos'), signal)
+        peaks = scipy.signal.find_peaks(filtered, distance=minDistance, prominence=0.5 * np.std(filtered))[0]
+    else:
+        filtered = movingMean(signal, max(round(samplesPerSecond / beatBandHz[1] / 2), 1)) - movingMean(signal, round(samplesPerSecond / beatBandHz[0]))
+        windowMax = np.lib.stride_tricks.sliding_window_view(np.pad(filtered, minDistance // 2, mode='edge'), 2 * (minDistance // 2) + 1).max(axis=1)
+        peaks = np.flatnonzero((filtered == windowMax) & (filtered > 0.5 * np.std(filtered)))
+    # no IBI across samples without a reading
+    gaps = np.concatenate([[0], np.cumsum(~valid)])
+    ibis = np.diff(timeMs[peaks], prepend=np.nan)
+    ibis[1:][gaps[peaks[1:]] != gaps[peaks[:-1]]] = np.nan
+    return timeMs[peaks], ibis
+
+# the accepted IBIs: plausible, and within beatIbiTolerance of the median of the surrounding five IBIs
+def acceptedIbis(ibis):
+    neighborMedian = np.nanmedian(np.lib.stride_tricks.sliding_window_view(np.pad(ibis, 2, constant_values=np.nan), 5), axis=1) if (len(ibis) > 0) else ibis
+    with np.errstate(invalid='ignore'):
+        return (ibis >= beatIbiMs[0]) & (ibis <= beatIbiMs[1]) & (np.abs(ibis - neighborMedian) <= beatIbiTolerance * neighborMedian)
+
+# the beat statistics per window (from windowStartMs on) as a table, all windows at once: the sums needed for the
+# statistics are collected per window with bincount
+def beatWindows(beatMs, ibis, windowStartMs, numberOfWindows, recordedMsPerWindow):
+    window = ((beatMs - windowStartMs) // (beatWindowS * 1000)).astype(np.int64)
+    # beats whose time falls outside the windows (extrapolated beyond the end of the session) are not counted
+    accepted = acceptedIbis(ibis) & (window >= 0) & (window < numberOfWindows)
+    acceptedWindow, acceptedIbi = window[accepted], ibis[accepted]
+    count = np.bincount(acceptedWindow, minlength=numberOfWindows)
+    total = np.bincount(acceptedWindow, weights=acceptedIbi, minlength=numberOfWindows)
+    squares = np.bincount(acceptedWindow, weights=acceptedIbi ** 2, minlength=numberOfWindows)
+    # the differences of successive IBIs if both are accepted, counted in the window of the second
+    successive = accepted[1:] & accepted[:-1]
+    differences = np.diff(ibis)[successive]
+    differenceWindow = window[1:][successive]
+    differenceCount = np.bincount(differenceWindow, minlength=numberOfWindows)
+    differenceSquares = np.bincount(differenceWindow, weights=differences ** 2, minlength=numberOfWindows)
+    over50 = np.bincount(differenceWindow, weights=np.abs(differences) > 50, minlength=numberOfWindows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanIbi = total / count
+        windows = pd.DataFrame({"MS-start": windowStartMs + beatWindowS * 1000 * np.arange(numberOfWindows), "beats": count, "bpm": 60000 / meanIbi,
+            "sdnn-ms": np.sqrt(np.maximum(squares / count - meanIbi ** 2, 0)), "rmssd-ms": np.sqrt(differenceSquares / differenceCount),
+            "pnn50": over50 / differenceCount, "quality": np.clip(np.where(recordedMsPerWindow > 0, total / recordedMsPerWindow, 0), 0, 1)})
+    windows["MS-end"] = windows["MS-start"] + beatWindowS * 1000
+    windows["artefact"] = windows["quality"] < beatMinQuality
+    return windows
+
+# the interactive report (--serve): a local HTTP server that serves the session as tiles, i.e., the buckets of one
+# pyramid level in a fixed time span (or, as level 0, the samples themselves), and a page that draws them with
+# Plotly and requests the tiles of the visible time range at the level that matches its width whenever it is panned
+# or zoomed, so that the browser never gets much more than a few points per pixel column
+tileBuckets = 1000 # buckets per tile of a pyramid level
+sampleTileMs = 60000 # time span of a tile of samples
+
+# values as a JSON list, with null for NaN
+def jsonValues(values, decimals):
+    return np.where(np.isnan(values), None, np.round(values, decimals)).tolist()
+
+# whether the samples of a time range can be read from a recording without parsing all of it: binary files are
+# memory-mapped, and uncompressed CSV files with an index are read from the data buffers in the range
+@functools.lru_cache(maxsize=None)
+def hasRandomAccess(recordingNumber):
+    return all([(isBinaryDataFile(fileName)) or ((not isCompressedFile(fileName)) and (readIndexFile(fileName) != None)) for fileName in recordingLimits[recordingNumber][0]])
+
+# the other recordings are parsed once (in their time limits) and kept for the following tiles
+@functools.lru_cache(maxsize=2)
+def parsedRecording(recordingNumber):
+    fileNames, fromMs, toMs = recordingLimits[recordingNumber]
+    return readRecording(fileNames, fromMs, toMs)
+
+# the samples of a recording in a time range (in ms, the end included)
+def recordingSamples(recordingNumber, rangeMs):
+    if (hasRandomAccess(recordingNumber)): return readRecording(recordingLimits[recordingNumber][0], rangeMs[0], rangeMs[1])
+    data = parsedRecording(recordingNumber)
+    ms = data["MS-timestamp"].to_numpy(dtype=np.int64)
+    return data[(ms >= rangeMs[0]) & (ms <= rangeMs[1])]
+
+# one tile as JSON: the times (in ms) and for each of PPG, BPM, and SpO2 the min, max, and mean per bucket or the
+# samples (only from the recordings that overlap the tile); only the data within the session's time limits is included
+@functools.lru_cache(maxsize=512)
+def reportTile(levelMs, index):
+    if (levelMs == 0):
+        rangeMs = [max(index * sampleTileMs, startTimeMs), min((index + 1) * sampleTileMs - 1, endTimeMs)]
+        overlapping = [recordingNumber for recordingNumber, recordingRangeMs in enumerate(recordingRangesMs) if (recordingRangeMs[0] <= rangeMs[1]) and (recordingRangeMs[1] >= rangeMs[0])]
+        dataParts = [data for data in [recordingSamples(recordingNumber, rangeMs) for recordingNumber in overlapping] if (len(data) > 0)]
+        if (len(dataParts) == 0): return json.dumps(dict(ms=[], PPG=[], BPM=[], SPO2=[])).encode('utf-8')
+        times, ppg, bpm, spo2 = chunkSamples(pd.concat(dataParts, ignore_index=True), None, samplesPerMs)
+        return json.dumps(dict(ms=jsonValues(times, 1), PPG=jsonValues(ppg, 0), BPM=jsonValues(bpm, 0), SPO2=jsonValues(spo2, 0))).encode('utf-8')
+    bucketMs, buckets = pyramidBuckets(pyramids, levelMs, [index * tileBuckets * levelMs, (index + 1) * tileBuckets * levelMs])
+    inLimits = (buckets['ms'] + levelMs > startTimeMs) & (buckets['ms'] <= endTimeMs)
+    tile = dict(ms=bucketMs.tolist())
+    for column in pyramidColumns:
+        counts = buckets[column + '-count']
+        valid = inLimits & (counts > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tile[column] = dict(min=jsonValues(np.where(valid, buckets[column + '-min'], np.nan), 0), max=jsonValues(np.where(valid, buckets[column + '-max'], np.nan), 0),
+                mean=jsonValues(np.where(valid, buckets[column + '-sum'] / counts, np.nan), 2))
+    return json.dumps(tile).encode('utf-8')
+
+reportPage = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Pulse Oximeter Data Trace</title>
+<script src="plotly.min.js"></script>
+<style>
+body { margin: 0; font-family: Helvetica, sans-serif; }
+#title { text-align: center; font-size: 22px; margin: 12px; }
+#graph { width: 100%; height: 80vh; }
+#status { text-align: center; font-size: 14px; color: gray; }
+</style>
+</head>
+<body>
+<div id="title"></div>
+<div id="graph"></div>
+<div id="status"></div>
+<script>
+const graph = document.getElementById("graph");
+const statusLine = document.getElementById("status");
+const columns = [["BPM", "BPM", "rgb(0,100,80)", "rgba(0,100,80,0.25)", 2, "y2"], ["SPO2", "SpO₂", "rgb(49,130,189)", "rgba(49,130,189,0.25)", 2, "y2"],
+    ["PPG", "PPG", "black", "rgba(0,0,0,0.2)", 1, "y"]];
+let info = null;
+let tiles = new Map(); // the requested tiles (as promises) by level and index
+let latestView = 0; // views whose tiles arrive after a newer view was requested are not drawn
+
+// Plotly takes numbers on a date axis as ms since 1970 (in UTC), which epochMs maps the ESP32 timestamps to
+function axisMs(ms) { return info.epochMs + ms; }
+function timestampMs(value) { return ((typeof value == "number") ? value : Date.parse(value.replace(" ", "T") + "Z")) - info.epochMs; }
+
+// the samples (level 0) if even the finest pyramid level is coarser than a pixel column, otherwise the coarsest
+// level whose buckets are not wider than a pixel column
+function tileLevel(fromMs, toMs) {
+    const msPerColumn = (toMs - fromMs) / graph.clientWidth;
+    let level = 0;
+    for (const levelMs of info.levelsMs) if (levelMs <= msPerColumn) level = levelMs;
+    return level;
+}
+
+function loadTile(level, index) {
+    const key = level + "/" + index;
+    if (tiles.size > 1000) tiles = new Map();
+    if (!tiles.has(key)) tiles.set(key, fetch("tile?level=" + level + "&index=" + index).then(response => response.json()));
+    return tiles.get(key);
+}
+
+// the traces of the tiles: the samples, or the range of the values per bucket as a band with the mean as a line
+function traces(level, parts) {
+    const x = parts.flatMap(part => part.ms.map(axisMs));
+    const result = [];
+    for (const [column, name, color, fillColor, width, yaxis] of columns) {
+        if (level == 0) {
+            result.push({x: x, y: parts.flatMap(part => part[column]), mode: "lines", name: name, line: {color: color, width: width}, yaxis: yaxis});
+            continue;
+        }
+        result.push({x: x, y: parts.flatMap(part => part[column].min), mode: "lines", name: name + " min", line: {width: 0}, yaxis: yaxis});
+        result.push({x: x, y: parts.flatMap(part => part[column].max), mode: "lines", name: name + " max", line: {width: 0}, fill: "tonexty", fillcolor: fillColor, yaxis: yaxis});
+        result.push({x: x, y: parts.flatMap(part => part[column].mean), mode: "lines", name: name + " mean", line: {color: color, width: width}, yaxis: yaxis});
+    }
+    return result;
+}
+
+function layout(fromMs, toMs) {
+    return {
+        margin: {l: 80, r: 80, b: 40, t: 20, pad: 4},
+        font: {color: "rgb(0,0,0)", size: 16, family: "Helvetica"},
+        showlegend: false,
+        xaxis: {type: "date", range: [axisMs(fromMs), axisMs(toMs)]},
+        yaxis: {title: {text: "PPG (black)"}, range: [0, 100], fixedrange: true},
+        yaxis2: {title: {text: "BPM (green), SpO₂ (blue)"}, overlaying: "y", side: "right", range: info.bpmSpo2Range, fixedrange: true},
+    };
+}
+
+// draw a time range with the tiles that cover it (and one more on each side for panning)
+async function showView(fromMs, toMs) {
+    const view = ++latestView;
+    const level = tileLevel(fromMs, toMs);
+    const tileMs = (level == 0) ? info.sampleTileMs : level * info.tileBuckets;
+    const first = Math.max(Math.floor(Math.max(fromMs, info.startMs) / tileMs) - 1, 0);
+    const last = Math.floor(Math.min(toMs, info.endMs) / tileMs) + 1;
+    statusLine.textContent = "loading...";
+    const parts = await Promise.all(Array.from({length: last - first + 1}, (_, i) => loadTile(level, first + i)));
+    if (view != latestView) return;
+    await Plotly.react(graph, traces(level, parts), layout(fromMs, toMs), {scrollZoom: true, displaylogo: false, responsive: true});
+    statusLine.textContent = (level == 0) ? "all samples" : "range and mean of the values per " + (level / 1000) + "s";
+}
+
+fetch("info").then(response => response.json()).then(sessionInfo => {
+    info = sessionInfo;
+    document.getElementById("title").textContent = info.title;
+    showView(info.startMs, info.endMs).then(() => graph.on("plotly_relayout", event => {
+        if ("xaxis.range[0]" in event) showView(timestampMs(event["xaxis.range[0]"]), timestampMs(event["xaxis.range[1]"]));
+        else if ("xaxis.autorange" in event) showView(info.startMs, info.endMs);
+    }));
+});
+</script>
+</body>
+</html>
+"""
+
+class ReportRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if (url.path == "/"):
+            body, contentType = reportPage.encode('utf-8'), "text/html; charset=utf-8"
+        elif (url.path == "/plotly.min.js"):
+            body, contentType = plotlyJs, "text/javascript; charset=utf-8"
+        elif (url.path == "/info"):
+            body, contentType = json.dumps(reportInfo).encode('utf-8'), "application/json"
+        elif (url.path == "/tile") and ("level" in query) and ("index" in query) and (query["level"][0] in ["0"] + [str(levelMs) for levelMs in pyramidLevelsMs]) and (query["index"][0].isdigit()):
+            with tileLock:
+                body, contentType = reportTile(int(query["level"][0]), int(query["index"][0])), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # keep the tile requests out of the output
+        pass
+
+tileLock = threading.Lock()
+
+filenameExtension = args.description
+reportSections = parseSections(args.sections)
+smoothing = parseSmoothing(args.smoothing)
+if (args.stream) and (args.backend != "matplotlib"):
+    print("The streaming mode writes the pages with matplotlib")
+    args.backend = "matplotlib"
 print("filenameExtension: " + filenameExtension)
-dataFileNames = sys.argv[2:]
-dataFileName = dataFileNames[0]
-oximeterData = []
-emptyEntry = {}
-needToRemoveInitial127BPM = True
+stages = StageTimer(args.profile != None, args.profilePage)
+stages.enter("parse")
+recordings = findRecordings(args.files)
+reportFileName = recordings[0][0]
+dataFileName = None # the first file with data in the requested time range
+dataParts = [] # the data of all files, merged into one timeline once all files are read
+pyramids = [] # the summary pyramids of all recordings, for the coarse graphs
+recordingLimits = [] # streaming mode and interactive report: the recordings with data and their time limits, read again for the detailed graphs
+recordingTotals = [] # streaming mode and interactive report: the totals of the recordings' pyramids in the time limits
+recordingRangesMs = [] # streaming mode and interactive report: the first and last timestamp of the recordings in the time limits
 bpmMax = 0
 bpmMin = 255
 spo2Max = 0
@@ -51,116 +1386,102 @@ spo2Min = 255
 ppgMax = 0
 ppgMin = 255
 
-# parse main data file
-with open(dataFileName, 'r', encoding='utf-8') as csvfile:
-    print("Parsing main input file " + dataFileName)
-    dataReader = csv.reader(csvfile, delimiter=',', quotechar='"')
-    headers = next(dataReader)[0:]
-    for row in dataReader:
-        # newEntry = {key: str(value) for key, value in zip(headers, row[0:])}
-        newEntry = {}
-        for key, value in zip(headers, row[0:]):
-            if value == '':
-                newEntry[key] = None
-            else:
-                newEntry[key] = int(value)
-        # remove the initial 127 values for BPM
-        if (newEntry["BPM"] != None) and (newEntry["BPM"] != 127): needToRemoveInitial127BPM = False
-        if (needToRemoveInitial127BPM): newEntry["BPM"] = None
-        # add the value to the list
-        oximeterData.append(newEntry)
-        #  determine the ranges
-        if (newEntry["BPM"] != None):
-            bpm = newEntry["BPM"]
-            if (bpm > bpmMax): bpmMax = bpm
-            if (bpm < bpmMin): bpmMin = bpm
-        if (newEntry["SPO2"] != None):
-            spo2 = newEntry["SPO2"]
-            if (spo2 > spo2Max): spo2Max = spo2
-            if (spo2 < spo2Min): spo2Min = spo2
-        if (newEntry["PPG"] != None):
-            ppg = newEntry["PPG"]
-            if (ppg > ppgMax): ppgMax = ppg
-            if (ppg < ppgMin): ppgMin = ppg
-
-    csvfile.close()
-    emptyEntry = {key: None for key, value in zip(headers, row[0:])}
-
-numberOfSamples = len(oximeterData)
-startTimeMs = int(oximeterData[0]["MS-timestamp"])
-endTimeMs = int(oximeterData[numberOfSamples - 1]["MS-timestamp"])
-durationMs = endTimeMs - startTimeMs
-samplesPerMs = numberOfSamples / durationMs
-print("samples per ms (first file): " + "{:.5f}".format(samplesPerMs))
+# the time limits, in the ms timestamp basis that all recordings of the session share; wall-clock times are resolved
+# once against the earliest recording, so that a range across the start of a later recording is not moved a day ahead
+firstRecordingFileName = min([segmentFileNames[0] for segmentFileNames in recordings], key=fileStartTime)
+fromMs, toMs = parseTimeLimit(args.fromTime, firstRecordingFileName), parseTimeLimit(args.toTime, firstRecordingFileName)
 
-# parse additional data files
-for additionalFileName in dataFileNames[1:]:
-    print("Parsing additional input file " + additionalFileName)
+# parse all data files
+for segmentFileNames in recordings:
+    inputFileName = segmentFileNames[0]
+    segmentsText = "" if (len(segmentFileNames) == 1) else " (and " + str(len(segmentFileNames) - 1) + " further segments)"
+    if (dataFileName == None): print("Parsing main input file " + inputFileName + segmentsText)
+    else: print("Parsing additional input file " + inputFileName + segmentsText)
+    if (args.stream) or (args.serve != None):
+        # only the summary pyramid is read here, the samples are read again page by page (or tile by tile)
+        stages.enter("pyramids")
+        filePyramid = readPyramid(segmentFileNames)
+        stages.enter("parse")
+        if (filePyramid["samples"] > 0):
+            rangeMs = [filePyramid["first"] if (fromMs == None) else max(filePyramid["first"], fromMs), filePyramid["last"] if (toMs == None) else min(filePyramid["last"], toMs)]
+            totals = pyramidTotals(filePyramid, [rangeMs[0], rangeMs[1] + 1])
+        if (filePyramid["samples"] == 0) or (rangeMs[0] > rangeMs[1]) or (totals['samples'] == 0):
+            print("No data in the requested time range in " + inputFileName)
+            continue
+        if (totals['BPM-count'] > 0):
+            bpmMax = max(bpmMax, int(totals['BPM-max']))
+            bpmMin = min(bpmMin, int(totals['BPM-min']))
+        if (totals['SPO2-count'] > 0):
+            spo2Max = max(spo2Max, int(totals['SPO2-max']))
+            spo2Min = min(spo2Min, int(totals['SPO2-min']))
+        if (totals['PPG-count'] > 0):
+            ppgMax = max(ppgMax, int(totals['PPG-max']))
+            ppgMin = min(ppgMin, int(totals['PPG-min']))
+        if (dataFileName == None): dataFileName = inputFileName
+        pyramids.append(filePyramid)
+        recordingLimits.append((segmentFileNames, fromMs, toMs))
+        recordingTotals.append(totals)
+        recordingRangesMs.append(rangeMs)
+        continue
+    fileOximeterData = readRecording(segmentFileNames, fromMs, toMs)
+    if (len(fileOximeterData) == 0):
+        print("No data in the requested time range in " + inputFileName)
+        continue
 
-    # first, actually parse the file
-    needToRemoveInitial127BPM = True
-    additionalOximeterData = []
-    with open(additionalFileName, 'r', encoding='utf-8') as csvfile:
-        dataReader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        headers = next(dataReader)[0:]
-        for row in dataReader:
-            # newEntry = {key: str(value) for key, value in zip(headers, row[0:])}
-            newEntry = {}
-            for key, value in zip(headers, row[0:]):
-                if value == '':
-                    newEntry[key] = None
-                else:
-                    newEntry[key] = int(value)
-            # remove the initial 127 values for BPM
-            if (newEntry["BPM"] != None) and (newEntry["BPM"] != 127): needToRemoveInitial127BPM = False
-            if (needToRemoveInitial127BPM): newEntry["BPM"] = None
-            # add the value to the list
-            additionalOximeterData.append(newEntry)
-            #  determine the ranges
-            if (newEntry["BPM"] != None):
-                bpm = newEntry["BPM"]
-                if (bpm > bpmMax): bpmMax = bpm
-                if (bpm < bpmMin): bpmMin = bpm
-            if (newEntry["SPO2"] != None):
-                spo2 = newEntry["SPO2"]
-                if (spo2 > spo2Max): spo2Max = spo2
-                if (spo2 < spo2Min): spo2Min = spo2
-            if (newEntry["PPG"] != None):
-                ppg = newEntry["PPG"]
-                if (ppg > ppgMax): ppgMax = ppg
-                if (ppg < ppgMin): ppgMin = ppg
+    #  determine the ranges
+    if (fileOximeterData.BPM.notna().any()):
+        bpmMax = max(bpmMax, int(fileOximeterData.BPM.max()))
+        bpmMin = min(bpmMin, int(fileOximeterData.BPM.min()))
+    if (fileOximeterData.SPO2.notna().any()):
+        spo2Max = max(spo2Max, int(fileOximeterData.SPO2.max()))
+        spo2Min = min(spo2Min, int(fileOximeterData.SPO2.min()))
+    if (fileOximeterData.PPG.notna().any()):
+        ppgMax = max(ppgMax, int(fileOximeterData.PPG.max()))
+        ppgMin = min(ppgMin, int(fileOximeterData.PPG.min()))
 
-        csvfile.close()
-    
-    # determine how many empty entries we need as a buffer to maintain the flow of time
-    startTimeAdditionalMs = int(additionalOximeterData[0]["MS-timestamp"])
-    gapDurationMs = startTimeAdditionalMs - endTimeMs
-    print("The interruption lasted " + str(gapDurationMs) + " ms.")
-    neededNumberOfSamples = round(gapDurationMs * samplesPerMs)
-    print("We thus add " + str(neededNumberOfSamples) + " empty samples in the break.")
-    endTimeMs = int(additionalOximeterData[len(additionalOximeterData) - 1]["MS-timestamp"])
-    durationMs = endTimeMs - startTimeMs
-    numberOfSamples = numberOfSamples + neededNumberOfSamples + len(additionalOximeterData)
-    samplesPerMs = numberOfSamples / durationMs
-    # print("samples per ms (break): " + "{:.5f}".format(neededNumberOfSamples / gapDurationMs))
-    # print("samples per ms (additional): " + "{:.5f}".format(len(additionalOximeterData) / (endTimeMs - int(additionalOximeterData[0]["MS-timestamp"]))))
-    print("samples per ms (updated): " + "{:.5f}".format(samplesPerMs))
-
-    # then add the buffer to the main data list
-    for i in range(0, neededNumberOfSamples):
-        oximeterData.append(emptyEntry)
-
-    # then add the new entries to the main data list
-    for entry in additionalOximeterData:
-        oximeterData.append(entry)
-
-# determine the numbers for the combined file
-numberOfSamples = len(oximeterData)
-startDate = dataFileName.split(".")[0].split("-")[1]
-startTimeStamp = dataFileName.split(".")[0].split("-")[2]
-startTimeStampMs = int(dataFileName.split(".")[0].split("-")[3])
-startTimeMs = int(oximeterData[0]["MS-timestamp"])
-endTimeMs = int(oximeterData[numberOfSamples - 1]["MS-timestamp"])
+    if (dataFileName == None): dataFileName = inputFileName
+    dataParts.append(fileOximeterData)
+    stages.enter("pyramids")
+    pyramids.append(readPyramid(segmentFileNames, fileOximeterData if (args.fromTime == None) and (args.toTime == None) else None))
+    stages.enter("parse")
+
+if (dataFileName == None):
+    print("No data to visualize.")
+    sys.exit()
+
+# determine the numbers for the combined file; in the streaming mode and for the interactive report from the
+# pyramids, with the number of samples (including the empty samples during interruptions) estimated from the
+# average sample rate of the recordings
+if (args.stream) or (args.serve != None):
+    stages.enter("statistics")
+    timeMs = None
+    startTimeMs = min([rangeMs[0] for rangeMs in recordingRangesMs])
+    endTimeMs = max([rangeMs[1] for rangeMs in recordingRangesMs])
+    recordedMs = sum([pyramid["recordedMs"] for pyramid in pyramids])
+    interruptions = sum([pyramid["interruptions"] for pyramid in pyramids]) + sum([nextRangeMs[0] - rangeMs[1] > interruptionMs for rangeMs, nextRangeMs in zip(recordingRangesMs, recordingRangesMs[1:])])
+    samplesPerMs = sum([pyramid["samples"] for pyramid in pyramids]) / recordedMs if (recordedMs > 0) else 0.1
+    numberOfSamples = round((endTimeMs - startTimeMs) * samplesPerMs)
+    sessionTotals = bucketTotals(np.array(recordingTotals, dtype=pyramidDtype))
+    spo2Mean = sessionTotals['SPO2-sum'] / sessionTotals['SPO2-count'] if (sessionTotals['SPO2-count'] > 0) else np.nan
+    bpmMean = sessionTotals['BPM-sum'] / sessionTotals['BPM-count'] if (sessionTotals['BPM-count'] > 0) else np.nan
+else:
+    stages.enter("merge")
+    oximeterData, timeMs = mergeData(dataParts)
+    stages.enter("statistics")
+    numberOfSamples = len(oximeterData)
+    startTimeMs = int(oximeterData["MS-timestamp"].iloc[0])
+    endTimeMs = int(oximeterData["MS-timestamp"].iloc[-1])
+    steps = np.diff(oximeterData["MS-timestamp"].dropna().to_numpy(dtype=np.int64))
+    recordedMs = int(np.sum(steps[steps <= interruptionMs]))
+    interruptions = int(np.sum(steps > interruptionMs))
+    spo2Mean = oximeterData.SPO2.mean()
+    bpmMean = oximeterData.BPM.mean()
+    ppgValues = floatValues(oximeterData.PPG)
+    bpmValues = floatValues(oximeterData.BPM)
+    spo2Values = floatValues(oximeterData.SPO2)
+fileStartDateTime, startTimeStampMs = fileStartTime(dataFileName)
+startDate = fileStartDateTime.strftime("%Y%m%d")
+startTimeStamp = fileStartDateTime.strftime("%H%M%S")
 durationMs = endTimeMs - startTimeMs
 durationS = durationMs / 1000
 durationMin = durationS / 60
@@ -171,7 +1492,6 @@ startTimeStampFormatted = startTimeStamp[:2] + ':' + startTimeStamp[2:4]+ ':' +
 startOffsetMs = startTimeMs - startTimeStampMs
 startDateTime = datetime.strptime(startDateFormatted + " " + startTimeStampFormatted, '%Y/%m/%d %H:%M:%S') + timedelta(milliseconds=startOffsetMs)  
 endDateTime = startDateTime + timedelta(milliseconds=durationMs)
-df = pd.DataFrame(oximeterData)
 
 print("read " + str(numberOfSamples) + " samples")
 print("start date: " + startDate)
@@ -194,10 +1514,97 @@ print("min. BPM: " + str(bpmMin))
 print("max. PPG: " + str(ppgMax))
 print("min. PPG: " + str(ppgMin))
 
-# create the PDF output target
-merger = PdfFileMerger(strict=False)
+# the events and their numbers, with the oxygen desaturation index (desaturations per hour of recorded data)
+if (args.events != None):
+    stages.enter("events")
+    events = detectEvents(pyramids, [startTimeMs, endTimeMs + 1])
+    eventCounts = {event: int(np.sum(events.event == event)) for event in ["desaturation", "bradycardia", "tachycardia"]}
+    odi = eventCounts["desaturation"] / (recordedMs / 3600000) if (recordedMs > 0) else 0
+    print("events: " + ", ".join([str(count) + " " + event for event, count in eventCounts.items()]) + ", ODI: " + "{:.1f}".format(odi))
+    events["start"] = graphTimes(startDateTime, events["MS-start"].to_numpy() - startTimeMs)
+    events["end"] = graphTimes(startDateTime, events["MS-end"].to_numpy() - startTimeMs)
+    if (args.events.endswith(".json")): events[eventColumns].to_json(args.events, orient="records", date_format="iso", double_precision=1, indent=1)
+    else: events[eventColumns].to_csv(args.events, index=False, float_format="%.1f")
+    print("wrote " + str(len(events)) + " events to " + args.events)
+
+# the beats in the PPG waveform, an hour of samples at a time, and their statistics per window
+if (args.beats != None):
+    stages.enter("beats")
+    print("analyzing the beats in the PPG" + ("" if (scipy != None) else " (without scipy, with moving averages as the filter)"))
+    beatStartTime = time.perf_counter()
+    piecePlan = planGraphs([(beatPieceMs / 60000, "samples")], startTimeMs, durationMs + 1, timeMs)[0]
+    if (args.stream): pieceSamples = sampleWindows(streamSamples(recordingLimits, samplesPerMs), piecePlan["rangesMs"])
+    else: pieceSamples = ([timeMs[start:end], ppgValues[start:end]] for start, end in piecePlan["samples"])
+    numberOfWindows = math.ceil((durationMs + 1) / (beatWindowS * 1000))
+    recordedMsPerWindow = np.zeros(numberOfWindows)
+    beatParts = []
+    for samples in pieceSamples:
+        pieceTimeMs, ppg = samples[0], samples[1]
+        beatParts.append(ppgBeats(pieceTimeMs, ppg, samplesPerSecond))
+        sampleWindow = ((pieceTimeMs[~np.isnan(ppg)] - startTimeMs) // (beatWindowS * 1000)).astype(np.int64)
+        recordedMsPerWindow += np.bincount(sampleWindow, minlength=numberOfWindows)[:numberOfWindows] * 1000 / samplesPerSecond
+    beatMs = np.concatenate([beats for beats, ibis in beatParts] + [np.zeros(0)])
+    beatWindowsTable = beatWindows(beatMs, np.concatenate([ibis for beats, ibis in beatParts] + [np.zeros(0)]), startTimeMs, numberOfWindows, recordedMsPerWindow)
+    beatWindowsTable = beatWindowsTable[recordedMsPerWindow > 0].reset_index(drop=True)
+    goodWindows = beatWindowsTable[~beatWindowsTable.artefact]
+    beatSummary = dict(beats=int(beatWindowsTable.beats.sum()), beatBpm=goodWindows.bpm.mean(), sdnnMs=goodWindows["sdnn-ms"].mean(), rmssdMs=goodWindows["rmssd-ms"].mean(),
+        pnn50=goodWindows.pnn50.mean(), goodWindows=len(goodWindows) / max(len(beatWindowsTable), 1))
+    print("beats: " + str(beatSummary["beats"]) + " in " + "{:.2f}".format(time.perf_counter() - beatStartTime) + "s, " + "{:.1%}".format(beatSummary["goodWindows"]) +
+        " of the windows with good signal quality, BPM: " + "{:.1f}".format(beatSummary["beatBpm"]) + ", SDNN: " + "{:.1f}".format(beatSummary["sdnnMs"]) + "ms, RMSSD: " + "{:.1f}".format(beatSummary["rmssdMs"]) + "ms")
+    beatWindowsTable["start"] = graphTimes(startDateTime, beatWindowsTable["MS-start"].to_numpy() - startTimeMs)
+    beatWindowsTable["end"] = graphTimes(startDateTime, beatWindowsTable["MS-end"].to_numpy() - startTimeMs)
+    if (args.beats.endswith(".json")): beatWindowsTable[beatColumns].to_json(args.beats, orient="records", date_format="iso", double_precision=3, indent=1)
+    else: beatWindowsTable[beatColumns].to_csv(args.beats, index=False, float_format="%.3f")
+    print("wrote " + str(len(beatWindowsTable)) + " windows to " + args.beats)
+
+# the numbers of the summary page (and the time lost in interruptions) for oximeter-batch-visualization.py
+if (args.summary != None):
+    summary = dict(start=startDateTime.isoformat(sep=" "), end=endDateTime.isoformat(sep=" "), durationS=durationS, samples=numberOfSamples, samplesPerSecond=samplesPerSecond,
+        spo2Min=spo2Min, spo2Max=spo2Max, spo2Mean=None if (pd.isna(spo2Mean)) else float(spo2Mean), bpmMin=bpmMin, bpmMax=bpmMax, bpmMean=None if (pd.isna(bpmMean)) else float(bpmMean),
+        ppgMin=ppgMin, ppgMax=ppgMax, gapS=max(durationMs - recordedMs, 0) / 1000, interruptions=int(interruptions))
+    if (args.events != None): summary.update(desaturations=eventCounts["desaturation"], odi=odi, bradycardia=eventCounts["bradycardia"], tachycardia=eventCounts["tachycardia"])
+    if (args.beats != None): summary.update({key: None if (pd.isna(value)) else value for key, value in beatSummary.items()})
+    with open(args.summary, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+        f.close()
+
+spo2LowValue = 90
+if (spo2Min < spo2LowValue): spo2LowValue = spo2Min
+bpmLowValue = 55
+if (bpmMin < bpmLowValue): bpmLowValue = bpmMin
+bpmHighValue = 120
+if (bpmMax > bpmHighValue): bpmHighValue = bpmMax
+bpmSpo2LowValue = 55
+if (bpmMin < bpmSpo2LowValue): bpmSpo2LowValue = bpmMin
+if (spo2Min < bpmSpo2LowValue): bpmSpo2LowValue = spo2Min
+bpmSpo2HighValue = bpmHighValue
+
+# the interactive report: serve it until the server is stopped
+if (args.serve != None):
+    reportInfo = dict(title="Pulse Oximeter Data Trace " + filenameExtension + " from " + startDateTime.strftime("%Y/%m/%d, %H:%M:%S") + " to " + endDateTime.strftime("%Y/%m/%d, %H:%M:%S"),
+        startMs=startTimeMs, endMs=endTimeMs, epochMs=(startDateTime - datetime(1970, 1, 1)) / timedelta(milliseconds=1) - startTimeMs,
+        levelsMs=pyramidLevelsMs, tileBuckets=tileBuckets, sampleTileMs=sampleTileMs, bpmSpo2Range=[bpmSpo2LowValue, bpmSpo2HighValue])
+    plotlyJs = py.get_plotlyjs().encode('utf-8')
+    server = http.server.ThreadingHTTPServer(("localhost", args.serve), ReportRequestHandler)
+    print("serving the interactive report on http://localhost:" + str(args.serve) + "/ (stop with Ctrl-C)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit()
+
+# the figures of all pages (as dicts), rendered once all of them are prepared, or in the streaming mode the report,
+# into which each page is drawn right away
+reportPdfFileName = os.path.join(os.path.dirname(reportFileName), os.path.basename(reportFileName).split(".")[0]) + "-" + filenameExtension + ".pdf"
+if (args.stream):
+    print("rendering the pages and writing them to " + reportPdfFileName + " as they are prepared")
+    renderStartTime = time.perf_counter()
+    pages = StreamingReport(reportPdfFileName)
+else:
+    pages = []
 
 # overall title slide
+stages.enter("figures")
 data = []
 layout = go.Layout(
     width=2000,
@@ -211,11 +1618,7 @@ layout = go.Layout(
     xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
     yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
 )
-fig = go.Figure(data=data, layout=layout)
-pdf_file = io.BytesIO()
-pio.write_image(fig, pdf_file, 'pdf')
-pdf_file.seek(0)
-merger.append(pdf_file)
+pages.append(go.Figure(data=data, layout=layout).to_dict())
 
 # data summary slide
 data = []
@@ -227,9 +1630,9 @@ layout = go.Layout(
     showlegend=False,
     title=dict(
         text = "oxygen saturation level (SpO₂) value range: " + str(spo2Min) + "%–" + str(spo2Max) + "%" +
-            ", mean: {:.1f}".format(df.SPO2.mean(axis = 0)) + "%<br>" +
+            ", mean: {:.1f}".format(spo2Mean) + "%<br>" +
             "     heart rate (beats per minute, BPM) value range: " + str(bpmMin) + "–" + str(bpmMax) + 
-            ", mean: {:.1f}".format(df.BPM.mean(axis = 0)) + "<br>" +
+            ", mean: {:.1f}".format(bpmMean) + "<br>" +
             "photoplethysmograph (PPG) value range: " + str(ppgMin) + "–" + str(ppgMax) + "<br>" +
             "data trace duration: " + 
             "{:.2f}".format(durationH) + "h ＝ " +
@@ -241,343 +1644,204 @@ layout = go.Layout(
     xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
     yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
 )
-fig = go.Figure(data=data, layout=layout)
-pdf_file = io.BytesIO()
-pio.write_image(fig, pdf_file, 'pdf')
-pdf_file.seek(0)
-merger.append(pdf_file)
-
-# write the coarse graphs
-print("writing very coarse, averaged BPM and SPO2 graphs")
-valuesToAverage = 200 # 100 is about 1 second
-timeSectionToGraphMin = 60
-detailGraphsToWrite = math.ceil(numberOfSamples / samplesPerSecond / 60 / timeSectionToGraphMin)
-
-# title slide
-data = []
-layout = go.Layout(
-    width=2000,
-    height=350,
-    margin=dict(l=80, r=80, b=40, t=20, pad=4),
-    font=dict(color='rgb(0,0,0)', size=40, family='Helvetica'),
-    showlegend=False,
-    title=dict(text = "Coarse, Averaged SpO₂ and BPM Graphs<br>" +
-        "(" + str(valuesToAverage) + " sample averaging window, " + str(timeSectionToGraphMin) + " minutes per graph)",
-        x = 0.5, y = 0.57, xanchor = 'center', yanchor = 'middle'),
-    xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-    yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-)
-fig = go.Figure(data=data, layout=layout)
-pdf_file = io.BytesIO()
-pio.write_image(fig, pdf_file, 'pdf')
-pdf_file.seek(0)
-merger.append(pdf_file)
-
-# data slides
-for detailGraph in range(0, detailGraphsToWrite):
-    print("creating graph: " + str(detailGraph+1) + "/" + str(detailGraphsToWrite))
-    timeOffsetS = detailGraph * timeSectionToGraphMin * 60
-    samplesOffset = round(timeOffsetS * samplesPerSecond)
-    # print("samplesOffset: " + str(samplesOffset))
-    timeSectionToGraphMs = timeSectionToGraphMin * 60 * 1000
-    sampleSizeToGraph = round(numberOfSamples * timeSectionToGraphMs / durationMs)
-    # print("samples in subset: " + str(sampleSizeToGraph))
-
-    timeSequence = []
-    for i in range(samplesOffset, sampleSizeToGraph + samplesOffset):
-        millisecondsTick = timeSectionToGraphMs * i / sampleSizeToGraph
-        timeSequence.append(startDateTime + timedelta(milliseconds=millisecondsTick))
-
-    oximeterDataSubset = []
-    if (sampleSizeToGraph+samplesOffset <= numberOfSamples): # if we are well before the end, all is fine
-        oximeterDataSubset = oximeterData[samplesOffset:sampleSizeToGraph+samplesOffset]
-    else: # otherwise we have to make sure that we do not access data that does not exist, and fill it up with empty values
-        oximeterDataSubset = oximeterData[samplesOffset:numberOfSamples]
-        for i in range(0, sampleSizeToGraph+samplesOffset - numberOfSamples):
-            oximeterDataSubset.append(emptyEntry)
-
-    # print("samples in subset: " + str(len(oximeterDataSubset)))
-    ppgDataSubset = []
-    bpmDataSubset = []
-    spo2DataSubset = []
-    for i in range(0, sampleSizeToGraph):
-        # if oximeterDataSubset[i]['PPG'] == '': ppgDataSubset.append(None)
-        # else: ppgDataSubset.append(int(oximeterDataSubset[i]['PPG']))
-        bpmDataSubset.append(oximeterDataSubset[i]['BPM'])
-        spo2DataSubset.append(oximeterDataSubset[i]['SPO2'])
-    
-    # print("averaging values")
-    dfBpm = pd.DataFrame(bpmDataSubset)
-    dfBpm['MA'] = dfBpm.rolling(valuesToAverage, center = True).mean()
-    dfSpo2 = pd.DataFrame(spo2DataSubset)
-    dfSpo2['MA'] = dfSpo2.rolling(valuesToAverage, center = True).mean()
-
-    # print("preparing plot")
-    data = [
-        # go.Scatter(
-        #     x=timeSequence,
-        #     y=bpmDataSubset,
-        #     mode='lines',
-        #     name='BPM',
-        #     line=dict(color='rgb(0,100,80)', width=0.5),
-        #     yaxis='y2',
-        # ),
-        # go.Scatter(
-        #     x=timeSequence,
-        #     y=spo2DataSubset,
-        #     mode='lines',
-        #     name='SPO₂',
-        #     line=dict(color='rgb(49,130,189)', width=0.5),
-        #     yaxis='y1',
-        # ),
-        go.Scatter(
-            x=timeSequence,
-            y=dfBpm.MA,
-            mode='lines',
-            name='BPM',
-            line=dict(color='rgb(0,100,80)', width=2),
-            yaxis='y2',
-        ),
-        go.Scatter(
-            x=timeSequence,
-            y=dfSpo2.MA,
-            mode='lines',
-            name='SpO₂',
-            line=dict(color='rgb(49,130,189)', width=2),
-            yaxis='y1',
-        ),
-    ]
-    spo2LowValue = 90
-    if (spo2Min < spo2LowValue): spo2LowValue = spo2Min
-    bpmLowValue = 55
-    if (bpmMin < bpmLowValue): bpmLowValue = bpmMin
-    bpmHighValue = 120
-    if (bpmMax > bpmHighValue): bpmHighValue = bpmMax
+pages.append(go.Figure(data=data, layout=layout).to_dict())
+
+# event summary slide
+if (args.events != None):
+    data = []
     layout = go.Layout(
         width=2000,
         height=350,
         margin=dict(l=80, r=80, b=40, t=20, pad=4),
         font=dict(color='rgb(0,0,0)', size=25, family='Helvetica'),
         showlegend=False,
-        yaxis=dict(title='SpO₂ in % (blue)', range=[spo2LowValue, 100]),
-        yaxis2=dict(title='BPM (green)', overlaying='y', side='right', range=[bpmLowValue, bpmHighValue]),
-        # legend=dict(x=0.03, y=1.0, font=dict(size=20),bordercolor='rgb(0,0,0)',borderwidth=1),
+        title=dict(
+            text = "desaturations (SpO₂ " + str(desaturationDropPercent) + "% or more below the mean of the preceding " + str(baselineWindowS) + "s): " + str(eventCounts["desaturation"]) +
+                "<br>oxygen desaturation index (ODI): {:.1f}".format(odi) + " per hour of recorded data<br>" +
+                "bradycardia (BPM below " + str(bradycardiaBpm) + "): " + str(eventCounts["bradycardia"]) +
+                "     tachycardia (BPM above " + str(tachycardiaBpm) + "): " + str(eventCounts["tachycardia"]) + "<br>" +
+                "(events of at least " + str(eventMinS) + "s, the detailed graphs only show the events)",
+            x = 0.5, y = 0.72, xanchor = 'center', yanchor = 'middle'),
+        xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
+        yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
     )
-    # print("creating figure")
-    fig = go.Figure(data=data, layout=layout)
-    # print("getting stream")
-    pdf_file = io.BytesIO()
-    # print("writing image")
-    pio.write_image(fig, pdf_file, 'pdf')
-    # print("seeking")
-    pdf_file.seek(0)
-    # print("appending PDF")
-    merger.append(pdf_file)
-
-# write the coarse graphs
-print("writing coarse BPM and SPO2 graphs")
-timeSectionToGraphMin = 10
-detailGraphsToWrite = math.ceil(numberOfSamples / samplesPerSecond / 60 / timeSectionToGraphMin)
-
-# title slide
-data = []
-layout = go.Layout(
-    width=2000,
-    height=350,
-    margin=dict(l=80, r=80, b=40, t=20, pad=4),
-    font=dict(color='rgb(0,0,0)', size=40, family='Helvetica'),
-    showlegend=False,
-    title=dict(text = "Coarse SpO₂ and BPM Graphs<br>(" + str(timeSectionToGraphMin) + " minutes per graph)",
-        x = 0.5, y = 0.57, xanchor = 'center', yanchor = 'middle'),
-    xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-    yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-)
-fig = go.Figure(data=data, layout=layout)
-pdf_file = io.BytesIO()
-pio.write_image(fig, pdf_file, 'pdf')
-pdf_file.seek(0)
-merger.append(pdf_file)
-
-# data slides
-for detailGraph in range(0, detailGraphsToWrite):
-    print("creating graph: " + str(detailGraph+1) + "/" + str(detailGraphsToWrite))
-    timeOffsetS = detailGraph * timeSectionToGraphMin * 60
-    samplesOffset = round(timeOffsetS * samplesPerSecond)
-    # print("samplesOffset: " + str(samplesOffset))
-    timeSectionToGraphMs = timeSectionToGraphMin * 60 * 1000
-    sampleSizeToGraph = round(numberOfSamples * timeSectionToGraphMs / durationMs)
-    # print("samples in subset: " + str(sampleSizeToGraph))
-
-    timeSequence = []
-    for i in range(samplesOffset, sampleSizeToGraph + samplesOffset):
-        millisecondsTick = timeSectionToGraphMs * i / sampleSizeToGraph
-        timeSequence.append(startDateTime + timedelta(milliseconds=millisecondsTick))
-
-    oximeterDataSubset = []
-    if (sampleSizeToGraph+samplesOffset <= numberOfSamples): # if we are well before the end, all is fine
-        oximeterDataSubset = oximeterData[samplesOffset:sampleSizeToGraph+samplesOffset]
-    else: # otherwise we have to make sure that we do not access data that does not exist, and fill it up with empty values
-        oximeterDataSubset = oximeterData[samplesOffset:numberOfSamples]
-        for i in range(0, sampleSizeToGraph+samplesOffset - numberOfSamples):
-            oximeterDataSubset.append(emptyEntry)
-
-    # print("samples in subset: " + str(len(oximeterDataSubset)))
-    ppgDataSubset = []
-    bpmDataSubset = []
-    spo2DataSubset = []
-    for i in range(0, sampleSizeToGraph):
-        # if oximeterDataSubset[i]['PPG'] == '': ppgDataSubset.append(None)
-        # else: ppgDataSubset.append(int(oximeterDataSubset[i]['PPG']))
-        bpmDataSubset.append(oximeterDataSubset[i]['BPM'])
-        spo2DataSubset.append(oximeterDataSubset[i]['SPO2'])
-
-    data = [
-        go.Scatter(
-            x=timeSequence,
-            y=bpmDataSubset,
-            mode='lines',
-            name='BPM',
-            line=dict(color='rgb(0,100,80)', width=2),
-            yaxis='y2',
-        ),
-        go.Scatter(
-            x=timeSequence,
-            y=spo2DataSubset,
-            mode='lines',
-            name='SpO₂',
-            line=dict(color='rgb(49,130,189)', width=2),
-            yaxis='y1',
-        ),
-    ]
-    spo2LowValue = 90
-    if (spo2Min < spo2LowValue): spo2LowValue = spo2Min
-    bpmLowValue = 55
-    if (bpmMin < bpmLowValue): bpmLowValue = bpmMin
-    bpmHighValue = 120
-    if (bpmMax > bpmHighValue): bpmHighValue = bpmMax
+    pages.append(go.Figure(data=data, layout=layout).to_dict())
+
+# beat analysis slide
+if (args.beats != None):
+    data = []
     layout = go.Layout(
         width=2000,
         height=350,
         margin=dict(l=80, r=80, b=40, t=20, pad=4),
         font=dict(color='rgb(0,0,0)', size=25, family='Helvetica'),
         showlegend=False,
-        yaxis=dict(title='SpO₂ in % (blue)', range=[spo2LowValue, 100]),
-        yaxis2=dict(title='BPM (green)', overlaying='y', side='right', range=[bpmLowValue, bpmHighValue]),
+        title=dict(
+            text = "beats detected in the PPG: " + "{:,}".format(beatSummary["beats"]) + ", " + "{:.0%}".format(beatSummary["goodWindows"]) +
+                " of the " + "{:g}".format(beatWindowS / 60) + " minute windows with good signal quality (the others likely have artefacts)<br>" +
+                "heart rate from the beats: {:.1f}".format(beatSummary["beatBpm"]) + " BPM (oximeter: {:.1f}".format(bpmMean) + " BPM)<br>" +
+                "heart rate variability (mean of the windows with good signal quality): SDNN {:.1f}".format(beatSummary["sdnnMs"]) +
+                "ms, RMSSD {:.1f}".format(beatSummary["rmssdMs"]) + "ms, pNN50 {:.1%}".format(beatSummary["pnn50"]),
+            x = 0.5, y = 0.72, xanchor = 'center', yanchor = 'middle'),
+        xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
+        yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
+    )
+    pages.append(go.Figure(data=data, layout=layout).to_dict())
+
+# the graphs of all sections: their time ranges and the ranges of their samples in the timeline, planned in one go;
+# with --events, the detailed graphs only where they show an event
+graphPlans = planGraphs(reportSections, startTimeMs, durationMs, timeMs)
+if (args.events != None):
+    for plan in graphPlans:
+        if (plan["kind"] != "samples"): continue
+        withEvents = graphsWithEvents(plan["rangesMs"], events)
+        plan["rangesMs"] = plan["rangesMs"][withEvents]
+        if ("samples" in plan): plan["samples"] = plan["samples"][withEvents]
+
+# the layout of the graph pages, with SpO2 and BPM or (for the detailed graphs) PPG and both of them on two y axes
+def graphLayout(timeRange, kind):
+    layout = dict(
+        width=2000,
+        height=350,
+        margin=dict(l=80, r=80, b=40, t=20, pad=4),
+        font=dict(color='rgb(0,0,0)', size=25, family='Helvetica'),
+        showlegend=False,
         # legend=dict(x=0.03, y=1.0, font=dict(size=20),bordercolor='rgb(0,0,0)',borderwidth=1),
+        xaxis=dict(range=timeRange),
     )
-    fig = go.Figure(data=data, layout=layout)
-    pdf_file = io.BytesIO()
-    pio.write_image(fig, pdf_file, 'pdf')
-    pdf_file.seek(0)
-    merger.append(pdf_file)
-
-# write the detailed graphs
-print("writing detailed PPG, BPM, and SPO2 graphs")
-timeSectionToGraphMin = 1
-detailGraphsToWrite = math.ceil(numberOfSamples / samplesPerSecond / 60 / timeSectionToGraphMin)
-
-# title slide
-data = []
-layout = go.Layout(
-    width=2000,
-    height=350,
-    margin=dict(l=80, r=80, b=40, t=20, pad=4),
-    font=dict(color='rgb(0,0,0)', size=40, family='Helvetica'),
-    showlegend=False,
-    title=dict(text = "Detailed PPG, SpO₂, and BPM Graphs<br>(" + str(timeSectionToGraphMin*60) + " seconds per graph)",
-        x = 0.5, y = 0.57, xanchor = 'center', yanchor = 'middle'),
-    xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-    yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
-)
-fig = go.Figure(data=data, layout=layout)
-pdf_file = io.BytesIO()
-pio.write_image(fig, pdf_file, 'pdf')
-pdf_file.seek(0)
-merger.append(pdf_file)
-
-# data slides
-for detailGraph in range(0, detailGraphsToWrite):
-    print("creating graph: " + str(detailGraph+1) + "/" + str(detailGraphsToWrite))
-    timeOffsetS = detailGraph * timeSectionToGraphMin * 60
-    samplesOffset = round(timeOffsetS * samplesPerSecond)
-    # print("samplesOffset: " + str(samplesOffset))
-    timeSectionToGraphMs = timeSectionToGraphMin * 60 * 1000
-    sampleSizeToGraph = round(numberOfSamples * timeSectionToGraphMs / durationMs)
-    # print("samples in subset: " + str(sampleSizeToGraph))
-
-    timeSequence = []
-    for i in range(samplesOffset, sampleSizeToGraph + samplesOffset):
-        millisecondsTick = timeSectionToGraphMs * i / sampleSizeToGraph
-        timeSequence.append(startDateTime + timedelta(milliseconds=millisecondsTick))
-        # timeSequence.append(timeSectionToGraphMs * i / sampleSizeToGraph / 1000)
-
-    oximeterDataSubset = []
-    if (sampleSizeToGraph+samplesOffset <= numberOfSamples): # if we are well before the end, all is fine
-        oximeterDataSubset = oximeterData[samplesOffset:sampleSizeToGraph+samplesOffset]
-    else: # otherwise we have to make sure that we do not access data that does not exist, and fill it up with empty values
-        oximeterDataSubset = oximeterData[samplesOffset:numberOfSamples]
-        for i in range(0, sampleSizeToGraph+samplesOffset - numberOfSamples):
-            oximeterDataSubset.append(emptyEntry)
-
-    # print("samples in subset: " + str(len(oximeterDataSubset)))
-    ppgDataSubset = []
-    bpmDataSubset = []
-    spo2DataSubset = []
-    for i in range(0, sampleSizeToGraph):
-        ppgDataSubset.append(oximeterDataSubset[i]['PPG'])
-        bpmDataSubset.append(oximeterDataSubset[i]['BPM'])
-        spo2DataSubset.append(oximeterDataSubset[i]['SPO2'])
-
-    data = [
-        go.Scatter(
-            x=timeSequence,
-            y=bpmDataSubset,
-            mode='lines',
-            name='BPM',
-            line=dict(color='rgb(0,100,80)', width=2),
-            yaxis='y2',
-        ),
-        go.Scatter(
-            x=timeSequence,
-            y=spo2DataSubset,
-            mode='lines',
-            name='SpO₂',
-            line=dict(color='rgb(49,130,189)', width=2),
-            yaxis='y2',
-        ),
-        go.Scatter(
-            x=timeSequence,
-            y=ppgDataSubset,
-            mode='lines',
-            name='PPG',
-            line=dict(color='black', width=1),
-            yaxis='y1',
-        ),
+    if (kind == "samples"):
+        layout.update(
+            yaxis=dict(title='PPG (black)', range=[0, 100]),
+            yaxis2=dict(title='BPM (green), SpO₂ (blue)', titlefont = dict(size = 25), overlaying='y', side='right', range=[bpmSpo2LowValue, bpmSpo2HighValue]),
+        )
+    else:
+        layout.update(
+            yaxis=dict(title='SpO₂ in % (blue)', range=[spo2LowValue, 100]),
+            yaxis2=dict(title='BPM (green)', overlaying='y', side='right', range=[bpmLowValue, bpmHighValue]),
+        )
+    return go.Layout(**layout)
+
+def trace(msValues, values, name, color, width, yaxis):
+    return go.Scatter(x=graphTimes(startDateTime, msValues - startTimeMs), y=values, mode='lines', name=name, line=dict(color=color, width=width), yaxis=yaxis)
+
+# the traces of a graph of each kind: the smoothed SpO2 and BPM (see smoothedSession) or the range of their values
+# per bucket, both from the summary pyramid, or all samples of PPG, SpO2, and BPM (given as their times and values, reduced to the
+# output resolution only at high sample rates)
+def averagedTraces(rangeMs, samples):
+    bucketMs, bpmSmoothed, spo2Smoothed = samples
+    return [
+        trace(bucketMs, bpmSmoothed, 'BPM', 'rgb(0,100,80)', 2, 'y2'),
+        trace(bucketMs, spo2Smoothed, 'SpO₂', 'rgb(49,130,189)', 2, 'y1'),
     ]
-    bpmSpo2LowValue = 55
-    if (bpmMin < bpmSpo2LowValue): bpmSpo2LowValue = bpmMin
-    if (spo2Min < bpmSpo2LowValue): bpmSpo2LowValue = spo2Min
-    bpmSpo2HighValue = 120
-    if (bpmMax > bpmSpo2HighValue): bpmSpo2HighValue = bpmMax
+
+# the pyramids cover the whole recordings, so the buckets are limited to the session's time limits (--from/--to)
+def rangeTraces(rangeMs, samples):
+    bucketMs, buckets = pyramidBuckets(pyramids, pyramidLevel((rangeMs[1] - rangeMs[0]) / plotColumns), [max(rangeMs[0], startTimeMs), min(rangeMs[1], endTimeMs + 1)])
+    return [
+        trace(*bucketEnvelope(bucketMs, buckets, "BPM"), 'BPM', 'rgb(0,100,80)', 2, 'y2'),
+        trace(*bucketEnvelope(bucketMs, buckets, "SPO2"), 'SpO₂', 'rgb(49,130,189)', 2, 'y1'),
+    ]
+
+def samplesTraces(rangeMs, samples):
+    timeSubset, ppgSubset, bpmSubset, spo2Subset = samples
+    return [
+        trace(*decimateTrace(timeSubset, bpmSubset, rangeMs), 'BPM', 'rgb(0,100,80)', 2, 'y2'),
+        trace(*decimateTrace(timeSubset, spo2Subset, rangeMs), 'SpO₂', 'rgb(49,130,189)', 2, 'y2'),
+        trace(*decimateTrace(timeSubset, ppgSubset, rangeMs), 'PPG', 'black', 1, 'y1'),
+    ]
+
+graphTraces = {"averaged": averagedTraces, "range": rangeTraces, "samples": samplesTraces}
+numberOfGraphs = sum([len(plan["rangesMs"]) for plan in graphPlans])
+graphsDone = 0
+
+for section in graphPlans:
+    minutesPerGraph = section["minutesPerGraph"]
+    kind = section["kind"]
+    if (kind == "averaged"):
+        print("writing very coarse, averaged BPM and SPO2 graphs")
+        sectionTitle = "Coarse, Averaged SpO₂ and BPM Graphs<br>(" + "{:g}".format(smoothing[1]) + "s " + smoothingNames[smoothing[0]] + ", " + "{:g}".format(minutesPerGraph) + " minutes per graph)"
+    elif (kind == "range"):
+        print("writing coarse BPM and SPO2 graphs")
+        sectionTitle = "Coarse SpO₂ and BPM Graphs<br>(" + "{:g}".format(minutesPerGraph) + " minutes per graph)"
+    else:
+        print("writing detailed PPG, BPM, and SPO2 graphs")
+        sectionTitle = "Detailed PPG, SpO₂, and BPM Graphs<br>(" + "{:g}".format(minutesPerGraph * 60) + " seconds per graph)"
+        if (args.events != None): sectionTitle = "Detailed PPG, SpO₂, and BPM Graphs of the Events<br>(" + "{:g}".format(minutesPerGraph * 60) + " seconds per graph, " + str(len(section["rangesMs"])) + " graphs)"
+
+    # title slide
+    stages.enter("figures", len(pages) + 1)
+    data = []
     layout = go.Layout(
         width=2000,
         height=350,
         margin=dict(l=80, r=80, b=40, t=20, pad=4),
-        font=dict(color='rgb(0,0,0)', size=25, family='Helvetica'),
-        # xaxis = dict(tickfont = dict(size = 20)),
-        # xaxis = dict(tickangle=315, nticks=totalEntryCount+1),
-        # yaxis = dict(nticks=9),
+        font=dict(color='rgb(0,0,0)', size=40, family='Helvetica'),
         showlegend=False,
-        # legend=dict(x=0.03, y=1.0, font=dict(size=20),bordercolor='rgb(0,0,0)',borderwidth=1),
-        yaxis=dict(title='PPG (black)', range=[0, 100]),
-        yaxis2=dict(title='BPM (green), SpO₂ (blue)', titlefont = dict(size = 25), overlaying='y', side='right', range=[bpmSpo2LowValue, bpmSpo2HighValue]),
+        title=dict(text = sectionTitle, x = 0.5, y = 0.57, xanchor = 'center', yanchor = 'middle'),
+        xaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
+        yaxis = dict(showticklabels=False, showgrid=False, zeroline=False),
     )
-    fig = go.Figure(data=data, layout=layout)
-    pdf_file = io.BytesIO()
-    pio.write_image(fig, pdf_file, 'pdf')
-    pdf_file.seek(0)
-    merger.append(pdf_file)
-
-# output all of that
-print("writing final pdf")
-merger.write(dataFileName.split(".")[0] + "-" + filenameExtension + ".pdf")
\ No newline at end of file
+    pages.append(go.Figure(data=data, layout=layout).to_dict())
+
+    # data slides; the detailed graphs get their samples as views into the timeline or, in the streaming mode, from
+    # a new pass over the recordings, the averaged graphs views into the smoothed session (with a margin of the
+    # smoothing window beyond their time range)
+    stages.enter("pages")
+    sectionSamples = itertools.repeat(None)
+    if (kind == "averaged"):
+        smoothedValues = smoothedSession(minutesPerGraph * 60 * 1000, [startTimeMs, endTimeMs + 1])
+        marginMs = smoothing[1] * 1000 + smoothingLevel(minutesPerGraph * 60 * 1000)
+        bounds = np.searchsorted(smoothedValues[0], section["rangesMs"] + [-marginMs, marginMs]) if (len(section["rangesMs"]) > 0) else np.zeros((0, 2), dtype=np.int64)
+        sectionSamples = ([values[start:end] for values in smoothedValues] for start, end in bounds)
+    if (kind == "samples") and (args.stream): sectionSamples = sampleWindows(streamSamples(recordingLimits, samplesPerMs), section["rangesMs"])
+    elif (kind == "samples"): sectionSamples = ([values[start:end] for values in [timeMs, ppgValues, bpmValues, spo2Values]] for start, end in section["samples"])
+    for detailGraph, (rangeMs, samples) in enumerate(zip(section["rangesMs"], sectionSamples)):
+        pageNumber = len(pages) + 1
+        stages.enter("pages", pageNumber)
+        print("creating graph: " + str(detailGraph+1) + "/" + str(len(section["rangesMs"])) + ("" if (args.profile == None) else stages.eta("graphs", graphsDone, numberOfGraphs)))
+        timeRange = [startDateTime + timedelta(milliseconds=float(rangeMs[0] - startTimeMs)), startDateTime + timedelta(milliseconds=float(rangeMs[1] - startTimeMs))]
+        traces = graphTraces[kind](rangeMs, samples)
+        stages.enter("figures", pageNumber)
+        page = go.Figure(data=traces, layout=graphLayout(timeRange, kind)).to_dict()
+        stages.enter("export", pageNumber)
+        pages.append(page)
+        stages.enter("pages")
+        graphsDone += 1
+
+# render the pages and output all of that
+# (with matplotlib, the pages are exported and written into the PDF in one go)
+if (args.stream):
+    print("writing final pdf")
+    stages.enter("pdf")
+    pages.close()
+elif (args.backend == "matplotlib"):
+    renderStartTime = time.perf_counter()
+    print("rendering " + str(len(pages)) + " pages and writing final pdf with matplotlib")
+    for pageIndex, pageStarts in enumerate(writeMatplotlibReport(pages, reportPdfFileName)):
+        stages.enter("export", pageIndex + 1)
+        if (args.profile != None): print("rendering page " + str(pageIndex + 1) + "/" + str(len(pages)) + stages.eta("render", pageIndex, len(pages)))
+    stages.enter("pdf")
+else:
+    renderStartTime = time.perf_counter()
+    print("rendering " + str(len(pages)) + " pages" + (" in " + str(args.jobs) + " processes" if (args.jobs > 1) else ""))
+    merger = PdfFileMerger(strict=False)
+    renderedPages = renderPages(pages, args.jobs) if (args.cacheSizeMB <= 0) else renderPagesCached(pages, args.jobs, args.cache, args.cacheSizeMB * 1e6)
+    stages.enter("export", 1)
+    for pageIndex, pdf in enumerate(renderedPages):
+        stages.enter("pdf", pageIndex + 1)
+        if (args.profile != None): print("rendered page " + str(pageIndex + 1) + "/" + str(len(pages)) + stages.eta("render", pageIndex + 1, len(pages)))
+        merger.append(io.BytesIO(pdf))
+        stages.enter("export", pageIndex + 2)
+    print("writing final pdf")
+    stages.enter("pdf")
+    merger.write(reportPdfFileName)
+renderTimeS = time.perf_counter() - renderStartTime
+print("rendered " + str(len(pages)) + " pages in " + "{:.2f}".format(renderTimeS) + "s (" + "{:.3f}".format(renderTimeS / len(pages)) + "s per page), " +
+    "{:,}".format(os.path.getsize(reportPdfFileName)) + " bytes")
+print("stage times: " + stages.summary())
+if (args.profile != None):
+    print(stages.breakdown())
+    stages.writeTrace(args.profile, args.profileFormat)
+    print("wrote the profile to " + args.profile)
+stages.writePageProfile(reportPdfFileName)
+print("wrote " + reportPdfFileName)
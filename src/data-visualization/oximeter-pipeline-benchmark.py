@@ -0,0 +1,246 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2020  Tobias Isenberg
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Pipeline benchmark for oximeter-data-visualization.py: generates synthetic nights of different lengths in the
+# recorder's CSV format, creates their reports, and records the time of each stage of the visualization (as printed
+# by the visualizer), the total time, and the peak memory, as JSON that can be compared with the results of another
+# version. Everything runs locally, without the ESP32 or a network connection.
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+visualizerFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oximeter-data-visualization.py")
+backends = ["plotly", "matplotlib"]
+nightLengths = {"1h": 1, "8h": 8, "24h": 24, "7d": 7 * 24}
+streamFromHours = 24 # longer nights do not fit into memory as a whole and are visualized with --stream
+
+# the recorder's CSV format (see oximeter-data-recording.py): 25 BLE notifications per second with 4 samples each,
+# which share the notification's ms timestamp, sent in buffers of 15 seconds whose last sample has the buffer-end
+# marker; samples without a reading have empty BPM and SpO2 fields (127 in the data buffer)
+csvColumns = ["PPG", "BPM", "SPO2", "MS-timestamp", "buffer-end-marker"]
+noReadingValue = 127
+notificationMs = 40
+samplesPerNotification = 4
+bufferMs = 15000
+# the synthetic nights: a new file after each reconnect (every few hours, with a gap of reconnectMs), lost buffers,
+# readings that are missing at the start of each file and while the finger moves (with a noisy PPG), and
+# desaturations; generatorVersion changes whenever the generated data does
+generatorVersion = 1
+reconnectEveryMs = 3 * 3600000
+reconnectMs = 40000
+lostBufferShare = 0.002
+noReadingAtStartMs = 8000
+movementsPerHour = 2
+desaturationsPerHour = 4
+
+# the visualizer's output: the number of samples, the rendered pages, and the time per stage, e.g.,
+# "stage times: parse 1.234s, pyramids 0.456s, merge 0.123s, ..."
+samplesPattern = re.compile(r"^read (\d+) samples$", re.MULTILINE)
+renderedPattern = re.compile(r"rendered (\d+) pages in ([\d.]+)s \(([\d.]+)s per page\), ([\d,]+) bytes")
+stagesPattern = re.compile(r"^stage times: (.*)$", re.MULTILINE)
+stagePattern = re.compile(r"(\w+) ([\d.]+)s")
+
+# random intervals (start and end in ms, sorted) of the given lengths, about perHour of them per hour
+def randomIntervals(rng, durationMs, perHour, lengthMs):
+    starts = np.sort(rng.integers(0, durationMs, int(durationMs / 3600000 * perHour)))
+    return starts, starts + rng.integers(lengthMs[0], lengthMs[1], len(starts))
+
+# whether each time lies in one of the intervals
+def inIntervals(timeMs, intervals):
+    index = np.searchsorted(intervals[0], timeMs, side='right') - 1
+    return (index >= 0) & (timeMs < intervals[1][np.maximum(index, 0)])
+
+# the samples of the notifications at the given times (in ms since the start of the session), with a heart rate that
+# slowly changes (and a PPG wave that follows it, continued from phase) and the readings missing or lowered in the
+# given intervals; returns the samples as a table and the phase at the end
+def syntheticSamples(rng, notificationTimeMs, phase, noReading, movements, desaturations):
+    timeMs = (notificationTimeMs[:, np.newaxis] + np.arange(samplesPerNotification) * notificationMs / samplesPerNotification).ravel()
+    heartRate = 62 + 6 * np.sin(timeMs / 2400000) + 3 * np.sin(timeMs / 170000)
+    phases = phase + 2 * np.pi * np.cumsum(heartRate / 60 * notificationMs / samplesPerNotification / 1000)
+    moving = inIntervals(timeMs, movements)
+    ppg = 50 + 30 * np.sin(phases) + 10 * np.sin(2 * phases + 1) + rng.normal(0, 2, len(timeMs)) + np.where(moving, rng.normal(0, 25, len(timeMs)), 0)
+    secondMs = timeMs // 1000 * 1000
+    bpm = np.round(62 + 6 * np.sin(secondMs / 2400000) + 3 * np.sin(secondMs / 170000) + rng.integers(-1, 2, len(timeMs)))
+    spo2 = np.round(96 + np.sin(secondMs / 1300000) + rng.integers(0, 2, len(timeMs)) - np.where(inIntervals(secondMs, desaturations), 5, 0))
+    missing = noReading | moving
+    samples = pd.DataFrame({
+        "PPG": np.clip(np.round(ppg), 0, 100).astype(np.uint8),
+        "BPM": pd.array(np.where(missing, 0, bpm), dtype="UInt8"),
+        "SPO2": pd.array(np.where(missing, 0, spo2), dtype="UInt8"),
+        "MS-timestamp": np.repeat(notificationTimeMs, samplesPerNotification),
+        "buffer-end-marker": 0,
+    })
+    samples.loc[missing, ["BPM", "SPO2"]] = pd.NA
+    return samples, phases[-1] % (2 * np.pi)
+
+# write a synthetic night of the given length into the directory, as the recorder does: one CSV file per connection,
+# named after the wall-clock time and the ESP32's ms timestamp of its start; returns the files
+def writeSyntheticNight(directory, hours):
+    rng = np.random.default_rng(hours)
+    os.makedirs(directory, exist_ok=True)
+    bootDateTime = datetime(2020, 7, 5, 22, 14, 10)
+    sessionStartMs = 29871 # the ESP32 has been running for a while when the oximeter connects
+    durationMs = int(hours * 3600000)
+    movements = randomIntervals(rng, durationMs, movementsPerHour, [5000, 60000])
+    desaturations = randomIntervals(rng, durationMs, desaturationsPerHour, [15000, 40000])
+    fileNames = []
+    phase = 0
+    for fileStartMs in range(0, durationMs, reconnectEveryMs):
+        fileEndMs = min(fileStartMs + reconnectEveryMs, durationMs)
+        if (fileStartMs > 0): fileStartMs += reconnectMs
+        startMs = sessionStartMs + fileStartMs
+        startDateTime = bootDateTime + timedelta(milliseconds=startMs)
+        fileName = os.path.join(directory, "oximeter-" + startDateTime.strftime("%Y%m%d-%H%M%S") + "-" + str(startMs) + ".csv")
+        with open(fileName, 'w', encoding='utf-8') as f:
+            f.write(",".join(csvColumns) + "\n")
+            # an hour at a time; the buffers that get lost are left out
+            for chunkStartMs in range(fileStartMs, fileEndMs, 3600000):
+                notificationTimeMs = np.arange(chunkStartMs, min(chunkStartMs + 3600000, fileEndMs), notificationMs)
+                bufferStarts = (notificationTimeMs - fileStartMs) // bufferMs
+                bufferEnds = np.append(bufferStarts[1:] != bufferStarts[:-1], True)
+                kept = rng.random(len(notificationTimeMs) // (bufferMs // notificationMs) + 2)[bufferStarts - bufferStarts[0]] >= lostBufferShare
+                noReading = np.repeat(notificationTimeMs - fileStartMs < noReadingAtStartMs, samplesPerNotification)
+                samples, phase = syntheticSamples(rng, notificationTimeMs, phase, noReading, movements, desaturations)
+                samples["MS-timestamp"] += sessionStartMs
+                samples.loc[np.repeat(bufferEnds, samplesPerNotification) & np.tile(np.arange(samplesPerNotification) == samplesPerNotification - 1, len(notificationTimeMs)), "buffer-end-marker"] = noReadingValue
+                samples[np.repeat(kept, samplesPerNotification)].to_csv(f, header=False, index=False, lineterminator="\n")
+            f.close()
+        fileNames.append(fileName)
+    return fileNames
+
+# the files of a synthetic night, generated unless they already exist (from the same version of the generator)
+def syntheticNight(dataDirectory, night):
+    directory = os.path.join(dataDirectory, "night-" + night)
+    doneFileName = os.path.join(directory, "generated-" + str(generatorVersion))
+    if (os.path.exists(doneFileName)):
+        with open(doneFileName, 'r', encoding='utf-8') as f:
+            fileNames = f.read().splitlines()
+            f.close()
+        return fileNames
+    print("generating the synthetic " + night + " night in " + directory)
+    shutil.rmtree(directory, ignore_errors=True)
+    startTime = time.perf_counter()
+    fileNames = writeSyntheticNight(directory, nightLengths[night])
+    with open(doneFileName, 'w', encoding='utf-8') as f:
+        f.write("\n".join(fileNames) + "\n")
+        f.close()
+    print("generated " + str(len(fileNames)) + " files (" + "{:,}".format(sum([os.path.getsize(fileName) for fileName in fileNames])) + " bytes) in " + "{:.1f}".format(time.perf_counter() - startTime) + "s")
+    return fileNames
+
+# visualize a night once (without the summary pyramids from an earlier run and without the page cache) and return the
+# measurements, or None if the visualization failed; the peak memory is that of the visualizer's process
+def visualizeNight(fileNames, backend, stream):
+    for fileName in fileNames:
+        pyramidFileName = os.path.splitext(fileName)[0] + ".pyramid"
+        if (os.path.exists(pyramidFileName)): os.remove(pyramidFileName)
+    command = [sys.executable, visualizerFileName, "benchmark", *fileNames, "--backend", backend, "--cache-size", "0", "--sections", args.sections]
+    if (stream): command.append("--stream")
+    startTime = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = process.stdout.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    wallS = time.perf_counter() - startTime
+    process.returncode = os.waitstatus_to_exitcode(status)
+    rendered, stages, samples = renderedPattern.search(output), stagesPattern.search(output), samplesPattern.search(output)
+    if (process.returncode != 0) or (rendered == None) or (stages == None):
+        print(output)
+        return None
+    if (not args.keep):
+        for line in output.splitlines():
+            if (line.startswith("wrote ")) and (os.path.exists(line[6:])): os.remove(line[6:])
+    return dict(wallS=round(wallS, 3), peakRssMB=round(usage.ru_maxrss / 1024, 1), samples=int(samples.group(1)) if (samples != None) else None,
+        pages=int(rendered.group(1)), pdfBytes=int(rendered.group(4).replace(",", "")),
+        stagesS={stage: float(seconds) for stage, seconds in stagePattern.findall(stages.group(1))})
+
+# the commit of the visualizer, if it is in a git repository
+def visualizerVersion():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(visualizerFileName), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def printResults(results, compared):
+    stageNames = list(dict.fromkeys([stage for result in results for stage in result["stagesS"]]))
+    print()
+    print("{:<6}{:<12}{:>9}{:>8}{:>9}".format("night", "backend", "total", "MB", "pages") + "".join(["{:>11}".format(stage) for stage in stageNames]))
+    for result in results:
+        print("{:<6}{:<12}{:>8.2f}s{:>8.0f}{:>9}".format(result["night"], result["backend"] + (" stream" if (result["stream"]) else ""), result["wallS"], result["peakRssMB"], result["pages"]) +
+            "".join(["{:>10.3f}s".format(result["stagesS"][stage]) if (stage in result["stagesS"]) else "{:>11}".format("") for stage in stageNames]))
+        previous = compared.get((result["night"], result["backend"], result["stream"]))
+        if (previous != None):
+            ratio = lambda new, old: "{:>10.2f}x".format(new / old) if (old > 0) else "{:>11}".format("")
+            print("{:<18}".format("  vs. " + str(compared["version"])) + "{:>8.2f}x{:>7.2f}x{:>9}".format(result["wallS"] / previous["wallS"], result["peakRssMB"] / previous["peakRssMB"], "") +
+                "".join([ratio(result["stagesS"][stage], previous["stagesS"][stage]) if (stage in result["stagesS"]) and (stage in previous["stagesS"]) else "{:>11}".format("") for stage in stageNames]))
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the stages of oximeter-data-visualization.py on synthetic nights of different lengths.",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog="examples:\n" +
+        "  " + os.path.basename(__file__) + "\n" +
+        "  " + os.path.basename(__file__) + " --nights 1h 8h 24h 7d --backends matplotlib --output results.json\n" +
+        "  " + os.path.basename(__file__) + " --compare results.json")
+parser.add_argument("--nights", nargs="+", choices=list(nightLengths), default=["1h", "8h"], help="lengths of the synthetic nights (default: %(default)s; nights of more than " + str(streamFromHours) + "h are visualized with --stream)")
+parser.add_argument("--backends", nargs="+", choices=backends, default=["matplotlib"], help="rendering backends (default: %(default)s)")
+parser.add_argument("--stream", action="store_true", help="visualize all nights with --stream")
+parser.add_argument("--sections", default="60:averaged,10:range,1:samples", metavar="LIST", help="the sections of the reports, as for oximeter-data-visualization.py (default: %(default)s)")
+parser.add_argument("--runs", type=int, default=1, help="visualize each night this many times and keep the fastest run (default: 1)")
+parser.add_argument("--data", metavar="DIR", default=os.path.join(tempfile.gettempdir(), "oximeter-pipeline-benchmark"), help="directory for the synthetic nights, which are kept for later runs (default: %(default)s)")
+parser.add_argument("--output", metavar="FILE", help="write the results to FILE (as JSON)")
+parser.add_argument("--compare", metavar="FILE", help="compare the results with those of an earlier run (as written with --output)")
+parser.add_argument("--keep", action="store_true", help="keep the reports (named after the first file of each night with the suffix benchmark)")
+args = parser.parse_args()
+
+compared = {}
+if (args.compare != None):
+    with open(args.compare, 'r', encoding='utf-8') as f:
+        earlier = json.load(f)
+        f.close()
+    compared = {(result["night"], result["backend"], result["stream"]): result for result in earlier["results"]}
+    compared["version"] = earlier.get("version") or args.compare
+
+results = []
+for night in args.nights:
+    fileNames = syntheticNight(args.data, night)
+    stream = (args.stream) or (nightLengths[night] > streamFromHours)
+    for backend in (["matplotlib"] if (stream) else args.backends):
+        best = None
+        for run in range(args.runs):
+            print("visualizing the " + night + " night with " + backend + (" (streaming)" if (stream) else "") + " (run " + str(run + 1) + " of " + str(args.runs) + ")")
+            measurements = visualizeNight(fileNames, backend, stream)
+            if (measurements == None): sys.exit("visualizing the " + night + " night with " + backend + " failed")
+            if (best == None) or (measurements["wallS"] < best["wallS"]): best = measurements
+        results.append(dict(night=night, hours=nightLengths[night], files=len(fileNames), backend=backend, stream=stream, **best))
+
+printResults(results, compared)
+if (args.output != None):
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(dict(version=visualizerVersion(), date=datetime.now().isoformat(sep=" ", timespec="seconds"), python=platform.python_version(), platform=platform.platform(),
+            cpus=os.cpu_count(), generatorVersion=generatorVersion, sections=args.sections, results=results), f, indent=1)
+        f.close()
+    print("wrote " + args.output)
@@ -0,0 +1,63 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2020  Tobias Isenberg
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Render benchmark for oximeter-data-visualization.py: creates the report of the same session with each
+# rendering backend and compares the render time per page and the size of the resulting PDF.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+visualizerFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oximeter-data-visualization.py")
+backends = ["plotly", "matplotlib"]
+
+# the visualizer's last line of output, e.g., "rendered 18 pages in 13.59s (0.755s per page), 310,224 bytes"
+renderedPattern = re.compile(r"rendered (\d+) pages in ([\d.]+)s \(([\d.]+)s per page\), ([\d,]+) bytes")
+
+parser = argparse.ArgumentParser(description="Compare the render time and report size of the rendering backends of oximeter-data-visualization.py.")
+parser.add_argument("files", nargs="+", help="data files of the session to visualize (as for oximeter-data-visualization.py)")
+parser.add_argument("--backends", nargs="+", choices=backends, default=backends, help="backends to compare (default: all)")
+parser.add_argument("--runs", type=int, default=1, help="render the report this many times per backend and report the fastest run (default: 1)")
+parser.add_argument("--keep", action="store_true", help="keep the rendered reports (named after the session with the suffix benchmark-<backend>)")
+args = parser.parse_args()
+
+results = {}
+for backend in args.backends:
+    description = "benchmark-" + backend
+    for run in range(args.runs):
+        print("rendering with " + backend + " (run " + str(run + 1) + " of " + str(args.runs) + ")")
+        output = subprocess.run([sys.executable, visualizerFileName, description, *args.files, "--backend", backend, "--cache-size", "0"],
+            capture_output=True, text=True)
+        match = renderedPattern.search(output.stdout)
+        if (output.returncode != 0) or (match == None):
+            print(output.stdout + output.stderr)
+            sys.exit("rendering with " + backend + " failed")
+        pages, totalS, perPageS, size = int(match.group(1)), float(match.group(2)), float(match.group(3)), int(match.group(4).replace(",", ""))
+        if (backend not in results) or (totalS < results[backend][1]): results[backend] = (pages, totalS, perPageS, size)
+    if (not args.keep):
+        for line in output.stdout.splitlines():
+            if (line.startswith("wrote ")) and (os.path.exists(line[6:])): os.remove(line[6:])
+
+print()
+print("backend       pages    total   per page        size")
+for backend, (pages, totalS, perPageS, size) in results.items():
+    print("{:<12}{:>7}{:>8.2f}s{:>10.3f}s{:>12,}".format(backend, pages, totalS, perPageS, size))
+if (len(results) == 2):
+    plotly, matplotlib = results["plotly"], results["matplotlib"]
+    print("matplotlib renders " + "{:.1f}".format(plotly[2] / matplotlib[2]) + "x faster per page, its report is " + "{:.0f}".format(100 * matplotlib[3] / plotly[3]) + "% of the size")